@@ -1,11 +1,24 @@
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
+from .cli.storage import ShardedStorage
 
 app = Flask(__name__)
 app.config.from_object('config')
 db = SQLAlchemy(app)
+image_storage = ShardedStorage(app.config['IMAGE_DIR'],
+    app.config['IMAGE_SHARD_LEVELS'])
 
 import views
+from .collector import start_collector
+from .workers import start_watchdog
+
+# the collector and watchdog are only wanted by a running app, not by every
+# script that imports it, like db_create.py
+@app.before_first_request
+def start_background_threads():
+    if app.config['GC_ENABLED']:
+        start_collector()
+    start_watchdog(views.cancel_job)
 
 if __name__=='__main__':
     app.run()
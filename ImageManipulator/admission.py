@@ -0,0 +1,190 @@
+"""
+Admission control for manipulation jobs. The cost of a job is estimated from
+the dimensions of the upload (read from its header) and the command line
+arguments, before any work is queued, and decides whether the job is run
+normally, run on the low priority queue, downscaled or rejected.
+"""
+from .cache import normalize_arguments
+
+# Seconds of work per megapixel of a frame and per box of a frame for each
+# stage, fitted to benchmarks/bench_manipulator.py with --threads 2 (the
+# JOB_THREADS of the web app). Frame is fitted to timings of the whole script
+# with --nogif, and encode to timings of it on jobs from smooth averaged
+# frames to noisy random ones, as quantizing a frame takes longer the noisier
+# it is. The weights only need to be right to within a small factor for the
+# ADMISSION_* thresholds.
+OPERATION_WEIGHTS = {
+    'frame': (0.011, 1.8e-7),
+    'flip': (0.011, 1.9e-7),
+    'ninety': (0.0067, 1.2e-6),
+    'average': (0.028, 1.7e-7),
+    'random': (0.0036, 6.6e-7),
+    'encode': (0.51, 0.0),
+}
+
+# What to do with a job
+ACCEPT = 'accept'
+LOW_PRIORITY = 'low_priority'
+DOWNSCALE = 'downscale'
+REJECT = 'reject'
+
+class AdmissionError(ValueError):
+    """ Raised when a job can not be admitted, with a message for the user. """
+
+def get_box_sizes(width, height, options):
+    """
+    Computes the box size of every frame the same way the manipulation script
+    does.
+
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param options: A dictionary of normalized command line options.
+    :return: A list of box sizes.
+    """
+    multiplier = 1 if '--constant' in options else 2
+    if '--auto' in options:
+        if '--vertical' in options: max_size = width
+        elif '--horizontal' in options: max_size = height
+        else: max_size = min(width, height)
+
+        box_sizes, box_size = [], 1
+        while box_size * 2 <= max_size:
+            box_sizes.append(box_size)
+            box_size *= multiplier
+        return box_sizes
+
+    box_size = get_positive_int(options, '--box_size', 0)
+    iterations = get_positive_int(options, '--iterations', 1)
+    return [box_size * multiplier ** i for i in range(iterations)]
+
+def get_positive_int(options, option, default):
+    """
+    :return: The value of option as a non-negative int, or default if the
+    option is not given.
+    :raises AdmissionError: If the value is not a non-negative whole number.
+    """
+    if options.get(option) is None:
+        return default
+    try:
+        value = int(options[option])
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise AdmissionError(
+            '{} must be a whole number'.format(option.strip('-')
+                .replace('_', ' ').capitalize()))
+    return value
+
+def count_boxes(width, height, box_size, options):
+    """ :return: The number of boxes a frame is split into. """
+    if box_size == 0:
+        return 1
+    if '--vertical' in options:
+        return width // box_size
+    if '--horizontal' in options:
+        return height // box_size
+    return (width // box_size) * (height // box_size)
+
+def estimate_cost(width, height, arguments, n_frames=1):
+    """
+    Estimates the cost of a job as pixels x frames x per-operation weights.
+    A still image is rendered once per box size and its animation loops back
+    through the middle frames; an animated image renders each of its frames
+    once, with the box sizes in turn, and is not looped.
+
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param arguments: The command line arguments of the job.
+    :param n_frames: The number of frames of the image.
+    :return: The estimated cost in seconds of work.
+    """
+    options = dict(normalize_arguments(arguments))
+    if '--resize' in options:
+        width, height = get_resized_size(width, height, options['--resize'])
+    megapixels = width * height / 1e6
+    operations = [name for name in ['flip', 'ninety', 'average', 'random']
+                  if '--' + name in options]
+    square = not ('--vertical' in options or '--horizontal' in options)
+
+    box_sizes = get_box_sizes(width, height, options)
+    frame_costs = []
+    for box_size in box_sizes:
+        n_boxes = count_boxes(width, height, box_size, options)
+        frame_cost = megapixels * OPERATION_WEIGHTS['frame'][0]
+        for name in operations:
+            # rotating or averaging boxes of one pixel does nothing
+            if box_size == 1 and square and name != 'random':
+                continue
+            per_megapixel, per_box = OPERATION_WEIGHTS[name]
+            frame_cost += megapixels * per_megapixel + n_boxes * per_box
+        frame_costs.append(frame_cost)
+    if not frame_costs:
+        return 0.0
+
+    if n_frames > 1:
+        cycles, rest = divmod(n_frames, len(frame_costs))
+        cost = cycles * sum(frame_costs) + sum(frame_costs[:rest])
+        n_gif_frames = n_frames
+    else:
+        cost = sum(frame_costs)
+        # the animation loops back through the middle frames
+        n_gif_frames = max(0, 2 * len(box_sizes) - 2)
+    cost += n_gif_frames * megapixels * OPERATION_WEIGHTS['encode'][0]
+    return cost
+
+def get_resized_size(width, height, resize):
+    """
+    :param resize: The value of --resize, 'X Y' where either may be zero.
+    :return: The size of the image after resizing, as the script computes it.
+    """
+    new_width, new_height = [int(value) for value in resize.split()]
+    if new_width == 0 and new_height != 0:
+        new_width = int((float(width) / float(height)) * new_height)
+    elif new_width != 0 and new_height == 0:
+        new_height = int((float(height) / float(width)) * new_width)
+    return new_width, new_height
+
+def admit(width, height, arguments, config, n_frames=1):
+    """
+    Decides what to do with a job.
+
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param arguments: The command line arguments of the job.
+    :param config: The app config with the ADMISSION_* thresholds.
+    :param n_frames: The number of frames of the image, counted up to one
+    more than ADMISSION_MAX_FRAMES.
+    :return: A tuple (decision, arguments, cost); where decision is ACCEPT,
+    LOW_PRIORITY or DOWNSCALE, arguments are the arguments to run the job
+    with, which include --resize for a downscaled job, and cost is the
+    estimated cost of running them.
+    :raises AdmissionError: If the job is too expensive to run at all, or the
+    image has more frames than it could be costed for.
+    """
+    if n_frames > config['ADMISSION_MAX_FRAMES']:
+        raise AdmissionError('Animations with more than {} frames are not '
+            'supported'.format(config['ADMISSION_MAX_FRAMES']))
+    cost = estimate_cost(width, height, arguments, n_frames)
+    if cost <= config['ADMISSION_ACCEPT_COST']:
+        return ACCEPT, arguments, cost
+    if cost <= config['ADMISSION_LOW_PRIORITY_COST']:
+        return LOW_PRIORITY, arguments, cost
+
+    # find the largest width that brings the cost down to the low priority
+    # limit, the cost only grows with the size of the image
+    low, high = config['ADMISSION_MIN_WIDTH'], width - 1
+    best = None
+    while low <= high:
+        new_width = (low + high) // 2
+        resized = arguments + ['--resize', str(new_width), '0']
+        new_cost = estimate_cost(width, height, resized, n_frames)
+        if new_cost <= config['ADMISSION_LOW_PRIORITY_COST']:
+            best = resized, new_cost
+            low = new_width + 1
+        else:
+            high = new_width - 1
+
+    if best is None:
+        raise AdmissionError('This image is too large for these options, try '
+            'a smaller image, a larger box size or fewer frames')
+    return DOWNSCALE, best[0], best[1]
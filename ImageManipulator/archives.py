@@ -0,0 +1,143 @@
+"""
+Zip archives read and written a file at a time. The images of a batch are
+read out of an uploaded zip one by one, and the results are written to a zip
+that is sent as it is written, so neither archive is ever held in memory in
+full.
+"""
+import os, time, zipfile, zlib
+
+# The prefix of the metadata macOS adds to the zips it makes
+MACOS_METADATA = '__MACOSX/'
+
+def is_zip(stream):
+    """
+    :param stream: A seekable file-like object.
+    :return: True if stream contains a zip archive. The stream is rewound.
+    """
+    try:
+        return zipfile.is_zipfile(stream)
+    finally:
+        stream.seek(0)
+
+def iter_members(stream):
+    """
+    Generates the files in the zip archive in stream, skipping directories,
+    hidden files and macOS metadata.
+
+    :param stream: A seekable file-like object containing a zip archive.
+    :return: A generator of tuples (name, n_bytes, open_member); where
+    n_bytes is the size of the file once inflated, as the archive gives it,
+    and open_member() returns a new file-like object reading the file from
+    its start, which raises IOError past n_bytes.
+    """
+    archive = zipfile.ZipFile(stream)
+    for info in archive.infolist():
+        name = os.path.basename(info.filename)
+        if (not name or name.startswith('.')
+            or info.filename.startswith(MACOS_METADATA)):
+            continue
+        yield name, info.file_size, lambda info=info: LimitedReader(
+            archive.open(info), info.file_size)
+
+class LimitedReader(object):
+    """
+    Reads a file-like object that must not be longer than a limit, so that
+    an archive can not inflate a member to more than the size it claims.
+    """
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        """
+        :raises IOError: If the stream goes on past the limit.
+        """
+        if size < 0 or size > self.limit - self.n_bytes + 1:
+            # one byte more than allowed is enough to tell
+            size = self.limit - self.n_bytes + 1
+        data = self.stream.read(size)
+        self.n_bytes += len(data)
+        if self.n_bytes > self.limit:
+            raise IOError('The file is larger than the archive says')
+        return data
+
+class ZipStream(object):
+    """
+    Writes a zip archive as a stream of chunks. zipfile writes the archive
+    into this object, which only keeps the bytes written since they were last
+    read. Entries are stored uncompressed, since the images in them are
+    compressed already, and files are streamed into the archive in chunks.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+        self.archive = zipfile.ZipFile(self, 'w', zipfile.ZIP_STORED,
+            allowZip64=True)
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def read(self):
+        """ :return: The bytes written since the last read. """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+    def add_bytes(self, name, data):
+        """
+        Effect: adds an entry holding data to the archive.
+
+        :param name: The name of the entry.
+        :param data: The contents of the entry.
+        """
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        self.archive.writestr(info, data)
+
+    def add_file(self, path, name, chunk_size):
+        """
+        Adds the file at path to the archive, reading it twice in chunks: once
+        for its checksum, which comes before the contents, then to copy it.
+
+        :param path: The path of the file.
+        :param name: The name of the entry.
+        :param chunk_size: The number of bytes to read at a time.
+        :return: A generator of the chunks of the archive holding the entry.
+        """
+        crc, size = 0, 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+
+        info = zipfile.ZipInfo(name,
+            time.localtime(os.path.getmtime(path))[:6])
+        info.external_attr = 0o644 << 16
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = info.compress_size = size
+        info.CRC = crc & 0xffffffff
+        info.header_offset = self.offset
+        self.write(info.FileHeader(size > zipfile.ZIP64_LIMIT))
+        yield self.read()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                self.offset += len(chunk)
+                yield chunk
+        self.archive.filelist.append(info)
+        self.archive.NameToInfo[name] = info
+
+    def close(self):
+        """
+        Effect: writes the central directory that ends the archive, to be
+        read with read.
+        """
+        self.archive.close()
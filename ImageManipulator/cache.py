@@ -0,0 +1,150 @@
+import os, json, hashlib, datetime
+from . import app, db, image_storage
+from .models import CachedResult, DONE
+
+# Options that make the output depend on the random number generator. Results
+# using them are only cached when an explicit seed is given.
+NONDETERMINISTIC_OPTIONS = ['--random', '--ninety']
+
+def normalize_arguments(arguments):
+    """
+    Normalizes a list of command line arguments as returned by
+    get_cli_arguments so that equivalent option sets compare equal, e.g.
+    '--box_size 08' and '--box_size 8'.
+
+    :param arguments: A list of command line arguments.
+    :return: A sorted list of (option, value) tuples; value is None for flags
+    and the values separated by spaces for options with several values.
+    """
+    options = []
+    i = 0
+    while i < len(arguments):
+        option, values = arguments[i], []
+        while i + 1 < len(arguments) and not arguments[i + 1].startswith('--'):
+            value = arguments[i + 1]
+            try: value = str(int(value))
+            except ValueError: pass
+            values.append(value)
+            i += 1
+        options.append((option, ' '.join(values) if values else None))
+        i += 1
+    return sorted(options)
+
+def get_cache_key(content_hash, arguments, seed=None):
+    """
+    Computes the key for the result of manipulating an image with the given
+    options.
+
+    :param content_hash: The hex SHA-1 of the uploaded image.
+    :param arguments: The command line arguments, excluding --seed.
+    :param seed: The seed for the random number generator or None.
+    :return: The key as a hex string, or None if the result can not be cached
+    because it is nondeterministic.
+    """
+    if content_hash is None:
+        return None
+    options = normalize_arguments(arguments)
+    if any(option in NONDETERMINISTIC_OPTIONS for option, _ in options):
+        if seed is None:
+            return None
+    else:
+        # the seed makes no difference to a deterministic result
+        seed = None
+
+    key = json.dumps([content_hash, options, seed])
+    return hashlib.sha1(key).hexdigest()
+
+def lookup(key):
+    """
+    Looks up the result cached under key and, if there is one, marks it as
+    recently used.
+
+    :param key: The cache key.
+    :return: The CachedResult or None.
+    """
+    if key is None:
+        return None
+    entry = CachedResult.query.filter_by(key=key).first()
+    if entry is not None:
+        entry.last_used = datetime.datetime.utcnow()
+    return entry
+
+def link(image, entry):
+    """
+    Effect: makes image share the result of entry.
+
+    :param image: The Image to link.
+    :param entry: The CachedResult.
+    """
+    image.results = entry.results
+    image.results_bytes = 0
+    image.status = DONE
+    image.cache_key = entry.key
+    entry.refcount += 1
+
+def store(key, image):
+    """
+    Adds the result of image to the cache under key and links image to it, if
+    no other job stored a result under the same key in the meantime. Evicts old
+    results if the cache has grown beyond its limit.
+
+    :param key: The cache key.
+    :param image: The Image with its results set.
+    """
+    if key is None or CachedResult.query.filter_by(key=key).first():
+        return
+    entry = CachedResult(key, image.results, get_results_size(image.results))
+    db.session.add(entry)
+    link(image, entry)
+    db.session.commit()
+    evict(app.config['RESULT_CACHE_MAX_BYTES'])
+
+def release(key):
+    """
+    Effect: drops one reference to the result cached under key.
+
+    :param key: The cache key.
+    """
+    entry = CachedResult.query.filter_by(key=key).first()
+    if entry is not None and entry.refcount > 0:
+        entry.refcount -= 1
+
+def evict(max_bytes):
+    """
+    Deletes the least recently used results that are no longer referenced by
+    any Image until the cache takes up at most max_bytes.
+
+    :param max_bytes: The size limit of the cache in bytes.
+    """
+    total = db.session.query(db.func.sum(CachedResult.n_bytes)).scalar() or 0
+    if total <= max_bytes:
+        return
+
+    unused = (CachedResult.query.filter_by(refcount=0)
+        .order_by(CachedResult.last_used))
+    for entry in unused:
+        if total <= max_bytes:
+            break
+        for name in get_results_names(entry.results):
+            image_storage.remove(name)
+        total -= entry.n_bytes
+        db.session.delete(entry)
+    db.session.commit()
+
+def get_results_names(results):
+    """
+    :param results: The JSON output of the manipulation script.
+    :return: A list of the names of every file in results.
+    """
+    results = json.loads(results)
+    return (([results['gif']] if results['gif'] else []) + results['frames']
+            + ([results['profile']] if results.get('profile') else []))
+
+def get_results_size(results):
+    """
+    :param results: The JSON output of the manipulation script.
+    :return: The total size in bytes of the files in results.
+    """
+    paths = map(image_storage.get_path, get_results_names(results))
+    return sum(os.path.getsize(path) for path in paths
+        if os.path.exists(path))
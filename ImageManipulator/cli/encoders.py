@@ -0,0 +1,152 @@
+"""
+Encoders for the animation made of the rendered frames. Every encoder is
+given the frames one at a time with put, and finishes the file with close.
+Each has presets that trade encoding time against the size of the file.
+"""
+from PIL import Image
+import images2gif
+
+# The preset used when none is chosen
+DEFAULT_PRESET = 'fast'
+
+class Encoder(object):
+    """
+    Base class of the encoders. Subclasses name the Pillow format they write,
+    the extension of their files and their presets, which are dictionaries of
+    options for the format.
+    """
+    name = None
+    format = None
+    extension = None
+    presets = {}
+
+    def __init__(self, path, size, preset, tracer):
+        """
+        :param path: The path to save the animation to.
+        :param size: The size of the smallest frame, which every frame is
+        cropped to.
+        :param preset: The name of the preset to encode with.
+        :param tracer: The Tracer to time the stages with.
+        """
+        self.path = path
+        self.size = size
+        self.options = self.presets[preset]
+        self.tracer = tracer
+
+    @classmethod
+    def is_available(cls):
+        """ :return: True if the installed Pillow can write the format. """
+        return True
+
+    def put(self, frame, duration=None):
+        """
+        Effect: adds the next Frame, to be shown for duration seconds, or
+        the default duration if None.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Effect: finishes the animation and closes its file. """
+        raise NotImplementedError
+
+class GifEncoder(Encoder):
+    """
+    Writes a gif with the writer of images2gif, one frame at a time as the
+    frames are given to it, without keeping them.
+    """
+    name = 'gif'
+    format = 'GIF'
+    extension = '.gif'
+    presets = {
+        'fast': {'colors': 256, 'dither': False},
+        'small': {'colors': 64, 'dither': False},
+    }
+
+    def __init__(self, path, size, preset, tracer):
+        super(GifEncoder, self).__init__(path, size, preset, tracer)
+        self.file = open(path, 'wb')
+        self.stream = images2gif.GifStream(self.file)
+
+    def put(self, frame, duration=None):
+        with self.tracer.stage('quantize'):
+            image = quantize_gif_frame(
+                frame.crop((0, 0) + self.size).to_image(), self.options)
+        timings = {}
+        self.stream.write(image, timings, duration)
+        for stage, seconds in timings.items():
+            self.tracer.add(stage, seconds)
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.file.close()
+
+class PillowEncoder(Encoder):
+    """
+    Writes an animation with the multi-frame save of Pillow, which encodes in
+    C. Pillow reads every frame before it starts encoding, so the frames are
+    kept until close.
+    """
+    # The duration of each frame in seconds, if none is given
+    duration = 0.1
+
+    def __init__(self, path, size, preset, tracer):
+        super(PillowEncoder, self).__init__(path, size, preset, tracer)
+        self.images = []
+        self.durations = []
+
+    @classmethod
+    def is_available(cls):
+        Image.init()
+        return cls.format in getattr(Image, 'SAVE_ALL', {})
+
+    def put(self, frame, duration=None):
+        self.images.append(frame.crop((0, 0) + self.size).to_image())
+        if duration is None:
+            duration = self.duration
+        self.durations.append(int(round(duration * 1000)))
+
+    def close(self):
+        with self.tracer.stage('encode'):
+            self.images[0].save(self.path, self.format, save_all=True,
+                append_images=self.images[1:], duration=self.durations,
+                loop=0, **self.options)
+        self.images = []
+
+class WebPEncoder(PillowEncoder):
+    """ Writes a lossy animated WebP. """
+    name = 'webp'
+    format = 'WEBP'
+    extension = '.webp'
+    presets = {
+        'fast': {'quality': 80, 'method': 0},
+        'small': {'quality': 70, 'method': 6, 'minimize_size': True},
+    }
+
+ENCODERS = dict((encoder.name, encoder)
+                for encoder in [GifEncoder, WebPEncoder])
+
+# The names of the presets every encoder has
+PRESETS = sorted(GifEncoder.presets)
+
+def get_encoder(name):
+    """
+    :param name: The name of the encoder, one of ENCODERS.
+    :return: The Encoder class.
+    :raises ValueError: If the installed Pillow can not write the format.
+    """
+    encoder = ENCODERS[name]
+    if not encoder.is_available():
+        raise ValueError('The installed Pillow can not write animated {}'
+            .format(encoder.format))
+    return encoder
+
+def quantize_gif_frame(image, options):
+    """
+    :param image: The Image of a rendered frame, cropped to the gif.
+    :param options: The options of a GifEncoder preset.
+    :return: The paletted Image of the frame to write to the gif.
+    """
+    return images2gif.GifWriter().convertImagesToPIL([image],
+        options['dither'], colors=options['colors'])[0]
@@ -0,0 +1,72 @@
+"""
+A frame of the animation, from rendering to encoding, as the pixels in one
+numpy buffer. Cropping a frame gives a view of the same buffer, and numpy
+code (the kernels, images2gif) reads the buffer directly, so pixels are only
+copied when PIL needs an Image of its own.
+"""
+import numpy as np
+from PIL import Image
+
+# The modes a frame can have, all with one byte per channel. The pixels of a
+# P frame are indices into its palette.
+MODES = ['RGB', 'RGBA', 'L', 'P']
+
+class Frame(object):
+    """ The pixels of one frame. """
+    def __init__(self, array, mode, palette=None):
+        """
+        :param array: The pixels, of shape (height, width) for modes L and P
+        and (height, width, channels) otherwise.
+        :param mode: The PIL mode of the pixels.
+        :param palette: The palette of a P frame, as a list of 768 values.
+        """
+        self.array = array
+        self.mode = mode
+        self.palette = palette
+
+    @classmethod
+    def from_image(cls, image):
+        """ :return: A Frame with a copy of the pixels of image. """
+        if image.mode not in MODES:
+            image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        palette = image.getpalette() if image.mode == 'P' else None
+        return cls(np.array(image), image.mode, palette)
+
+    @property
+    def size(self):
+        """ The (width, height) of the frame. """
+        return self.array.shape[1], self.array.shape[0]
+
+    @property
+    def __array_interface__(self):
+        return self.array.__array_interface__
+
+    def crop(self, box):
+        """
+        :param box: A tuple (left, up, right, down).
+        :return: A Frame viewing the box of this frame, sharing its pixels.
+        """
+        left, up, right, down = box
+        return Frame(self.array[up:down, left:right], self.mode,
+                     self.palette)
+
+    def copy(self):
+        """ :return: A Frame with a contiguous copy of the pixels. """
+        return Frame(self.array.copy(), self.mode, self.palette)
+
+    def to_image(self):
+        """
+        :return: An Image of the pixels. PIL shares the buffer where its own
+        layout matches it (modes L, P and RGBA), and copies it otherwise, so the
+        Image must be treated as read only.
+        """
+        array = np.ascontiguousarray(self.array)
+        image = Image.frombuffer(self.mode, self.size, array, 'raw',
+                                 self.mode, 0, 1)
+        if self.palette is not None:
+            image.putpalette(self.palette)
+        return image
+
+    def tobytes(self):
+        """ :return: The pixels as bytes, row by row. """
+        return np.ascontiguousarray(self.array).tobytes()
@@ -1,11 +1,37 @@
 #!/usr/bin/env python
 
-import argparse, sys, os, random, io, json
+import argparse, sys, os, random, io, json, hashlib, cProfile, traceback
+import itertools, signal
+import multiprocessing
+from Queue import Queue, Empty, Full
 from shutil import copyfile
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 import images2gif
+from memo import StageMemo, get_stage_key, get_file_hash
+from storage import FlatStorage, ShardedStorage
+from tracing import Tracer, MAX_EVENTS
+from pipeline import Pipeline
+from frame import Frame, MODES
+from manifest import Manifest, MANIFEST_NAME, get_options_key
+from watching import get_watcher, PollingWatcher, Debouncer
+from saving import FrameSaver, EXTENSION_FORMATS
+import saving
+import kernels, encoders, resizing
 
-IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp']
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff']
+
+# The most seconds --watch waits for files before checking on its jobs
+WATCH_TIMEOUT = 0.5
+
+# The operations whose result depends on the random number generator
+RANDOM_OPERATIONS = ['ninety', 'random']
+
+# Formats that boxes can be swapped through without changing their pixels
+LOSSLESS_FORMATS = ['png', 'bmp']
+
+# The number of quarter turns counter-clockwise of each RotateOption
+ROTATE_TURNS = {None: 0, Image.ROTATE_90: 1, Image.ROTATE_180: 2,
+                Image.ROTATE_270: 3}
 
 class ImageManipulator(object):
     """
@@ -15,37 +41,96 @@ class ImageManipulator(object):
     horizontal or vertical options are selected, then the boxes are done as
     slices across the image, instead of square boxes.
      """
-    def __init__(self, image_path, box_size, args):
+    def __init__(self, image_path, box_size, args, image=None, tracer=None):
         """
         :param image_path: The path to the image file.
         :param box_size: The size of a box. This is used to split the image into
         boxes and manipulate them.
         :param args: The args object containing configuration values.
+        :param image: An already loaded (and resized) Image to manipulate
+        instead of the file at image_path.
+        :param tracer: The Tracer to time stages and count box operations
+        with.
         """
-        self.image = Image.open(image_path)
         self.args = args
-        if args.resize:
-            self.resize()
+        self.tracer = tracer or Tracer()
+        self.frame = None
+        if image is not None:
+            self.image = image
+        else:
+            with self.tracer.stage('decode'):
+                image = Image.open(image_path)
+                size = image.size
+                # only decode as much of the image as the resize keeps
+                if args.resize:
+                    resizing.draft(image,
+                        resizing.get_resized_size(size, args.resize))
+                image.load()
+                self.image = image
+            if args.resize:
+                with self.tracer.stage('resize'):
+                    self.resize(size)
+            with self.tracer.stage('normalize'):
+                self.image = normalize_mode(self.image)
         self.box_size = box_size
         self.boxes, self.new_w, self.new_h = self.get_boxes_and_size(box_size)
-        self.ext = os.path.splitext(image_path)[1][1:]
+        self.ext = os.path.splitext(image_path)[1][1:].lower()
+        self.format = EXTENSION_FORMATS.get(self.ext, self.ext)
+
+    @property
+    def image(self):
+        """
+        The Image being manipulated. After a kernel has changed the Frame, it
+        is made from the Frame when it is next needed.
+        """
+        if self._image is None:
+            self._image = self.frame.to_image()
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.frame = None
+
+    def get_frame(self, writing=False):
+        """
+        :param writing: True if the pixels of the Frame are about to be
+        changed, so the Image must be made from it again.
+        :return: The Frame of the pixels, copied from the Image if an
+        operation on the Image changed them last.
+        """
+        if self.frame is None:
+            self.frame = Frame.from_image(self._image)
+        if writing:
+            self._image = None
+        return self.frame
+
+    def release_frame(self):
+        """
+        Effect: makes the Image the only copy of the pixels, so they can be
+        changed in place by PIL.
+        """
+        if self.frame is not None:
+            image = self.image
+            self.image = image.copy() if image.readonly else image
+
+    def get_pixels(self):
+        """ :return: The Frame if it is current, otherwise the Image. """
+        return self.frame if self.frame is not None else self._image
 
-    def resize(self):
+    def resize(self, size=None):
         """
         Resizes the image according to the arguments provided. If either the
         width or height provided is zero, the other dimension is caluclated
         from the dimension provided.
-        """
-        cur_width, cur_height = self.image.size
-        width, height = args.resize
 
-        if width == 0 and height != 0:
-            width = int((float(cur_width) / float(cur_height)) * height)
-        elif width != 0 and height == 0:
-            height = int((float(cur_height) / float(cur_width)) * width)
-
-        self.image = self.image.resize((width, height))
-        self.log('Resized image to ({}, {})'.format(width, height))
+        :param size: The full size of the image, if it was decoded at a
+        reduced resolution.
+        """
+        width, height = resizing.get_resized_size(size or self.image.size,
+            self.args.resize)
+        self.image = resizing.resize(self.image, (width, height))
+        self.tracer.event('resize', [width, height])
 
     def get_boxes_and_size(self, box_size):
         """
@@ -62,9 +147,9 @@ class ImageManipulator(object):
         if box_size == 0:
             w, h = self.image.size
             return [(0, 0, w, h)], w, h
-        if args.vertical:
+        if self.args.vertical:
             return self.get_vertical_boxes_and_size(box_size)
-        elif args.horizontal:
+        elif self.args.horizontal:
             return self.get_horizontal_boxes_and_size(box_size)
         else:
             return self.get_square_boxes_and_size(box_size)
@@ -144,13 +229,26 @@ class ImageManipulator(object):
 
         n_options = len(rotate_options)
 
+        # every option is drawn in box order before any box is rotated, so
+        # the kernels rotate the same boxes however they split the image
         if n_options == 1:
-            for box in self.boxes:
-                self.rotate_box(box, rotate_options[0])
+            options = [rotate_options[0] for box in self.boxes]
+        else:
+            options = [rotate_options[random.randint(0, n_options - 1)]
+                       for box in self.boxes]
+
+        turns = [ROTATE_TURNS[option] for option in options]
+        grid = self.get_grid() if self.use_kernels(MODES) else None
+        if (grid is not None
+            and (grid.block_w == grid.block_h
+                 or all(n_turns % 2 == 0 for n_turns in turns))):
+            kernels.rotate(self.get_frame(writing=True), grid, turns,
+                self.args.threads)
+            self.tracer.count('rotate_box', len(turns) - turns.count(0))
         else:
-            for box in self.boxes:
-                rotate_option = rotate_options[random.randint(0, n_options - 1)]
-                self.rotate_box(box, rotate_option)
+            self.release_frame()
+            for box, option in zip(self.boxes, options):
+                self.rotate_box(box, option)
 
     def rotate_box(self, box, rotate_option):
         """
@@ -163,45 +261,56 @@ class ImageManipulator(object):
             region = self.image.crop(box)
             region = region.transpose(rotate_option)
             self.image.paste(region, box)
-            self.log("Rotated box {}".format(box))
+            self.tracer.event('rotate_box', box)
 
     def randomize_sections(self):
         """
         Cuts the image into sections of side length box_size and randomly
         switches pairs of sections.
         """
-        boxes = list(self.boxes)
-        random.shuffle(boxes)
-
-        pairs = []
-        for i in range(0, len(boxes), 2):
-            try: pairs.append((boxes[i], boxes[i + 1]))
-            except IndexError: pass
+        order = range(len(self.boxes))
+        random.shuffle(order)
+        pairs = [(order[i], order[i + 1]) for i in range(0, len(order) - 1, 2)]
 
-        for first_box, second_box in pairs:
-            self.swap_boxes(first_box, second_box, self.ext)
+        # the kernels move pixels as they are, which is only what swapping
+        # through the image format does if the format is lossless
+        if (self.use_kernels(MODES)
+            and self.format in LOSSLESS_FORMATS):
+            sources = range(len(self.boxes))
+            for first, second in pairs:
+                sources[first], sources[second] = second, first
+            kernels.permute(self.get_frame(writing=True), self.get_grid(),
+                sources, self.args.threads)
+            self.tracer.count('swap_boxes', len(pairs))
+        else:
+            self.release_frame()
+            for first, second in pairs:
+                self.swap_boxes(self.boxes[first], self.boxes[second],
+                    self.format)
 
-    def swap_boxes(self, first_box, second_box, ext):
+    def swap_boxes(self, first_box, second_box, image_format):
         """
         Swaps the two boxes on the image.
 
         :param first_box: The first box to swap.
         :param second_box: The other box to swap with the first.
-        :param ext: The extension of the image file, needed to save the images
-        bytes.
+        :param image_format: The format of the image file, needed to save
+        the images bytes.
         """
         first_region_bytes = io.BytesIO()
-        self.image.crop(first_box).save(first_region_bytes, format=ext)
+        self.image.crop(first_box).save(first_region_bytes,
+            format=image_format)
         first_region = Image.open(first_region_bytes)
 
         second_region_bytes = io.BytesIO()
-        self.image.crop(second_box).save(second_region_bytes, format=ext)
+        self.image.crop(second_box).save(second_region_bytes,
+            format=image_format)
         second_region = Image.open(second_region_bytes)
 
         self.image.paste(first_region, second_box)
         self.image.paste(second_region, first_box)
 
-        self.log("Swapped boxes {}".format((first_box, second_box)))
+        self.tracer.event('swap_boxes', [first_box, second_box])
 
     def average_sections(self):
         """
@@ -211,40 +320,71 @@ class ImageManipulator(object):
             and not (self.args.vertical or self.args.horizontal)):
             return
 
+        # the indices of a palette can not be averaged
+        if self.get_pixels().mode == 'P':
+            self.image = self.image.convert('RGB')
+
+        if self.use_kernels(kernels.AVERAGE_MODES):
+            kernels.average(self.get_frame(writing=True), self.get_grid(),
+                self.args.threads)
+            self.tracer.count('average_box', len(self.boxes))
+            return
+
+        self.release_frame()
         for box in self.boxes:
             self.average_box(box)
-            self.log("Averaged box {}".format(box))
+            self.tracer.event('average_box', box)
 
     def average_box(self, box):
         """
-        Averages one box.
+        Averages one box. The colors of RGBA pixels are weighted by their
+        alpha, so fully transparent pixels do not darken the box.
 
         :param box: The box to average.
         """
         region = self.image.crop(box)
         w, h = region.size
-        pixels = region.load()
+        n = w * h
 
-        rs, gs, bs = [], [], []
-        for x in range(w):
-            for y in range(h):
-                pixel = pixels[x, y]
-                rs.append(pixel[0])
-                gs.append(pixel[1])
-                bs.append(pixel[2])
+        if region.mode == 'RGBA':
+            alphas = region.split()[3].getdata()
+            alpha_sum = sum(alphas)
+            color_sums = [sum(c * a for c, a in zip(band.getdata(), alphas))
+                          for band in region.split()[:3]]
+            fill = tuple([c / max(alpha_sum, 1) for c in color_sums]
+                         + [alpha_sum / n])
+        else:
+            sums = [int(total) for total in ImageStat.Stat(region).sum]
+            fill = tuple(total / n for total in sums)
+            if region.mode == 'L':
+                fill = fill[0]
+
+        self.image.paste(fill, box)
 
-        r = sum(rs) / len(rs)
-        g = sum(gs) / len(gs)
-        b = sum(bs) / len(bs)
+    def use_kernels(self, modes):
+        """
+        :param modes: The modes of Image the kernel works on.
+        :return: True if the operation should run on the threaded kernels.
+        """
+        return (self.args.threads > 0 and self.box_size > 0
+                and self.get_pixels().mode in modes)
 
-        self.image.paste(Image.new('RGB', (w, h), (r, g, b)), box)
+    def get_grid(self):
+        """ :return: The kernels.Grid of the boxes. """
+        return kernels.Grid(self.get_pixels().size, self.box_size,
+            self.args.vertical, self.args.horizontal)
 
     def crop_image(self):
         """
         Effect: crops the image to the new dimenstions returned when calculating
         the boxes.
         """
-        self.image = self.image.crop((0, 0, self.new_w, self.new_h))
+        box = (0, 0, self.new_w, self.new_h)
+        if self.frame is not None:
+            self.frame = self.frame.crop(box)
+            self._image = None
+        else:
+            self.image = self.image.crop(box)
 
     def copy(self):
         """ :return: A copy of the current Image. """
@@ -262,69 +402,783 @@ class ImageManipulator(object):
         """ Effect: closes the Image. """
         self.image.close()
 
-    def log(self, message):
-        """
-        Simply prints message to STDOUT if debugging is enabled.
-
-        :param message: The message to be logged.
-        """
-        if self.args.debug:
-            print message
-
 def manipulate_image(image_path, args):
     """
-    Performs all image operations on the given image file
+    Performs all image operations on the given image file. The file itself
+    is only ever read.
 
     :param image_path: path to the image file to edit
+    :return: The dictionary of results, with the names of the animation
+    under 'gif' and of the frames under 'frames', and the timings.
     """
-    full_name, _ = os.path.splitext(image_path)
     base_name, ext = os.path.splitext(os.path.basename(image_path))
-    if ext.lower() == '.jpg':
-        os.rename(full_name + ext, full_name + '.jpeg')
-        ext = '.jpeg'
+    if args.name:
+        base_name = args.name
+    storage = get_output_storage(args, os.path.dirname(image_path))
+
+    # never save the animation over the image, when it is in the same format
+    # and saved next to it
+    animation_path = storage.get_path(
+        base_name + encoders.get_encoder(args.format).extension)
+    if os.path.abspath(animation_path) == os.path.abspath(image_path):
+        base_name += '-manipulated'
+
+    tracer = Tracer(args.trace_sample or (1 if args.debug else 0))
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    memo = get_memo(args)
+    if is_animated(image_path):
+        animation_path, frame_paths = manipulate_animation(image_path,
+            base_name, ext, storage, args, memo, tracer)
+    else:
+        animation_path, frame_paths = manipulate_still(image_path,
+            base_name, ext, storage, args, memo, tracer)
+
+    if memo is not None:
+        with tracer.stage('memo'):
+            memo.close()
+
+    # the animation is under 'gif' whatever its format
+    image_paths = {'gif': animation_path, 'frames': frame_paths}
+    image_paths.update(tracer.report())
+    if memo is not None:
+        image_paths['memo'] = {'hits': memo.hits, 'misses': memo.misses}
+    if profiler is not None:
+        profiler.disable()
+        profile_path = base_name + '.prof'
+        profiler.dump_stats(storage.get_save_path(profile_path))
+        image_paths['profile'] = profile_path
+    if args.debug:
+        print >>sys.stderr, json.dumps(tracer.report(), indent=2)
+    return image_paths
+
+def manipulate_directory(args):
+    """
+    Performs all image operations on every image file under args.directory,
+    printing the results of each. Images that the manifest in the output
+    directory records as unchanged since they were rendered with the same
+    options are skipped, as are the results of earlier runs.
+
+    :param args: The args object used for configuration.
+    """
+    manifest = open_manifest(args)
+    options = get_options_key(args)
+
+    try:
+        # listed up front, so results saved under the directory are not read
+        for image_path in list(find_images(args.directory)):
+            if is_rendered(manifest, image_path, options):
+                if args.debug:
+                    print >>sys.stderr, 'Skipping', image_path
+                continue
+            image_paths = manipulate_image(image_path, args)
+            print json.dumps(image_paths)
+            sys.stdout.flush()
+            record_results(manifest, image_path, options, image_paths, args)
+    finally:
+        manifest.close()
 
+def watch_directory(args):
+    """
+    Watches args.directory, and performs all image operations on every image
+    file written to it on a pool of worker processes. The results of each
+    image, or the error it failed with, are printed as a line of JSON with
+    its path. The images already in the directory are rendered first, and
+    every image is recorded in the manifest once it is done, so a watch that
+    is restarted carries on where it stopped. Runs until interrupted.
+
+    :param args: The args object used for configuration.
+    """
+    manifest = open_manifest(args)
+    options = get_options_key(args)
+    watcher = get_watcher(args.directory, args.watch_interval)
+    debouncer = Debouncer(args.watch_debounce)
+    if isinstance(watcher, PollingWatcher):
+        # a file still being written may not change between two walks
+        debouncer.delay = max(debouncer.delay, watcher.interval)
+    for image_path in find_images(args.directory):
+        debouncer.add(image_path)
+
+    # the workers are daemons, which can not start the process of a
+    # GifPipeline
+    args.pipeline = False
+    pool = multiprocessing.Pool(args.watch_workers or None, ignore_interrupts)
+    finished = Queue()
+    running = {}
+    try:
+        while True:
+            for path in watcher.read(WATCH_TIMEOUT):
+                debouncer.add(path)
+
+            for image_path in debouncer.pop_ready():
+                _, ext = os.path.splitext(image_path)
+                if (ext.lower() not in IMAGE_EXTENSIONS
+                    or not os.path.isfile(image_path)):
+                    continue
+                # the results of a running job are only recorded once it is
+                # done, and the image may be written again meanwhile
+                if (image_path in running
+                    or any(is_result_of(image_path, other, args)
+                           for other in running)):
+                    debouncer.add(image_path)
+                    continue
+                if is_rendered(manifest, image_path, options):
+                    continue
+                running[image_path] = pool.apply_async(
+                    render_watched_image, (image_path, args),
+                    callback=finished.put)
+
+            while True:
+                try:
+                    image_paths = finished.get_nowait()
+                except Empty:
+                    break
+                image_path = image_paths['path']
+                del running[image_path]
+                if 'error' not in image_paths:
+                    record_results(manifest, image_path, options,
+                        image_paths, args)
+                print json.dumps(image_paths)
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+        watcher.close()
+        manifest.close()
+
+def ignore_interrupts():
+    """ Leaves interrupting the workers of --watch to the main process. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def render_watched_image(image_path, args):
+    """
+    Runs in a worker process of watch_directory.
+
+    :param image_path: The path of the image to render.
+    :param args: The args object used for configuration.
+    :return: The results returned by manipulate_image, or the formatted
+    traceback under 'error' if it failed, with the path under 'path'.
+    """
+    try:
+        image_paths = manipulate_image(image_path, args)
+    except Exception:
+        image_paths = {'error': traceback.format_exc()}
+    image_paths['path'] = image_path
+    return image_paths
+
+def is_result_of(path, image_path, args):
+    """
+    :param path: The path of a file.
+    :param image_path: The path of an image.
+    :param args: The args object used for configuration.
+    :return: True if the file could be one of the results of the image.
+    """
+    base_name, _ = os.path.splitext(os.path.basename(image_path))
+    root = get_output_storage(args, os.path.dirname(image_path)).root
+    return (os.path.basename(path).startswith(args.name or base_name)
+            and os.path.abspath(path).startswith(
+                os.path.abspath(root) + os.sep))
+
+def open_manifest(args):
+    """
+    :param args: The args object used for configuration.
+    :return: The Manifest of args.directory, kept in the output directory.
+    """
     if args.output and os.path.exists(args.output):
-        output = os.path.abspath(args.output)
+        output = args.output
     else:
-        output = os.path.dirname(full_name + ext)
+        output = args.directory
+    return Manifest(os.path.join(output, MANIFEST_NAME), args.directory)
 
-    box_sizes = get_box_sizes(args.box_size, args.iterations, full_name + ext, args)
+def is_rendered(manifest, image_path, options):
+    """
+    :param manifest: The Manifest of the directory.
+    :param image_path: The path of an image in the directory.
+    :param options: The options key from get_options_key.
+    :return: True if the image has not changed since it was rendered with
+    the options, or is itself one of the results.
+    """
+    return (manifest.is_output(image_path)
+            or manifest.lookup(image_path, options) is not None)
+
+def record_results(manifest, image_path, options, image_paths, args):
+    """
+    Effect: records the results of an image in the manifest.
+
+    :param manifest: The Manifest of the directory.
+    :param image_path: The path of the image.
+    :param options: The options key from get_options_key.
+    :param image_paths: The results returned by manipulate_image.
+    :param args: The args object used for configuration.
+    """
+    storage = get_output_storage(args, os.path.dirname(image_path))
+    results = {'gif': image_paths['gif'], 'frames': image_paths['frames']}
+    outputs = [storage.get_path(name)
+               for name in [results['gif']] + results['frames'] if name]
+    manifest.add(image_path, options, results, outputs)
+
+def find_images(directory):
+    """
+    :param directory: The directory to search, recursively.
+    :return: A generator of the paths of the image files in directory, in
+    order.
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in sorted(filenames):
+            _, ext = os.path.splitext(name)
+            if ext.lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(dirpath, name)
+
+def manipulate_still(image_path, base_name, ext, storage, args, memo,
+                     tracer):
+    """
+    Renders a frame of the image for each box size, and saves the frames
+    and the animation looping through them and back.
+
+    :param image_path: The path to the image file.
+    :param base_name: The name to save the animation and frames under.
+    :param ext: The extension to save the frames with.
+    :param storage: The storage to save the animation and frames in.
+    :param args: The args object used for configuration.
+    :param memo: The StageMemo or None.
+    :param tracer: The Tracer to time the stages with.
+    :return: A tuple (animation_path, frame_paths) of the saved files.
+    """
+    base, base_key = load_base_image(image_path, args, memo, tracer)
+
+    box_sizes = get_box_sizes(args.box_size, args.iterations, image_path,
+        args, base.size)
+    encoder = encoders.get_encoder(args.format)
+    write_animation = not (args.nogif or len(box_sizes) == 1)
+    animation_path = (base_name + encoder.extension if write_animation
+                      else '')
+
+    # quantize and encode each frame while the next one is rendered
+    pipeline = None
+    if write_animation and args.pipeline and encoder is encoders.GifEncoder:
+        pipeline = GifPipeline(storage.get_save_path(animation_path),
+            get_min_frame_size(base.size, box_sizes, args),
+            args.pipeline_depth, tracer, encoder.presets[args.preset])
+
+    # compress the saved frames while the next ones are rendered
+    saver = FrameSaver(args.save_threads, args.save_preset, tracer)
     frames, frame_paths = [], []
+    try:
+        for box_size in box_sizes:
+            im = render_frame(image_path, base, base_key, box_size, args,
+                memo, tracer)
+            with tracer.stage('crop'):
+                im.crop_image()
+            if args.frames or len(box_sizes) == 1:
+                filename = '{}-{:04d}{}'.format(base_name, box_size, ext)
+                saver.save(im.image, storage.get_save_path(filename))
+                frame_paths.append(filename)
+            # only a view of the rendered pixels is passed on, as a Frame
+            if pipeline is not None:
+                pipeline.put(im.get_frame())
+            else:
+                frames.append(im.get_frame())
+    finally:
+        saver.close()
+
+    if pipeline is not None:
+        pipeline.close()
+    elif write_animation:
+        # Crop all frames to size of smallest frame
+        min_w = min(map(lambda frame: frame.size[0], frames))
+        min_h = min(map(lambda frame: frame.size[1], frames))
+        frames = map(lambda frame: frame.crop((0, 0, min_w, min_h)), frames)
+
+        # Loop the animation and save it
+        middle_frames = frames[1:-1]
+        middle_frames.reverse()
+        if encoder is encoders.GifEncoder:
+            timings = {}
+            frames, palette = match_frame_modes(frames + middle_frames)
+            images2gif.writeGif(storage.get_save_path(animation_path),
+                frames, timings=timings, palette=palette,
+                **encoder.presets[args.preset])
+            for stage, seconds in timings.items():
+                tracer.add(stage, seconds)
+        else:
+            writer = encoder(storage.get_save_path(animation_path),
+                (min_w, min_h), args.preset, tracer)
+            for frame in frames + middle_frames:
+                writer.put(frame)
+            writer.close()
+    return animation_path, frame_paths
+
+def manipulate_animation(image_path, base_name, ext, storage, args, memo,
+                         tracer):
+    """
+    Renders each frame of an animated image with the next box size, cycling
+    through the box sizes, and saves the animation of the rendered frames
+    with the durations of the frames they were rendered from. The frames
+    are read, rendered and written one at a time, so with a gif only one
+    is held in memory however long the animation is.
+
+    :param image_path: The path to the animated image file.
+    :param base_name: The name to save the animation and frames under.
+    :param ext: The extension to save the frames with.
+    :param storage: The storage to save the animation and frames in.
+    :param args: The args object used for configuration.
+    :param memo: The StageMemo or None.
+    :param tracer: The Tracer to time the stages with.
+    :return: A tuple (animation_path, frame_paths) of the saved files.
+    """
+    source = read_frames(image_path, args, tracer)
+    first = next(source)
+    source = itertools.chain([first], source)
+    size = first[0].size
+
+    box_sizes = get_box_sizes(args.box_size, args.iterations, image_path,
+        args, size)
+    encoder = encoders.get_encoder(args.format)
+    write_animation = not args.nogif
+    animation_path = (base_name + encoder.extension if write_animation
+                      else '')
+    animation_size = get_min_frame_size(size, box_sizes, args)
+
+    source_key = None
+    if memo is not None:
+        with tracer.stage('memo'):
+            source_hash = args.source_hash or get_file_hash(image_path)
+            memo.mark_source(source_hash)
+            source_key = [source_hash, args.resize or None]
+
+    writer = None
+    if write_animation and args.pipeline and encoder is encoders.GifEncoder:
+        writer = GifPipeline(storage.get_save_path(animation_path),
+            animation_size, args.pipeline_depth, tracer,
+            encoder.presets[args.preset], loop=False)
+    elif write_animation:
+        writer = encoder(storage.get_save_path(animation_path),
+            animation_size, args.preset, tracer)
+
+    saver = FrameSaver(args.save_threads, args.save_preset, tracer)
+    frame_paths = []
+    try:
+        for index, (base, duration) in enumerate(source):
+            box_size = box_sizes[index % len(box_sizes)]
+            base_key = source_key and source_key + ['frame', index]
+            im = render_frame(image_path, base, base_key, box_size, args,
+                memo, tracer)
+            with tracer.stage('crop'):
+                im.crop_image()
+            if args.frames or not write_animation:
+                filename = '{}-{:04d}-{:04d}{}'.format(base_name, index,
+                    box_size, ext)
+                saver.save(im.image, storage.get_save_path(filename))
+                frame_paths.append(filename)
+            if writer is not None:
+                writer.put(im.get_frame(), duration)
+    finally:
+        try:
+            saver.close()
+        finally:
+            if writer is not None:
+                writer.close()
+    return animation_path, frame_paths
+
+def is_animated(image_path):
+    """
+    :param image_path: The path to the image file.
+    :return: True if the image has more than one frame.
+    """
+    image = Image.open(image_path)
+    try:
+        return getattr(image, 'n_frames', 1) > 1
+    finally:
+        image.close()
+
+def read_frames(image_path, args, tracer):
+    """
+    Decodes and, if requested, resizes the frames of an animated image one
+    at a time.
+
+    :param image_path: The path to the animated image file.
+    :param args: The args object used for configuration.
+    :param tracer: The Tracer to time the stages with.
+    :return: A generator of tuples (image, duration); where image is the
+    Image of the frame and duration is the seconds it is shown for.
+    """
+    frames = images2gif.iterFrames(image_path)
+    while True:
+        with tracer.stage('decode'):
+            try:
+                image, duration = next(frames)
+            except StopIteration:
+                return
+        if args.resize:
+            im = ImageManipulator(image_path, 0, args, image=image,
+                tracer=tracer)
+            with tracer.stage('resize'):
+                im.resize()
+            image = im.image
+        with tracer.stage('normalize'):
+            image = normalize_mode(image)
+        yield image, duration
+
+class GifPipeline(object):
+    """
+    Writes the looping gif of the frames given to it while the next frames
+    are rendered. The frames are quantized and encoded by a process of its
+    own, so the work is not serialized with rendering by the interpreter
+    lock, and the queue to it is bounded, so rendering waits for the encoder
+    instead of piling up frames in memory.
+    """
+    def __init__(self, path, size, depth, tracer, options, loop=True):
+        """
+        :param path: The path to save the gif to.
+        :param size: The size of the smallest frame, which every frame is
+        cropped to.
+        :param depth: The number of frames waiting for each stage before
+        rendering blocks.
+        :param tracer: The Tracer to add the timings of the encoder to.
+        :param options: The options of the GifEncoder preset to quantize
+        the frames with.
+        :param loop: True to loop the gif back through the frames in reverse
+        after the last one.
+        """
+        self.tracer = tracer
+        self.frames = multiprocessing.Queue(depth)
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=write_gif_frames,
+            args=(path, size, depth, options, loop, self.frames,
+                  self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def put(self, frame, duration=None):
+        """
+        Effect: queues the next Frame, once there is room for it, to be
+        shown for duration seconds, or the default duration if None.
+        """
+        self.send((frame.mode, frame.size, frame.tobytes(), frame.palette,
+                   duration))
+
+    def close(self):
+        """ Effect: waits for every frame to be written and ends the gif. """
+        # an encoder that already exited reads no more frames
+        if self.process.is_alive():
+            self.send(None)
+        while True:
+            try:
+                error, timings = self.results.get(timeout=0.1)
+                break
+            except Empty:
+                if not self.process.is_alive():
+                    self.raise_exited()
+        self.process.join()
+        for stage, seconds in timings.items():
+            self.tracer.add(stage, seconds)
+        if error is not None:
+            raise RuntimeError('The gif encoder failed:\n' + error)
+
+    def send(self, item):
+        while True:
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except Full:
+                if not self.process.is_alive():
+                    self.raise_exited()
+
+    def raise_exited(self):
+        """
+        :raises RuntimeError: With the traceback of the encoder process,
+        which has exited before the gif was done, if it sent one.
+        """
+        try:
+            error, _ = self.results.get(timeout=0.1)
+        except Empty:
+            error = None
+        if error is not None:
+            raise RuntimeError('The gif encoder failed:\n' + error)
+        raise RuntimeError('The gif encoder exited with {}'.format(
+            self.process.exitcode))
+
+def write_gif_frames(path, size, depth, options, loop, frames, results):
+    """
+    Runs in the encoder process of a GifPipeline. Quantizes and encodes the
+    frames read from frames as they arrive, on a Pipeline of two stages, then
+    if looping writes them again in reverse to loop back to the start. Only
+    the quantized frames are kept for that.
+
+    :param path: The path to save the gif to.
+    :param size: The size every frame is cropped to.
+    :param depth: The number of frames waiting for each stage.
+    :param options: The options of the GifEncoder preset.
+    :param loop: True to loop back through the frames in reverse.
+    :param frames: The queue of frames, as (mode, size, bytes, palette,
+    duration), ending with None.
+    :param results: The queue to put a tuple (error, timings) on when done;
+    where error is the formatted traceback, or None.
+    """
+    tracer = Tracer()
+    written = []
+
+    def quantize(item):
+        mode, frame_size, data, palette, duration = item
+        with tracer.stage('quantize'):
+            image = Image.frombytes(mode, frame_size, data)
+            if palette is not None:
+                image.putpalette(palette)
+            return encoders.quantize_gif_frame(image.crop((0, 0) + size),
+                options), duration
+
+    def encode(item):
+        frame, duration = item
+        timings = {}
+        stream.write(frame, timings, duration)
+        for stage, seconds in timings.items():
+            tracer.add(stage, seconds)
+        if loop:
+            written.append(item)
+
+    try:
+        with open(path, 'wb') as f:
+            stream = images2gif.GifStream(f)
+            pipeline = Pipeline([quantize, encode], depth)
+            for item in iter(frames.get, None):
+                pipeline.put(item)
+            pipeline.close()
+            for item in reversed(written[1:-1]):
+                encode(item)
+            stream.close()
+        results.put((None, tracer.summary()))
+    except Exception:
+        results.put((traceback.format_exc(), tracer.summary()))
+
+def match_frame_modes(frames):
+    """
+    :param frames: The Frames of an animation.
+    :return: A tuple (frames, palette) of the frames in one mode, and the
+    palette their pixels index if that mode is P, otherwise None. Frames
+    that do not all share a mode and palette are converted to RGB.
+    """
+    first = frames[0]
+    if all(frame.mode == first.mode and frame.palette == first.palette
+           for frame in frames):
+        return frames, first.palette
+    return [Frame.from_image(frame.to_image().convert('RGB'))
+            for frame in frames], None
+
+def get_min_frame_size(size, box_sizes, args):
+    """
+    :param size: The size of the image the frames are rendered from.
+    :param box_sizes: The box size of each frame.
+    :param args: The args object used for configuration.
+    :return: The size of the smallest frame once cropped to its boxes, which
+    is the size of the gif.
+    """
+    w, h = size
     for box_size in box_sizes:
-        im = ImageManipulator(full_name + ext, box_size, args)
-        rotate_options = get_rotate_options(args)
-        if len(rotate_options) != 0:
-            im.rotate_sections(rotate_options)
-        if args.average:
-            im.average_sections()
-        if args.random:
-            im.randomize_sections()
-        im.crop_image()
-        if args.frames or len(box_sizes) == 1:
-            filename = '{}-{:04d}{}'.format(base_name, box_size, ext)
-            im.save(os.path.join(output, filename))
-            frame_paths.append(filename)
-        frames.append(im.copy())
-
-    # Crop all frames to size of smallest frame
-    min_w = min(map(lambda frame: frame.size[0], frames))
-    min_h = min(map(lambda frame: frame.size[1], frames))
-    frames = map(lambda frame: frame.crop((0, 0, min_w, min_h)), frames)
-
-    # Loop the animation and save it
-    middle_frames = frames[1:-1]
-    middle_frames.reverse()
-    if not (args.nogif or len(box_sizes) == 1):
-        gif_path = base_name + ".gif"
-        images2gif.writeGif(os.path.join(output, gif_path),
-            frames + middle_frames)
+        if box_size == 0:
+            continue
+        if not args.horizontal:
+            w = min(w, box_size * (size[0] / box_size))
+        if not args.vertical:
+            h = min(h, box_size * (size[1] / box_size))
+    return w, h
+
+def get_output_storage(args, default_dir):
+    """
+    :param args: The args object used for configuration.
+    :param default_dir: The directory to save results in if no output
+    directory is given.
+    :return: The storage to save the gif and frames in.
+    """
+    if args.output and os.path.exists(args.output):
+        output = os.path.abspath(args.output)
     else:
-        gif_path =  ''
+        output = default_dir
+
+    if args.shard:
+        return ShardedStorage(output, args.shard_levels)
+    return FlatStorage(output)
+
+def get_memo(args):
+    """
+    :param args: The args object used for configuration.
+    :return: A StageMemo if memoization is enabled by the arguments, or None.
+    """
+    if not args.memo:
+        return None
+    return StageMemo(args.memo_size * 1024 * 1024, args.memo,
+        args.memo_spill_size * 1024 * 1024)
+
+def load_base_image(image_path, args, memo, tracer):
+    """
+    Decodes and, if requested, resizes the image that every frame is rendered
+    from.
+
+    :param image_path: The path to the image.
+    :param args: The args object used for configuration.
+    :param memo: The StageMemo or None.
+    :param tracer: The Tracer to time the stages with.
+    :return: A tuple (image, key); where image is the loaded Image and key is
+    the memo prefix identifying it, or None if memoization is disabled.
+    """
+    if memo is None:
+        im = ImageManipulator(image_path, 0, args, tracer=tracer)
+        return im.image, None
+
+    with tracer.stage('memo'):
+        source_hash = args.source_hash or get_file_hash(image_path)
+        memo.mark_source(source_hash)
+        key = [source_hash, args.resize or None]
+        image = memo.get(get_stage_key(key))
+    if image is None:
+        image = ImageManipulator(image_path, 0, args, tracer=tracer).image
+        with tracer.stage('memo'):
+            memo.put(get_stage_key(key), image)
+    return image, key
+
+def normalize_mode(image):
+    """
+    Converts an image to the mode its frames are rendered in, with as few
+    channels as its pixels need: L for grayscale images, including RGB ones
+    whose channels are all equal, RGB for opaque images, RGBA for images
+    with transparency, and P for paletted images without transparency, whose
+    boxes are rotated and swapped as indices.
+
+    :param image: The loaded Image.
+    :return: The Image in its normalized mode, which may be image itself.
+    """
+    mode = image.mode
+    if mode == 'P' and 'transparency' in image.info:
+        mode = 'RGBA'
+    elif mode in ['1', 'I', 'F'] or mode.startswith('I;'):
+        mode = 'L'
+    elif mode in ['LA', 'PA', 'RGBa']:
+        mode = 'RGBA'
+    elif mode not in ['L', 'P', 'RGB', 'RGBA']:
+        mode = 'RGB'
+    if mode != image.mode:
+        image = image.convert(mode)
+
+    if image.mode == 'RGBA' and image.getextrema()[3][0] == 255:
+        image = image.convert('RGB')
+    if image.mode == 'RGB':
+        r, g, b = image.split()
+        if (ImageChops.difference(r, g).getbbox() is None
+            and ImageChops.difference(g, b).getbbox() is None):
+            image = image.convert('L')
+    return image
 
-    image_paths = {'gif': gif_path, 'frames': frame_paths}
-    print json.dumps(image_paths)
+def get_operations(args):
+    """
+    Lists the operations applied to each frame, in the order they are applied.
 
-def get_box_sizes(initial_box_size, iterations, image_path, args):
+    :param args: The args object used for configuration.
+    :return: A list of operation names, each one of 'flip', 'ninety',
+    'average' or 'random'.
+    """
+    operations = []
+    if args.flip:
+        operations.append('flip')
+    elif args.ninety:
+        operations.append('ninety')
+    if args.average:
+        operations.append('average')
+    if args.random:
+        operations.append('random')
+    return operations
+
+def apply_operation(im, operation):
+    """
+    Applies one operation to the ImageManipulator im.
+
+    :param im: The ImageManipulator.
+    :param operation: The name of the operation, see get_operations.
+    """
+    if operation in ['flip', 'ninety']:
+        im.rotate_sections(get_rotate_options(im.args))
+    elif operation == 'average':
+        im.average_sections()
+    elif operation == 'random':
+        im.randomize_sections()
+
+def seed_operation(args, box_size, operation):
+    """
+    Effect: seeds the random number generator for one operation on one frame.
+    Seeding every operation separately makes its result independent of which
+    operations before it were computed and which came from the memo.
+
+    :param args: The args object used for configuration.
+    :param box_size: The box size of the frame.
+    :param operation: The name of the operation.
+    """
+    if args.seed is not None:
+        seed = '{}-{}-{}'.format(args.seed, box_size, operation)
+        random.seed(int(hashlib.sha1(seed).hexdigest()[:8], 16))
+
+def render_frame(image_path, base, base_key, box_size, args, memo, tracer):
+    """
+    Renders one frame by applying all operations to a copy of the base image.
+    With a memo, the longest memoized prefix of the operations is looked up
+    and only the operations after it are computed.
+
+    :param image_path: The path to the image.
+    :param base: The loaded base Image.
+    :param base_key: The memo prefix of the base Image.
+    :param box_size: The box size of the frame.
+    :param args: The args object used for configuration.
+    :param memo: The StageMemo or None.
+    :param tracer: The Tracer to time the stages with.
+    :return: The ImageManipulator holding the uncropped frame.
+    """
+    operations = get_operations(args)
+
+    # the key of each stage, None once a nondeterministic operation without a
+    # seed has been applied. Only those operations are keyed by the seed, so
+    # the stages of the others are shared whatever the seed
+    keys = []
+    if memo is not None:
+        shape = ('vertical' if args.vertical
+                 else 'horizontal' if args.horizontal else 'square')
+        prefix = base_key + [shape, box_size]
+        for operation in operations:
+            random_operation = operation in RANDOM_OPERATIONS
+            if prefix is None or (random_operation and args.seed is None):
+                prefix = None
+            else:
+                prefix = prefix + [[operation,
+                    args.seed if random_operation else None]]
+            keys.append(prefix and get_stage_key(prefix))
+    else:
+        keys = [None for operation in operations]
+
+    image, start = None, 0
+    with tracer.stage('memo'):
+        for i in reversed(range(len(operations))):
+            if keys[i] is not None:
+                image = memo.get(keys[i])
+                if image is not None:
+                    start = i + 1
+                    break
+    if image is None:
+        with tracer.stage('copy'):
+            image = base.copy()
+
+    im = ImageManipulator(image_path, box_size, args, image=image,
+        tracer=tracer)
+    for operation, key in zip(operations, keys)[start:]:
+        seed_operation(args, box_size, operation)
+        with tracer.stage(operation):
+            apply_operation(im, operation)
+        if key is not None:
+            with tracer.stage('memo'):
+                memo.put(key, im.image)
+    return im
+
+def get_box_sizes(initial_box_size, iterations, image_path, args, size=None):
     """
     Creates a list of integers, where each integer is the box size for the
     manipulations of the image for that frame. This is done by taking a starting
@@ -336,6 +1190,7 @@ def get_box_sizes(initial_box_size, iterations, image_path, args):
     :param iterations: The number of iterations.
     :param image_path: The path to the image.
     :param args: The args object used for configuration.
+    :param size: The size of the image after resizing, if already known.
 
     :return: A list of integers.
     """
@@ -344,9 +1199,10 @@ def get_box_sizes(initial_box_size, iterations, image_path, args):
     box_sizes = []
     box_size = 1 if args.auto else initial_box_size
     if args.auto:
-        image = Image.open(image_path)
-        size = image.size
-        image.close()
+        if size is None:
+            image = Image.open(image_path)
+            size = image.size
+            image.close()
 
         if args.vertical: max_size = size[0]
         elif args.horizontal: max_size = size[1]
@@ -411,18 +1267,81 @@ if __name__=='__main__':
         gif with the resulting frames')
     parser.add_argument('-o', '--output', default='', type=str, help='Path to\
         directory to save gif and/or frames in')
+    parser.add_argument('--shard', action='store_true', help='Save results in\
+        nested shard directories of the output directory, named after the\
+        leading hex digits of each file name')
+    parser.add_argument('--shard_levels', default=2, type=int, help='The\
+        number of nested shard directories used by --shard')
+    parser.add_argument('--name', default='', type=str, help='Base name of\
+        the gif and frames, instead of the name of the image')
     parser.add_argument('-dir', '--directory', default='', type=str,
         help='Directory containing image files to do operations on, recursive.')
-    parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--watch', action='store_true', help='Keep running\
+        and render every image file written to --directory, printing the\
+        results of each as a line of JSON')
+    parser.add_argument('--watch_workers', default=0, type=int, help='The\
+        number of worker processes rendering the images of --watch, 0 for\
+        one per CPU')
+    parser.add_argument('--watch_debounce', default=1.0, type=float,
+        help='Seconds a file written to the --watch directory has to stay\
+        untouched before it is read')
+    parser.add_argument('--watch_interval', default=2.0, type=float,
+        help='Seconds between walks of the --watch directory, where inotify\
+        is not available')
+    parser.add_argument('-s', '--seed', default=None, type=int, help='Seed\
+        for the random number generator, makes --random and --ninety\
+        reproducible')
+    parser.add_argument('--memo', default='', type=str, help='Directory to\
+        memoize intermediate stages of the pipeline in, so that jobs on the\
+        same image only recompute the stages after their options differ')
+    parser.add_argument('--memo_size', default=256, type=int, help='Megabytes\
+        of stages to keep in memory before spilling them to the memo\
+        directory')
+    parser.add_argument('--memo_spill_size', default=4096, type=int,
+        help='Megabytes of stages to keep in the memo directory')
+    parser.add_argument('--source_hash', default='', type=str, help='The\
+        SHA-1 of the image, if already known, to save hashing it for --memo')
+    parser.add_argument('-t', '--threads', default=0, type=int, help='Run\
+        the box operations on this many threads, on bands of boxes. 0 runs\
+        them one box at a time')
+    parser.add_argument('--pipeline', action='store_true', help='Quantize\
+        and encode the gif in another process while the frames are rendered')
+    parser.add_argument('--pipeline_depth', default=2, type=int, help='The\
+        number of frames waiting to be quantized or encoded before rendering\
+        blocks')
+    parser.add_argument('--format', default='gif',
+        choices=sorted(encoders.ENCODERS), help='The format of the\
+        animation')
+    parser.add_argument('--preset', default=encoders.DEFAULT_PRESET,
+        choices=encoders.PRESETS, help='Encode the animation fast, or\
+        slower into a smaller file')
+    parser.add_argument('--save_preset', default=saving.DEFAULT_PRESET,
+        choices=sorted(saving.SAVE_PRESETS), help='Save the frames fast, or\
+        slower into smaller files')
+    parser.add_argument('--save_threads', default=2, type=int, help='Save\
+        the frames on this many threads while the next ones are rendered. 0\
+        saves each frame before rendering the next')
+    parser.add_argument('--profile', action='store_true', help='Profile the\
+        run and save the pstats dump next to the gif, named after it')
+    parser.add_argument('--trace_sample', default=0, type=int, help='Keep one\
+        in every N box events of each kind in the output, for debugging')
+    parser.add_argument('-d', '--debug', action='store_true', help='Print\
+        the stage timings, counters and the first {} box events to STDERR'
+        .format(MAX_EVENTS))
     args = parser.parse_args()
+    try:
+        encoders.get_encoder(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.watch and not args.directory:
+        parser.error('--watch needs a --directory to watch')
 
-    if args.directory:
-        for dirpath, dirnames, filenames in os.walk(args.directory):
-            for name in filenames:
-                _, ext = os.path.splitext(name)
-                if ext in IMAGE_EXTENSIONS:
-                    manipulate_image(os.path.join(dirpath, name), args)
+    if args.watch:
+        watch_directory(args)
+    elif args.directory:
+        manipulate_directory(args)
     elif args.image_path != '':
-        manipulate_image(args.image_path, args)
+        print json.dumps(manipulate_image(args.image_path, args))
     else:
         parser.print_help()
@@ -29,7 +29,7 @@
 Provides functionality for reading and writing animated GIF images.
 Use writeGif to write a series of numpy arrays or PIL images as an
 animated GIF. Use readGif to read an animated gif as a series of numpy
-arrays.
+arrays, or iterFrames to read it one frame at a time.
 Note that since July 2004, all patents on the LZW compression patent have
 expired. Therefore the GIF format may now be used freely.
 Acknowledgements
@@ -101,7 +101,10 @@ def checkImages(images):
             # We assume PIL images are allright
             images2.append(im)
 
-        elif np and isinstance(im, np.ndarray):
+        elif np and (isinstance(im, np.ndarray)
+                     or hasattr(im, '__array_interface__')):
+            # Frames and other array-likes are used without copying
+            im = np.asarray(im)
             # Check and convert dtype
             if im.dtype == np.uint8:
                 images2.append(im) # Ok
@@ -306,20 +309,8 @@ class GifWriter:
         prev = ims[0]
         for im in ims[1:]:
 
-            # Get difference, sum over colors
-            diff = np.abs(im-prev)
-            if diff.ndim==3:
-                diff = diff.sum(2)
-            # Get begin and end for both dimensions
-            X = np.argwhere(diff.sum(0))
-            Y = np.argwhere(diff.sum(1))
             # Get rect coordinates
-            if X.size and Y.size:
-                x0, x1 = X[0], X[-1]+1
-                y0, y1 = Y[0], Y[-1]+1
-            else: # No change ... make it minimal
-                x0, x1 = 0, 2
-                y0, y1 = 0, 2
+            x0, y0, x1, y1 = self.getSubRectangle(prev, im)
 
             # Cut out and store
             im2 = im[y0:y1,x0:x1]
@@ -333,10 +324,35 @@ class GifWriter:
         return ims2, xy
 
 
-    def convertImagesToPIL(self, images, dither, nq=0):
-        """ convertImagesToPIL(images, nq=0)
+    def getSubRectangle(self, prev, im):
+        """ getSubRectangle(prev, im)
+        Calculate the minimal rectangle of the numpy image im that differs
+        from the numpy image prev. Returns a tuple (x0, y0, x1, y1).
+        """
+
+        # Get difference, sum over colors
+        diff = np.abs(im-prev)
+        if diff.ndim==3:
+            diff = diff.sum(2)
+        # Get begin and end for both dimensions
+        X = np.argwhere(diff.sum(0))
+        Y = np.argwhere(diff.sum(1))
+        # Get rect coordinates
+        if X.size and Y.size:
+            return int(X[0]), int(Y[0]), int(X[-1])+1, int(Y[-1])+1
+        else: # No change ... make it minimal
+            return 0, 0, 2, 2
+
+
+    def convertImagesToPIL(self, images, dither, nq=0, colors=256,
+                           palette=None):
+        """ convertImagesToPIL(images, nq=0, colors=256, palette=None)
         Convert images to Paletted PIL images, which can then be
-        written to a single animaged GIF.
+        written to a single animaged GIF. The adaptive palette of each
+        image has at most the given number of colors. If palette is
+        given, 2D arrays hold indices into it rather than intensities.
+        Paletted and grayscale images are not quantized when all 256
+        colors are allowed.
         """
 
         # Convert to PIL images
@@ -351,6 +367,8 @@ class GifWriter:
                     im = Image.fromarray(im[:,:,:3],'RGB')
                 elif im.ndim==2:
                     im = Image.fromarray(im,'L')
+                    if palette is not None:
+                        im.putpalette(palette)
                 images2.append(im)
 
         # Convert to paletted PIL images
@@ -369,7 +387,15 @@ class GifWriter:
             # Adaptive PIL algorithm
             AD = Image.ADAPTIVE
             for im in images:
-                im = im.convert('P', palette=AD, dither=dither)
+                if colors >= 256 and im.mode == 'P':
+                    pass # Already paletted
+                elif colors >= 256 and im.mode == 'L':
+                    im = im.convert('P') # Exact, with a gray palette
+                else:
+                    if im.mode not in ['RGB', 'L']:
+                        im = im.convert('RGB')
+                    im = im.convert('P', palette=AD, dither=dither,
+                                    colors=colors)
                 images2.append(im)
 
         # Done
@@ -384,12 +410,7 @@ class GifWriter:
         # Obtain palette for all images and count each occurance
         palettes, occur = [], []
         for im in images:
-            #palette = getheader(im)[1]
-            palette = getheader(im)[0][-1]
-            if not palette:
-              #palette = PIL.ImagePalette.ImageColor
-                palette = im.palette.tobytes()
-            palettes.append(palette)
+            palettes.append(self.getPalette(im))
         for palette in palettes:
             occur.append( palettes.count( palette ) )
 
@@ -418,32 +439,8 @@ class GifWriter:
                 # Next frame is not the first
                 firstFrame = False
 
-            if True:
-                # Write palette and image data
-
-                # Gather info
-                data = getdata(im)
-                imdes, data = data[0], data[1:]
-                graphext = self.getGraphicsControlExt(durations[frames],
-                                                        disposes[frames])
-                # Make image descriptor suitable for using 256 local color palette
-                lid = self.getImageDescriptor(im, xys[frames])
-
-                # Write local header
-                if (palette != globalPalette) or (disposes[frames] != 2):
-                    # Use local color palette
-                    fp.write(encode(graphext))
-                    fp.write(encode(lid)) # write suitable image descriptor
-                    fp.write(palette) # write local color table
-                    fp.write(encode('\x08')) # LZW minimum size code
-                else:
-                    # Use global color palette
-                    fp.write(encode(graphext))
-                    fp.write(imdes) # write suitable image descriptor
-
-                # Write image data
-                for d in data:
-                    fp.write(d)
+            self.writeFrame(fp, im, palette, globalPalette, durations[frames],
+                            disposes[frames], xys[frames])
 
             # Prepare for next round
             frames = frames + 1
@@ -452,14 +449,129 @@ class GifWriter:
         return frames
 
 
+    def getPalette(self, im):
+        """ getPalette(im)
+        Get the palette of the paletted PIL image im, as 256 RGB colors.
+        """
+        #palette = getheader(im)[1]
+        palette = getheader(im)[0][-1]
+        if not palette:
+          #palette = PIL.ImagePalette.ImageColor
+            palette = im.palette.tobytes()
+        return palette + '\x00' * (768 - len(palette))
+
+
+    def writeFrame(self, fp, im, palette, globalPalette, duration, dispose,
+                   xy):
+        """ writeFrame(fp, im, palette, globalPalette, duration, dispose, xy)
+        Write the palette and image data of one frame.
+        """
+
+        # Gather info
+        data = getdata(im)
+        imdes, data = data[0], data[1:]
+        if len(imdes) == 10:
+            # newer versions of PIL write the LZW minimum code size
+            # separately from the image descriptor
+            imdes, data = imdes + data[0], data[1:]
+        graphext = self.getGraphicsControlExt(duration, dispose)
+        # Make image descriptor suitable for using 256 local color palette
+        lid = self.getImageDescriptor(im, xy)
+
+        # Write local header
+        if (palette != globalPalette) or (dispose != 2):
+            # Use local color palette
+            fp.write(encode(graphext))
+            fp.write(encode(lid)) # write suitable image descriptor
+            fp.write(palette) # write local color table
+            fp.write(encode('\x08')) # LZW minimum size code
+        else:
+            # Use global color palette
+            fp.write(encode(graphext))
+            fp.write(imdes) # write suitable image descriptor
+
+        # Write image data
+        for d in data:
+            fp.write(d)
+
+
+class GifStream:
+    """ GifStream(fp, duration=0.1, repeat=True)
+    Writes an animated GIF one paletted frame at a time, so the frames do
+    not all have to be held in memory. Each frame is cropped to the
+    rectangle that differs from the frame displayed before it, and left in
+    place (dispose 1). The palette of the first frame is the global palette.
+    """
+
+    def __init__(self, fp, duration=0.1, repeat=True):
+        self.fp = fp
+        self.duration = duration
+        if repeat is False:
+            self.loops = 1
+        elif repeat is True:
+            self.loops = 0 # zero means infinite
+        else:
+            self.loops = int(repeat)
+        self.writer = GifWriter()
+        self.globalPalette = None
+        self.prev = None
+        self.frames = 0
+
+
+    def write(self, im, timings=None, duration=None):
+        """ write(im, timings=None, duration=None)
+        Write the paletted PIL image im as the next frame. All frames must
+        have the size of the first. If timings is a dictionary, the seconds
+        spent finding the subrectangle and encoding are added to it. The
+        frame is shown for duration seconds, or the duration of the stream
+        if None.
+        """
+        if duration is None:
+            duration = self.duration
+        t0 = time.time()
+        palette = self.writer.getPalette(im)
+        shown = np.asarray(im.convert('RGB'))
+        if self.prev is None:
+            xy, region = (0, 0), im
+        else:
+            x0, y0, x1, y1 = self.writer.getSubRectangle(self.prev, shown)
+            xy, region = (x0, y0), im.crop((x0, y0, x1, y1))
+        self.prev = shown
+
+        t1 = time.time()
+        if self.globalPalette is None:
+            self.globalPalette = palette
+            self.fp.write(encode(self.writer.getheaderAnim(im)))
+            self.fp.write(self.globalPalette)
+            self.fp.write(encode(self.writer.getAppExt(self.loops)))
+        self.writer.writeFrame(self.fp, region, palette, self.globalPalette,
+                               duration, 1, xy)
+        self.frames += 1
+
+        if timings is not None:
+            timings['subrectangles'] = (timings.get('subrectangles', 0.0)
+                                        + t1 - t0)
+            timings['encode'] = timings.get('encode', 0.0) + time.time() - t1
+
+
+    def close(self):
+        """ close()
+        End the GIF. Does not close the file.
+        """
+        self.fp.write(encode(";"))  # end gif
+        return self.frames
+
+
 
 
 ## Exposed functions
 
 def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                nq=0, subRectangles=True, dispose=None):
+                nq=0, subRectangles=True, dispose=None, timings=None,
+                colors=256, palette=None):
     """ writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                    nq=0, subRectangles=True, dispose=None)
+                    nq=0, subRectangles=True, dispose=None, timings=None,
+                    colors=256, palette=None)
     Write an animated gif from the specified images.
     Parameters
     ----------
@@ -468,7 +580,8 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
     images : list
         Should be a list consisting of PIL images or numpy arrays.
         The latter should be between 0 and 255 for integer types, and
-        between 0 and 1 for float types.
+        between 0 and 1 for float types. Objects exposing the numpy array
+        interface are used as arrays, without copying.
     duration : scalar or list of scalars
         The duration for all frames, or (if a list) for each frame.
     repeat : bool or integer
@@ -494,6 +607,15 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
         in place. 2 means the background color should be restored after
         each frame. 3 means the decoder should restore the previous frame.
         If subRectangles==False, the default is 2, otherwise it is 1.
+    timings : dict
+        If given, the seconds spent in the 'subrectangles', 'quantize' and
+        'encode' stages are stored in it.
+    colors : integer
+        The most colors in the palette of each frame, when the standard
+        PIL algorithm is used. Fewer colors make a smaller file.
+    palette : list
+        If given, 2D numpy arrays are indices into this palette, as
+        returned by getpalette, and are written without quantizing.
     """
 
     # Check PIL
@@ -524,6 +646,7 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
         duration = [duration for im in images]
 
     # Check subrectangles
+    t0 = time.time()
     if subRectangles:
         images, xy = gifWriter.handleSubRectangles(images, subRectangles)
         defaultDispose = 1 # Leave image in place
@@ -543,60 +666,115 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
 
 
     # Make images in a format that we can write easy
-    images = gifWriter.convertImagesToPIL(images, dither, nq)
+    t1 = time.time()
+    images = gifWriter.convertImagesToPIL(images, dither, nq, colors,
+                                          palette)
 
     # Write
+    t2 = time.time()
     fp = open(filename, 'wb')
     try:
         gifWriter.writeGifToFile(fp, images, duration, loops, xy, dispose)
     finally:
         fp.close()
 
+    if timings is not None:
+        timings['subrectangles'] = t1 - t0
+        timings['quantize'] = t2 - t1
+        timings['encode'] = time.time() - t2
 
 
-def readGif(filename, asNumpy=True):
-    """ readGif(filename, asNumpy=True)
-    Read images from an animated GIF file.  Returns a list of numpy
-    arrays, or, if asNumpy is false, a list if PIL images.
+
+def iterFrames(filename):
+    """ iterFrames(filename)
+    Read the frames of an animated GIF, or of any other image file PIL can
+    seek in (such as a multi-page TIFF), one at a time. Yields a tuple
+    (image, duration) for each frame; where image is an RGB PIL image of the
+    frame as it is displayed and duration is in seconds. Frames of a GIF
+    are composited over the frames before them according to their disposal
+    method. Only the displayed frame is kept between frames, and each
+    yielded image is a new one, so it can be changed.
     """
 
     # Check PIL
     if PIL is None:
         raise RuntimeError("Need PIL to read animated gif files.")
 
-    # Check Numpy
-    if np is None:
-        raise RuntimeError("Need Numpy to read animated gif files.")
-
     # Check whether it exists
     if not os.path.isfile(filename):
         raise IOError('File not found: '+str(filename))
 
-    # Load file using PIL
     pilIm = PIL.Image.open(filename)
-    pilIm.seek(0)
+    isGif = pilIm.format == 'GIF'
+    canvas, background = None, (0, 0, 0)
+    dispose, extent, restore = 0, None, None
+    index = 0
+    while True:
+        try:
+            pilIm.seek(index)
+        except EOFError:
+            break
+        duration = pilIm.info.get('duration', 100) / 1000.0
+
+        if not isGif:
+            yield pilIm.convert('RGB'), duration
+            index += 1
+            continue
+
+        # PIL can leave the palette of the last frame in place when it
+        # draws a frame with a local palette over it, so it is kept from
+        # before the frame is loaded
+        palette = pilIm.palette and pilIm.palette.getdata()
+
+        # Dispose of the previous frame
+        if canvas is None:
+            i = 3 * pilIm.info.get('background', 0)
+            if palette and palette[0] == 'RGB' and i + 3 <= len(palette[1]):
+                background = tuple(bytearray(palette[1][i:i + 3]))
+            canvas = PIL.Image.new('RGB', pilIm.size, background)
+        elif dispose == 2:
+            canvas.paste(background, extent)
+        elif dispose == 3:
+            canvas.paste(restore, extent[:2])
+
+        # Draw this frame over it, through its transparency
+        if pilIm.tile:
+            extent = tuple(pilIm.tile[0][1])
+        else:
+            extent = (0, 0) + pilIm.size
+        dispose = getattr(pilIm, 'disposal_method', 0)
+        restore = canvas.crop(extent) if dispose == 3 else None
+        pilIm.load()
+        frame = pilIm.copy()
+        if frame.mode == 'P' and palette:
+            rawmode, data = palette
+            frame.putpalette(data, rawmode)
+        region = frame.convert('RGBA').crop(extent)
+        canvas.paste(region, extent[:2], region)
+
+        yield canvas.copy(), duration
+        index += 1
+
+
+def readGif(filename, asNumpy=True):
+    """ readGif(filename, asNumpy=True)
+    Read images from an animated GIF file.  Returns a list of numpy
+    arrays, or, if asNumpy is false, a list if PIL images. Use iterFrames
+    to read large files without holding every frame.
+    """
+
+    # Check Numpy
+    if np is None:
+        raise RuntimeError("Need Numpy to read animated gif files.")
 
     # Read all images inside
     images = []
-    try:
-        while True:
-            # Get image as numpy array
-            tmp = pilIm.convert() # Make without palette
-            a = np.asarray(tmp)
-            if len(a.shape)==0:
+    for im, duration in iterFrames(filename):
+        if asNumpy:
+            im = np.asarray(im)
+            if len(im.shape)==0:
                 raise MemoryError("Too little memory to convert PIL image to array")
-            # Store, and next
-            images.append(a)
-            pilIm.seek(pilIm.tell()+1)
-    except EOFError:
-        pass
-
-    # Convert to normal PIL images if needed
-    if not asNumpy:
-        images2 = images
-        images = []
-        for im in images2:
-            images.append( PIL.Image.fromarray(im) )
+        images.append(im)
 
     # Done
     return images
@@ -724,7 +902,7 @@ class NeuQuant:
 
         # Initialize
         self.setconstants(samplefac, colors)
-        self.pixels = np.fromstring(image.tostring(), np.uint32)
+        self.pixels = np.fromstring(image.tobytes(), np.uint32)
         self.setUpArrays()
 
         self.learn()
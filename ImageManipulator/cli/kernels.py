@@ -0,0 +1,160 @@
+"""
+Vectorized versions of the box operations of ImageManipulator. The boxes of
+an image are viewed as a grid of blocks in a numpy array, and each operation
+runs on bands of whole rows of boxes (or columns, for vertical slices) in
+parallel on a pool of threads, since numpy releases the interpreter lock while
+it copies and sums. Everything random is drawn by the caller, in box order, so
+the results are the same as those of the operations on one box at a time.
+"""
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+# The modes the pixels of a box can be averaged in
+AVERAGE_MODES = ['RGB', 'RGBA', 'L']
+
+pools = {}
+
+def get_pool(threads):
+    """ :return: The ThreadPool with the given number of threads. """
+    if threads not in pools:
+        pools[threads] = ThreadPool(threads)
+    return pools[threads]
+
+class Grid(object):
+    """ The layout of the boxes of an image, as rows and columns of blocks. """
+    def __init__(self, size, box_size, vertical=False, horizontal=False):
+        """
+        :param size: The size of the image.
+        :param box_size: The size of a box.
+        :param vertical: True if the boxes are vertical slices.
+        :param horizontal: True if the boxes are horizontal slices.
+        """
+        w, h = size
+        if vertical:
+            self.block_w, self.block_h = box_size, h
+        elif horizontal:
+            self.block_w, self.block_h = w, box_size
+        else:
+            self.block_w = self.block_h = box_size
+        self.cols = w / self.block_w
+        self.rows = h / self.block_h
+
+    def get_blocks(self, array):
+        """
+        :param array: The pixels of the image, with a channel axis.
+        :return: A view of array of shape (rows, cols, block_h, block_w,
+        channels), in the order of ImageManipulator.boxes.
+        """
+        region = array[:self.rows * self.block_h, :self.cols * self.block_w]
+        return region.reshape(self.rows, self.block_h, self.cols,
+                              self.block_w, array.shape[2]
+                              ).transpose(0, 2, 1, 3, 4)
+
+    def get_bands(self, n):
+        """
+        :param n: The number of bands wanted.
+        :return: A list of at most n tuples of slices (rows, cols), together
+        covering every block.
+        """
+        if self.rows > 1:
+            return [(band, slice(None)) for band in split(self.rows, n)]
+        return [(slice(None), band) for band in split(self.cols, n)]
+
+def split(length, n):
+    """ :return: At most n slices of nearly equal size covering length. """
+    n = max(1, min(n, length))
+    bounds = [length * i / n for i in range(n + 1)]
+    return [slice(bounds[i], bounds[i + 1]) for i in range(n)]
+
+def get_array(frame):
+    """ :return: A view of the pixels of frame, with a channel axis. """
+    array = frame.array
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    return array
+
+def run(grid, array, kernel, threads, *args):
+    """
+    Effect: runs kernel(blocks, band, *args) on every band of blocks of
+    array, in parallel.
+    """
+    blocks = grid.get_blocks(array)
+    bands = grid.get_bands(threads)
+    if len(bands) == 1:
+        kernel(blocks, bands[0], *args)
+    else:
+        get_pool(threads).map(lambda band: kernel(blocks, band, *args), bands)
+
+def rotate(frame, grid, turns, threads):
+    """
+    Effect: rotates every box of frame by its own number of quarter turns.
+
+    :param frame: The Frame.
+    :param grid: The Grid of its boxes.
+    :param turns: A list of the quarter turns counter-clockwise of each box,
+    in box order. Boxes turned once or three times must be square.
+    :param threads: The number of threads to run on.
+    """
+    turns = np.array(turns, dtype=np.uint8).reshape(grid.rows, grid.cols)
+    run(grid, get_array(frame), rotate_band, threads, turns)
+
+def rotate_band(blocks, band, turns):
+    blocks = blocks[band]
+    turns = turns[band]
+    for n_turns in [1, 2, 3]:
+        selected = turns == n_turns
+        if not selected.any():
+            continue
+        # (n, y, x, channels)
+        boxes = blocks[selected]
+        if n_turns == 1:
+            boxes = boxes.transpose(0, 2, 1, 3)[:, ::-1]
+        elif n_turns == 2:
+            boxes = boxes[:, ::-1, ::-1]
+        else:
+            boxes = boxes.transpose(0, 2, 1, 3)[:, :, ::-1]
+        blocks[selected] = boxes
+
+def average(frame, grid, threads):
+    """
+    Effect: colors every box of frame with the average of its pixels, rounded
+    down. The colors of RGBA pixels are weighted by their alpha.
+
+    :param frame: The Frame, in one of AVERAGE_MODES.
+    :param grid: The Grid of its boxes.
+    :param threads: The number of threads to run on.
+    """
+    run(grid, get_array(frame), average_band, threads, frame.mode == 'RGBA')
+
+def average_band(blocks, band, weighted):
+    blocks = blocks[band]
+    n = np.uint64(blocks.shape[2] * blocks.shape[3])
+    if weighted:
+        alpha = blocks[..., 3:].astype(np.uint64)
+        alpha_sums = alpha.sum(axis=(2, 3))
+        color_sums = (blocks[..., :3] * alpha).sum(axis=(2, 3))
+        colors = color_sums // np.maximum(alpha_sums, np.uint64(1))
+        means = np.concatenate([colors, alpha_sums // n], axis=-1)
+    else:
+        means = blocks.sum(axis=(2, 3), dtype=np.uint64) // n
+    blocks[...] = means[:, :, np.newaxis, np.newaxis, :].astype(np.uint8)
+
+def permute(frame, grid, sources, threads):
+    """
+    Effect: moves every box of frame to where another one was.
+
+    :param frame: The Frame.
+    :param grid: The Grid of its boxes.
+    :param sources: A list of the index of the box that ends up in each box,
+    in box order.
+    :param threads: The number of threads to run on.
+    """
+    array = get_array(frame)
+    original = grid.get_blocks(array.copy())
+    original = original.reshape((grid.rows * grid.cols,)
+                                + original.shape[2:])
+    sources = np.array(sources).reshape(grid.rows, grid.cols)
+    run(grid, array, permute_band, threads, original, sources)
+
+def permute_band(blocks, band, original, sources):
+    blocks[band] = original[sources[band]]
@@ -0,0 +1,139 @@
+"""
+The record of the images a --directory run has rendered, kept as JSON lines
+in the output directory. A record is appended as soon as an image is done, so
+a run that is interrupted resumes after the last image it finished, and a
+rerun skips every image that is unchanged since it was rendered with the same
+options.
+"""
+import os, json, hashlib
+from memo import get_file_hash
+
+MANIFEST_NAME = '.imagemanipulator-manifest.jsonl'
+
+# The arguments that change what is rendered, which the options of a record
+# are the hash of
+OPTION_ARGUMENTS = ['resize', 'box_size', 'iterations', 'constant', 'auto',
+    'vertical', 'horizontal', 'flip', 'ninety', 'random', 'average',
+    'frames', 'nogif', 'shard', 'shard_levels', 'name', 'seed', 'format',
+    'preset', 'save_preset']
+
+def get_options_key(args):
+    """
+    :param args: The args object used for configuration.
+    :return: The hex SHA-1 of the arguments that change what is rendered.
+    """
+    options = dict((name, getattr(args, name, None))
+                   for name in OPTION_ARGUMENTS)
+    return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+
+class Manifest(object):
+    """
+    The records of rendered images by their path relative to the input
+    directory, each holding the size, modification time and hash of the
+    image, the options it was rendered with and the paths of its results.
+    The file is compacted when it is opened, if images have been recorded
+    more than once.
+    """
+    def __init__(self, path, root):
+        """
+        :param path: The path of the manifest file, which need not exist.
+        :param root: The input directory the paths of images are relative to.
+        """
+        self.path = path
+        self.root = root
+        self.records = {}
+        n_lines = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run
+                        continue
+                    self.records[record['path']] = record
+        if n_lines > len(self.records):
+            self.compact()
+        self.outputs = set(output for record in self.records.values()
+                           for output in record['outputs'])
+        self.file = open(path, 'a')
+
+    def get_key(self, image_path):
+        """ :return: The path of an image relative to the input directory. """
+        return os.path.relpath(image_path, self.root)
+
+    def is_output(self, path):
+        """ :return: True if the file at path is a recorded result. """
+        return self.get_key(path) in self.outputs
+
+    def lookup(self, image_path, options):
+        """
+        Finds the record of an image, if it is unchanged since it was
+        rendered with options and its results still exist. An image whose
+        size and modification time match its record is taken as unchanged
+        without reading it; one whose modification time alone differs is
+        hashed, and its record is updated if the contents are the same.
+
+        :param image_path: The path of the image.
+        :param options: The options key from get_options_key.
+        :return: The record, or None if the image has to be rendered.
+        """
+        record = self.records.get(self.get_key(image_path))
+        if record is None or record['options'] != options:
+            return None
+        outputs = [os.path.join(self.root, output)
+                   for output in record['outputs']]
+        if not all(os.path.exists(output) for output in outputs):
+            return None
+
+        stat = os.stat(image_path)
+        if stat.st_size != record['size']:
+            return None
+        if stat.st_mtime != record['mtime']:
+            content_hash = get_file_hash(image_path)
+            if content_hash != record['hash']:
+                return None
+            self.add(image_path, options, record['results'], outputs,
+                     content_hash)
+        return self.records[self.get_key(image_path)]
+
+    def add(self, image_path, options, results, outputs, content_hash=None):
+        """
+        Effect: records that an image was rendered, and writes the record
+        through to the file.
+
+        :param image_path: The path of the image.
+        :param options: The options key from get_options_key.
+        :param results: The names of the results, as {'gif': name,
+        'frames': [name, ...]}.
+        :param outputs: The paths of the result files.
+        :param content_hash: The hex SHA-1 of the image, if already known.
+        """
+        stat = os.stat(image_path)
+        record = {
+            'path': self.get_key(image_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': content_hash or get_file_hash(image_path),
+            'options': options,
+            'results': results,
+            'outputs': [self.get_key(output) for output in outputs],
+        }
+        self.records[record['path']] = record
+        self.outputs.update(record['outputs'])
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def compact(self):
+        """ Effect: rewrites the file with only the latest records. """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for key in sorted(self.records):
+                f.write(json.dumps(self.records[key], sort_keys=True) + '\n')
+        os.rename(tmp_path, self.path)
+
+    def close(self):
+        """ Effect: closes the file. """
+        self.file.close()
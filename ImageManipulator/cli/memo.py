@@ -0,0 +1,226 @@
+"""
+Memoization of the intermediate products of the manipulation pipeline. Every
+stage of rendering a frame is identified by the hash of the source image plus
+the list of operations applied to it so far, so two jobs whose options only
+differ towards the end of the pipeline share all the stages before that.
+"""
+import os, json, time, hashlib, tempfile
+from collections import OrderedDict
+from PIL import Image
+
+SPILL_EXTENSION = '.stage'
+# The marker of a source image that a job has rendered
+SEEN_EXTENSION = '.seen'
+TMP_EXTENSION = '.tmp'
+
+# Seconds after which the temporary file of a spill is left over from a job
+# that was killed while writing it, and after which a source is forgotten
+STALE_TMP_SECONDS = 60 * 60
+SEEN_SECONDS = 7 * 24 * 60 * 60
+
+def get_stage_key(prefix):
+    """
+    :param prefix: A JSON serializable list identifying the source image and
+    the operations applied to it, in order.
+    :return: The key of the stage as a hex string.
+    """
+    return hashlib.sha1(json.dumps(prefix)).hexdigest()
+
+def get_file_hash(path, chunk_size=64 * 1024):
+    """
+    :param path: The path of a file.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: The hex SHA-1 of the contents of the file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class StageMemo(object):
+    """
+    An LRU cache of stage images held in memory up to max_bytes. Images that
+    are evicted from memory spill to spill_dir (if given) as raw pixel data,
+    which is much cheaper to write and read back than an encoded image. The
+    images left in memory on close only spill if their source was rendered by
+    an earlier job too, since most images are only ever rendered once. The
+    spill directory is trimmed to max_spill_bytes on close, oldest access
+    first.
+    """
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        """
+        :param max_bytes: The number of bytes of pixel data to hold in memory.
+        :param spill_dir: The directory to spill images to, or None to keep
+        them in memory only.
+        :param max_spill_bytes: The size limit of the spill directory.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.repeated = False
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def get(self, key):
+        """
+        :param key: The key of the stage.
+        :return: A copy of the stage image, or None if it is not memoized.
+        """
+        if key in self.entries:
+            image, spilled = self.entries.pop(key)
+            self.entries[key] = (image, spilled)
+            self.hits += 1
+            return image.copy()
+
+        image = self.read_spill(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.add(key, image, spilled=True)
+        return image.copy()
+
+    def put(self, key, image):
+        """
+        Effect: memoizes a copy of image under key.
+
+        :param key: The key of the stage.
+        :param image: The stage image.
+        """
+        if key in self.entries:
+            return
+        self.add(key, image.copy(), spilled=False)
+
+    def add(self, key, image, spilled):
+        self.entries[key] = (image, spilled)
+        self.n_bytes += get_image_bytes(image)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, (old_image, old_spilled) = self.entries.popitem(last=False)
+            self.n_bytes -= get_image_bytes(old_image)
+            if not old_spilled:
+                self.write_spill(old_key, old_image)
+
+    def mark_source(self, source_hash):
+        """
+        Effect: records that this job renders the source image, noting if an
+        earlier job did too.
+
+        :param source_hash: The hex SHA-1 of the source image.
+        """
+        if not self.spill_dir:
+            return
+        path = os.path.join(self.spill_dir, source_hash + SEEN_EXTENSION)
+        try:
+            if os.path.exists(path):
+                self.repeated = True
+                os.utime(path, None)
+            else:
+                open(path, 'a').close()
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        """
+        Effect: spills what is still held in memory, if the source was
+        rendered before, and trims the spill directory.
+        """
+        if self.repeated:
+            for key, (image, spilled) in self.entries.items():
+                if not spilled:
+                    self.write_spill(key, image)
+        self.entries.clear()
+        self.n_bytes = 0
+        self.trim_spill()
+
+    def get_spill_path(self, key):
+        return os.path.join(self.spill_dir, key + SPILL_EXTENSION)
+
+    def write_spill(self, key, image):
+        """
+        Effect: writes image to the spill directory as a one line JSON header
+        followed by the raw pixel data. Each write goes through its own
+        temporary file, since other processes spill to the same directory; if
+        the spill cannot be written it is lost, which only costs a miss later.
+        """
+        if not self.spill_dir:
+            return
+        header = {'mode': image.mode, 'size': image.size}
+        if image.mode == 'P':
+            header['palette'] = image.getpalette()
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=key, suffix=TMP_EXTENSION,
+                dir=self.spill_dir)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header) + '\n')
+                f.write(image.tobytes())
+            os.rename(tmp_path, self.get_spill_path(key))
+        except (IOError, OSError):
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+    def read_spill(self, key):
+        """
+        :return: The image spilled under key, or None if there is none.
+        """
+        if not self.spill_dir:
+            return None
+        path = self.get_spill_path(key)
+        # the file may be torn, or removed by another process trimming the
+        # spill directory, both of which are a miss
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                data = f.read()
+            image = Image.frombytes(header['mode'], tuple(header['size']),
+                data)
+            if 'palette' in header:
+                image.putpalette(header['palette'])
+            # keep the access time current for trim_spill
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return image
+
+    def trim_spill(self):
+        """
+        Effect: deletes the least recently used spilled images until the
+        spill directory takes up at most max_spill_bytes, along with stale
+        temporary files and markers.
+        """
+        if not self.spill_dir:
+            return
+        files = []
+        now = time.time()
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            # another process may have removed it since the listing
+            try: stat = os.stat(path)
+            except OSError: continue
+            if name.endswith(SPILL_EXTENSION):
+                files.append((stat.st_mtime, stat.st_size, name))
+            elif ((name.endswith(TMP_EXTENSION)
+                   and now - stat.st_mtime > STALE_TMP_SECONDS)
+                  or (name.endswith(SEEN_EXTENSION)
+                      and now - stat.st_mtime > SEEN_SECONDS)):
+                try: os.remove(path)
+                except OSError: pass
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_spill_bytes:
+                break
+            try: os.remove(os.path.join(self.spill_dir, name))
+            except OSError: pass
+            total -= size
+
+def get_image_bytes(image):
+    """ :return: The approximate size of the pixel data of image in bytes. """
+    w, h = image.size
+    return w * h * len(image.getbands())
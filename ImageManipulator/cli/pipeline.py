@@ -0,0 +1,80 @@
+"""
+A chain of stages, each running on its own thread and connected by bounded
+queues, so that a slow stage holds up the ones before it instead of letting
+work pile up in memory.
+"""
+import sys, threading
+from Queue import Queue, Full
+
+# Passed down the pipeline after the last item
+DONE = object()
+
+class Pipeline(object):
+    """
+    Runs items through stages. Each stage is a function taking an item and
+    returning the item for the next stage, or None to drop it. An exception
+    in a stage stops the pipeline and is raised again by put or close.
+    """
+    def __init__(self, stages, depth=2):
+        """
+        :param stages: The list of stage functions, in order.
+        :param depth: The number of items each queue holds before put blocks.
+        """
+        self.queues = [Queue(depth) for stage in stages]
+        self.error = None
+        self.threads = []
+        for i, stage in enumerate(stages):
+            output = self.queues[i + 1] if i + 1 < len(stages) else None
+            thread = threading.Thread(target=self.run,
+                                      args=(stage, self.queues[i], output))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        """ Effect: queues item for the first stage, once there is room. """
+        self.send(self.queues[0], item)
+        self.check()
+
+    def close(self):
+        """
+        Effect: waits until every item has gone through every stage.
+        """
+        self.send(self.queues[0], DONE)
+        for thread in self.threads:
+            thread.join()
+        self.check()
+
+    def run(self, stage, input, output):
+        while True:
+            item = input.get()
+            if item is DONE:
+                break
+            if self.error is not None:
+                # drain the queue so the stages before do not block
+                continue
+            try:
+                item = stage(item)
+            except Exception:
+                self.error = sys.exc_info()
+                continue
+            if item is not None and output is not None:
+                self.send(output, item)
+        if output is not None:
+            output.put(DONE)
+
+    def send(self, queue, item):
+        # stop waiting for room once a stage has failed, since the queue
+        # might not be drained in time
+        while True:
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                if self.error is not None and item is not DONE:
+                    return
+
+    def check(self):
+        if self.error is not None:
+            error_type, error, traceback = self.error
+            raise error_type, error, traceback
@@ -0,0 +1,57 @@
+"""
+Resizing images as they are decoded. Formats that can decode at a reduced
+resolution, like JPEG by DCT scaling, are decoded at the smallest one that
+is still at least the size they are resized to, so the full resolution is
+never held in memory. A high quality resize takes them the rest of the way.
+"""
+from PIL import Image
+
+# The filter of the final resize
+RESAMPLE = getattr(Image, 'LANCZOS', Image.ANTIALIAS)
+
+# How many times larger than the target an image can be before it is first
+# reduced by a whole factor, where Pillow supports it (Pillow 7 and later)
+REDUCING_GAP = 3.0
+
+def get_resized_size(size, resize):
+    """
+    :param size: The size of the image.
+    :param resize: The size to resize to, as given to --resize. If either
+    the width or height is zero, it is calculated from the other one.
+    :return: The size to resize the image to.
+    """
+    cur_width, cur_height = size
+    width, height = resize
+
+    if width == 0 and height != 0:
+        width = int((float(cur_width) / float(cur_height)) * height)
+    elif width != 0 and height == 0:
+        height = int((float(cur_height) / float(cur_width)) * width)
+    return width, height
+
+def draft(image, size):
+    """
+    Effect: makes an Image that is not loaded yet decode at the smallest
+    reduced resolution at least size, if its format has one.
+
+    :param image: The opened Image.
+    :param size: The size it will be resized to.
+    :return: True if the image will be decoded smaller than its full size.
+    """
+    full_size = image.size
+    if size[0] >= full_size[0] or size[1] >= full_size[1]:
+        return False
+    image.draft(image.mode, size)
+    return image.size != full_size
+
+def resize(image, size):
+    """
+    :param image: The Image to resize.
+    :param size: The size to resize it to.
+    :return: The resized Image, or image itself if it is that size already.
+    """
+    if image.size == tuple(size):
+        return image
+    if hasattr(Image.Image, 'reduce'):
+        return image.resize(size, RESAMPLE, reducing_gap=REDUCING_GAP)
+    return image.resize(size, RESAMPLE)
@@ -0,0 +1,124 @@
+"""
+Saving the frames of an animation on background threads, so the frames are
+compressed while the next ones are rendered. Pillow lets go of the GIL while
+it compresses, so the threads save in parallel with rendering. Each format
+has presets that trade saving time against the size of the file.
+"""
+import os, time, threading
+from multiprocessing.pool import ThreadPool
+
+# The zlib strategy that only looks for runs of the same byte, missing from
+# the zlib module of Python 2
+Z_RLE = 3
+
+# The formats of the extensions that are not the name of their format
+EXTENSION_FORMATS = {'jpg': 'jpeg', 'tif': 'tiff'}
+
+# The preset used when none is chosen
+DEFAULT_PRESET = 'fast'
+
+# The options each preset saves the formats that have any with
+SAVE_PRESETS = {
+    'fast': {
+        'png': {'compress_level': 1, 'compress_type': Z_RLE},
+        'jpeg': {'quality': 75},
+    },
+    'small': {
+        'png': {'optimize': True},
+        'jpeg': {'quality': 70, 'optimize': True},
+    },
+}
+
+def get_save_options(path, preset):
+    """
+    :param path: The path an image is saved to.
+    :param preset: The name of the preset.
+    :return: The options to give Image.save for the format of the path.
+    """
+    ext = os.path.splitext(path)[1][1:].lower()
+    image_format = EXTENSION_FORMATS.get(ext, ext)
+    return SAVE_PRESETS[preset].get(image_format, {})
+
+class FrameSaver(object):
+    """
+    Saves images on a pool of threads. At most two saves per thread are
+    waiting or running at a time, after which save blocks, so frames do not
+    pile up in memory when saving is slower than rendering. The threads are
+    only started by the first save, as most jobs save no frames. An exception
+    in a save is raised again by the next call to save or close.
+    """
+    def __init__(self, threads, preset, tracer):
+        """
+        :param threads: The number of threads to save on, or 0 to save on
+        the calling thread.
+        :param preset: The name of the preset to save with.
+        :param tracer: The Tracer to time the saves with.
+        """
+        self.preset = preset
+        self.tracer = tracer
+        self.threads = threads
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(max(1, 2 * threads))
+        self.pending = []
+
+    def save(self, image, path):
+        """
+        Effect: saves image to path, in the background if there are threads.
+        The image must not be changed afterwards.
+        """
+        if not self.threads:
+            self.tracer.add('save_frames', self.save_image(image, path))
+            return
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        with self.tracer.stage('save_wait'):
+            self.slots.acquire()
+        self.collect()
+        self.pending.append(self.pool.apply_async(self.save_image,
+            (image, path)))
+
+    def save_image(self, image, path):
+        """
+        Saves image to path with the options of the preset.
+
+        :return: The seconds it took.
+        """
+        start = time.time()
+        try:
+            image.save(path, **get_save_options(path, self.preset))
+        finally:
+            if self.threads:
+                self.slots.release()
+        return time.time() - start
+
+    def collect(self):
+        """
+        Effect: adds the time of the finished saves to the tracer, raising
+        the exception of any that failed.
+        """
+        pending = []
+        for result in self.pending:
+            if result.ready():
+                self.tracer.add('save_frames', result.get())
+            else:
+                pending.append(result)
+        self.pending = pending
+
+    def close(self):
+        """
+        Effect: waits for every save to finish, even if one failed, and stops
+        the threads.
+        """
+        if self.pool is None:
+            return
+        with self.tracer.stage('save_wait'):
+            try:
+                for result in self.pending:
+                    self.tracer.add('save_frames', result.get())
+            finally:
+                # the threads exit on their own once closed; joining the pool
+                # would wait on its bookkeeping thread, which polls slowly
+                self.pool.close()
+                for result in self.pending:
+                    result.wait()
+                self.pending = []
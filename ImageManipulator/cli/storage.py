@@ -0,0 +1,114 @@
+"""
+Layouts of the directory that uploaded images and generated results are saved
+in. Both the web app and the manipulation script save and find files through
+a storage object, by name, so the layout on disk can change without the names
+(and the URLs built from them) changing.
+"""
+import os, re, errno, hashlib
+
+HEX_PREFIX = re.compile('^[0-9a-f]+')
+
+class FlatStorage(object):
+    """
+    Saves every file directly in the root directory.
+    """
+    def __init__(self, root):
+        """
+        :param root: The directory to save files in.
+        """
+        self.root = root
+
+    def get_relative_path(self, name):
+        """
+        :param name: The name of a file.
+        :return: The path of the file relative to the root directory.
+        """
+        return name
+
+    def get_path(self, name):
+        """
+        :param name: The name of a file.
+        :return: The absolute path of the file.
+        """
+        return os.path.join(self.root, self.get_relative_path(name))
+
+    def get_save_path(self, name):
+        """
+        Effect: creates the directory the file will be saved in.
+
+        :param name: The name of a file.
+        :return: The absolute path to save the file to.
+        """
+        path = os.path.join(self.root, self.get_relative_path(name))
+        make_dirs(os.path.dirname(path))
+        return path
+
+    def exists(self, name):
+        """ :return: True if the file named name exists. """
+        return os.path.exists(self.get_path(name))
+
+    def remove(self, name):
+        """ Effect: deletes the file named name, if it exists. """
+        try:
+            os.remove(self.get_path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def remove_prefixed(self, prefix):
+        """
+        Effect: deletes every file whose name starts with prefix and that is
+        stored alongside a file named prefix, e.g. the partial results of a
+        job named after its uuid.
+        """
+        directory = os.path.dirname(self.get_save_path(prefix))
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                self.remove(name)
+
+class ShardedStorage(FlatStorage):
+    """
+    Saves files in nested shard directories named after the leading hex digits
+    of the file name, e.g. 'ab/cd/abcd1234.gif'. Content hashes and uuids are
+    used as names as they are, so an upload and all the results generated from
+    it end up in the same shard. Other names are sharded by their SHA-1.
+    Files saved before sharding was enabled are still found in the root.
+    """
+    def __init__(self, root, levels=2, width=2):
+        """
+        :param root: The directory to save files in.
+        :param levels: The number of nested shard directories.
+        :param width: The number of hex digits in each shard directory name.
+        """
+        super(ShardedStorage, self).__init__(root)
+        self.levels = levels
+        self.width = width
+
+    def get_relative_path(self, name):
+        n_digits = self.levels * self.width
+        digits = HEX_PREFIX.match(name.lower())
+        if digits is None or len(digits.group()) < n_digits:
+            digits = hashlib.sha1(name).hexdigest()
+        else:
+            digits = digits.group()
+        shards = [digits[i * self.width:(i + 1) * self.width]
+                  for i in range(self.levels)]
+        return os.path.join(*(shards + [name]))
+
+    def get_path(self, name):
+        path = super(ShardedStorage, self).get_path(name)
+        if not os.path.exists(path):
+            flat_path = os.path.join(self.root, name)
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+
+def make_dirs(path):
+    """ Effect: creates the directory at path and its parents if needed. """
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,75 @@
+"""
+Low overhead tracing of the manipulation pipeline. Stages are timed as a whole
+(once per frame, not once per box), and their durations are summed by name so
+they can be reported along with the results. Per box work is only counted,
+and a sample of the per box events can be kept for debugging.
+"""
+import time
+from contextlib import contextmanager
+
+# The most events kept, however many are sampled
+MAX_EVENTS = 1000
+
+class Tracer(object):
+    """
+    Accumulates the time spent in each named stage, counts events and keeps
+    every sample_every-th event of each name.
+    """
+    def __init__(self, sample_every=0):
+        """
+        :param sample_every: Keep one in every sample_every events of each
+        name, or none if 0.
+        """
+        self.sample_every = sample_every
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the time spent in its body to the stage
+        name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """ Effect: adds seconds to the time spent in the stage name. """
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """ Effect: adds n to the counter name. """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, name, data=None):
+        """
+        Effect: counts an event, and keeps it if it is sampled.
+
+        :param name: The name of the event, which is also its counter.
+        :param data: Anything JSON serializable describing the event.
+        """
+        n = self.counters.get(name, 0)
+        self.counters[name] = n + 1
+        if (self.sample_every and n % self.sample_every == 0
+                and len(self.events) < MAX_EVENTS):
+            self.events.append([name, data])
+
+    def summary(self):
+        """
+        :return: A dictionary from stage name to the seconds spent in it.
+        """
+        return dict(self.timings)
+
+    def report(self):
+        """
+        :return: A dictionary with the timings, the counters and, if any were
+        sampled, the events.
+        """
+        report = {'timings': self.summary(), 'counters': dict(self.counters)}
+        if self.sample_every:
+            report['events'] = list(self.events)
+        return report
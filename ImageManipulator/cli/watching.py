@@ -0,0 +1,190 @@
+"""
+Watching a directory tree for new files. On Linux the kernel reports every
+file that is closed after writing or moved into the tree through inotify, so
+the tree is only walked once, when it starts being watched. Elsewhere the
+tree is walked every few seconds and compared with the last walk. Files are
+only handed on once they have been quiet for a while, so a file that is
+written in several goes is not read half written.
+"""
+import os, sys, time, errno, select, struct, ctypes, ctypes.util
+
+# inotify events, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# The header of each event read from an inotify descriptor
+EVENT_HEADER = struct.Struct('iIII')
+
+def walk_files(directory):
+    """ :return: A generator of the paths of the files under directory. """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+
+class InotifyWatcher(object):
+    """
+    Watches a directory tree with inotify, adding a watch to every directory
+    in it, including those created or moved in later.
+    """
+    def __init__(self, directory):
+        """
+        :param directory: The root of the tree to watch.
+        :raises OSError: If inotify is not available.
+        """
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.directory = directory
+        self.paths = {}
+        self.add_tree(directory)
+
+    def add_tree(self, directory):
+        """
+        Effect: watches directory and every directory under it.
+
+        :return: The paths of the files already in them.
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            self.add_watch(dirpath)
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+        return files
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # the directory may be gone again already
+            if error not in [errno.ENOENT, errno.ENOTDIR]:
+                raise OSError(error, 'inotify_add_watch failed', directory)
+            return
+        self.paths[wd] = directory
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for files to be written.
+
+        :param timeout: The most seconds to wait.
+        :return: The paths of the files closed after writing or moved in, and
+        of the files in directories moved in.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+
+        files = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so look at everything again
+                files.extend(walk_files(self.directory))
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                path = os.path.join(self.paths[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        files.extend(self.add_tree(path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    files.append(path)
+        return files
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Watches a directory tree by walking it every interval seconds, reporting
+    the files that are new or have changed size or modification time since
+    the last walk.
+    """
+    def __init__(self, directory, interval):
+        """
+        :param directory: The root of the tree to watch.
+        :param interval: The number of seconds between walks.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.stats = {}
+        self.last_walk = 0
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds, or until the next walk is due.
+
+        :return: The paths of the files that are new or changed.
+        """
+        wait = self.last_walk + self.interval - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self.last_walk = time.time()
+
+        stats, files = {}, []
+        for path in walk_files(self.directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime)
+            if self.stats.get(path) != stats[path]:
+                files.append(path)
+        self.stats = stats
+        return files
+
+    def close(self):
+        pass
+
+def get_watcher(directory, interval):
+    """
+    :param directory: The root of the tree to watch.
+    :param interval: The seconds between walks, if inotify is not available.
+    :return: An InotifyWatcher, or a PollingWatcher if inotify is not
+    available.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        return PollingWatcher(directory, interval)
+
+class Debouncer(object):
+    """
+    Holds back files until delay seconds have passed since they were last
+    reported.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.reported = {}
+
+    def add(self, path):
+        """ Effect: records that path was just written. """
+        self.reported[path] = time.time()
+
+    def pop_ready(self):
+        """
+        :return: The paths that have not been written for delay seconds,
+        which are forgotten.
+        """
+        now = time.time()
+        ready = [path for path, reported in self.reported.items()
+                 if now - reported >= self.delay]
+        for path in ready:
+            del self.reported[path]
+        return sorted(ready)
@@ -0,0 +1,198 @@
+"""
+Garbage collection of uploads and generated results. Accesses to results are
+recorded in memory and written to the DB by the collector thread, which then
+deletes the least recently accessed Images in small batches while the disk
+usage is over quota or they have not been accessed for longer than the TTL.
+Images whose job is queued or running are never deleted; jobs active for
+longer than JOB_TIMEOUT that no queue or worker holds, like those left behind
+by a restart, are failed so their Images can be.
+"""
+import os, re, time, datetime, threading
+from sqlalchemy import or_
+from . import app, db, cache, image_storage
+from .models import Image, CachedResult, ACTIVE_STATUSES, FAILED
+from .dispatcher import dispatcher
+from .workers import registry
+from .uploads import get_preview_name
+
+UUID_PREFIX = re.compile(
+    '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+_accesses = {}
+_accesses_lock = threading.Lock()
+
+def record_access(filename=None, image_id=None):
+    """
+    Effect: records that a file or an Image was accessed just now. This is
+    cheap enough to call on every request; the access is written to the DB by
+    the collector.
+
+    :param filename: The name of an uploaded or generated file.
+    :param image_id: The id of an Image.
+    """
+    if image_id is not None:
+        try:
+            key = ('id', int(image_id))
+        except ValueError:
+            # not the id of any Image
+            return
+    elif UUID_PREFIX.match(filename):
+        # results are named after the uuid of their job
+        key = ('job', UUID_PREFIX.match(filename).group())
+    else:
+        key = ('source', filename)
+    with _accesses_lock:
+        _accesses[key] = datetime.datetime.utcnow()
+
+def flush_accesses():
+    """
+    Effect: writes the accesses recorded since the last flush to the DB.
+    """
+    global _accesses
+    with _accesses_lock:
+        accesses, _accesses = _accesses, {}
+
+    for (kind, value), accessed in accesses.items():
+        if kind == 'id':
+            query = Image.query.filter_by(id=value)
+        elif kind == 'job':
+            query = Image.query.filter(Image.filename.like(value + '%'))
+        else:
+            query = Image.query.filter_by(source_filename=value)
+        query = query.filter(or_(Image.last_accessed == None,
+                                 Image.last_accessed < accessed))
+        query.update({'last_accessed': accessed}, synchronize_session=False)
+    db.session.commit()
+
+def get_disk_usage():
+    """
+    :return: The number of bytes taken up by uploads and results, as recorded
+    in the DB.
+    """
+    sources = (db.session.query(Image.source_filename, Image.n_bytes)
+        .distinct().subquery())
+    source_bytes = db.session.query(db.func.sum(sources.c.n_bytes)).scalar()
+    # the results of Images linked to a cached result are counted with it
+    results_bytes = (db.session.query(db.func.sum(Image.results_bytes))
+        .filter(Image.cache_key == None).scalar())
+    cached_bytes = db.session.query(db.func.sum(CachedResult.n_bytes)).scalar()
+    return (source_bytes or 0) + (results_bytes or 0) + (cached_bytes or 0)
+
+def collect(quota, ttl, batch_size):
+    """
+    Deletes at most batch_size of the least recently accessed Images, for as
+    long as the disk usage is over quota or they have expired.
+
+    :param quota: The number of bytes uploads and results may take up.
+    :param ttl: The number of seconds an Image is kept after its last access.
+    :param batch_size: The maximum number of Images to delete.
+    :return: The number of Images deleted.
+    """
+    expire_jobs(app.config['JOB_TIMEOUT'])
+    usage = get_disk_usage()
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    candidates = (Image.query
+        .filter(or_(Image.status == None,
+                    Image.status.notin_(ACTIVE_STATUSES)))
+        .order_by(Image.last_accessed)
+        .limit(batch_size))
+
+    n_deleted = 0
+    for image in candidates:
+        if usage <= quota and image.last_accessed > expired:
+            break
+        usage -= delete_image(image)
+        n_deleted += 1
+    db.session.commit()
+
+    cache.evict(app.config['RESULT_CACHE_MAX_BYTES'] if usage <= quota else 0)
+    return n_deleted
+
+def expire_jobs(timeout):
+    """
+    Fails the jobs that have been queued or running for longer than timeout
+    seconds that no queue or worker holds, and removes what they rendered.
+    A worker kills its job after JOB_TIMEOUT, so these can not finish.
+
+    :param timeout: The number of seconds after which a job is expired.
+    :return: The number of jobs failed.
+    """
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+    images = (Image.query
+        .filter(Image.status.in_(ACTIVE_STATUSES))
+        .filter(or_(Image.started == None, Image.started < stale)))
+
+    n_expired = 0
+    for image in images:
+        if dispatcher.is_queued(image.id) or registry.is_claimed(image.id):
+            continue
+        image.status = FAILED
+        image.error = 'The job failed'
+        image_storage.remove_prefixed(os.path.splitext(image.filename)[0])
+        n_expired += 1
+    db.session.commit()
+    return n_expired
+
+def delete_image(image):
+    """
+    Effect: deletes an Image and the files that no other Image shares.
+
+    :param image: The Image to delete.
+    :return: The number of bytes freed.
+    """
+    freed = 0
+    if image.cache_key:
+        # the files belong to the cached result, which is evicted separately
+        cache.release(image.cache_key)
+    elif image.results:
+        for name in cache.get_results_names(image.results):
+            image_storage.remove(name)
+        freed += image.results_bytes or 0
+
+    if image.source_filename and not is_source_shared(image):
+        path = image_storage.get_path(image.source_filename)
+        grace = app.config['GC_UPLOAD_GRACE']
+        # an upload of the same image may have just been deduplicated against
+        # this file, before its own Image was committed
+        if not (os.path.exists(path)
+                and os.path.getmtime(path) > time.time() - grace):
+            image_storage.remove(image.source_filename)
+            image_storage.remove(get_preview_name(image.source_filename))
+            freed += image.n_bytes or 0
+
+    db.session.delete(image)
+    return freed
+
+def is_source_shared(image):
+    """ :return: True if another Image was rendered from the same upload. """
+    return (Image.query
+        .filter(Image.source_filename == image.source_filename)
+        .filter(Image.id != image.id)
+        .first()) is not None
+
+class Collector(threading.Thread):
+    """
+    Daemon thread that flushes recorded accesses and collects garbage every
+    GC_INTERVAL seconds. Each run deletes at most GC_BATCH_SIZE Images, so a
+    run never holds the DB for long.
+    """
+    def __init__(self):
+        super(Collector, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(app.config['GC_INTERVAL'])
+            try:
+                flush_accesses()
+                collect(app.config['GC_QUOTA_BYTES'], app.config['GC_TTL'],
+                    app.config['GC_BATCH_SIZE'])
+            except Exception:
+                app.logger.exception('Garbage collection failed')
+                db.session.rollback()
+
+def start_collector():
+    """ Effect: starts the collector thread. """
+    collector = Collector()
+    collector.start()
+    return collector
@@ -0,0 +1,224 @@
+"""
+Runs manipulation jobs on fixed pools of worker threads. Jobs are scheduled
+fairly between clients: the client that has received the least work so far
+goes next, and among its jobs the cheapest goes first. Jobs age while they
+wait so expensive jobs are never starved, and cheap single frame previews
+have workers of their own so they stay fast however busy the others are.
+"""
+import time, threading
+from . import app
+from .metrics import stage_seconds
+
+# The queues a job can be submitted to
+NORMAL = 'normal'
+LOW_PRIORITY = 'low_priority'
+
+# The kinds of worker
+PREVIEW = 'preview'
+
+class Job(object):
+    """ A function to run along with what the scheduler needs to know. """
+    def __init__(self, function, args, client, cost, queue, preview,
+                 key=None):
+        self.function = function
+        self.args = args
+        self.client = client
+        self.cost = cost
+        self.queue = queue
+        self.preview = preview
+        self.key = key
+        self.submitted = time.time()
+
+    def run(self):
+        self.function(*self.args)
+
+class FairScheduler(object):
+    """
+    Holds the pending jobs of every client. Each client is charged the
+    estimated cost of its jobs as they start. The next job comes from the
+    client that has been charged the least, and is the one with the lowest
+    cost once divided by (1 + seconds waited / aging). A job that has waited
+    longer than max_wait goes before all others.
+    """
+    def __init__(self, aging, max_wait):
+        """
+        :param aging: The number of seconds of waiting that halve the
+        effective cost of a job.
+        :param max_wait: The number of seconds after which a job is run
+        before all jobs that have waited less.
+        """
+        self.aging = aging
+        self.max_wait = max_wait
+        self.pending = {}
+        self.charged = {}
+        self.condition = threading.Condition()
+
+    def push(self, job):
+        """ Effect: adds job to the pending jobs of its client. """
+        with self.condition:
+            if job.client not in self.pending and self.pending:
+                # a client coming back from idle can't have banked any credit
+                active = min(self.charged.get(client, 0.0)
+                             for client in self.pending)
+                self.charged[job.client] = max(
+                    self.charged.get(job.client, 0.0), active)
+            self.pending.setdefault(job.client, []).append(job)
+            self.condition.notify_all()
+
+    def pop(self, accept):
+        """
+        Blocks until there is a pending job that accept(job) is true for, then
+        removes and returns the next such job.
+
+        :param accept: A predicate on jobs, selecting those the caller can run.
+        :return: The Job.
+        """
+        with self.condition:
+            while True:
+                job = self.select(accept)
+                if job is not None:
+                    self.pending[job.client].remove(job)
+                    if not self.pending[job.client]:
+                        del self.pending[job.client]
+                    self.charged[job.client] = (
+                        self.charged.get(job.client, 0.0) + job.cost)
+                    if not self.pending:
+                        # nobody is waiting, so everybody starts even again
+                        self.charged.clear()
+                    return job
+                self.condition.wait()
+
+    def remove(self, predicate):
+        """
+        Removes every pending job that predicate(job) is true for.
+
+        :return: The list of removed jobs.
+        """
+        removed = []
+        with self.condition:
+            for client in list(self.pending):
+                for job in list(self.pending[client]):
+                    if predicate(job):
+                        self.pending[client].remove(job)
+                        removed.append(job)
+                if not self.pending[client]:
+                    del self.pending[client]
+        return removed
+
+    def select(self, accept):
+        now = time.time()
+        candidates = [job for jobs in self.pending.values() for job in jobs
+                      if accept(job)]
+        if not candidates:
+            return None
+
+        starved = [job for job in candidates
+                   if now - job.submitted > self.max_wait]
+        if starved:
+            return min(starved, key=lambda job: job.submitted)
+
+        client = min(set(job.client for job in candidates),
+                     key=lambda client: self.charged.get(client, 0.0))
+        return min((job for job in candidates if job.client == client),
+                   key=lambda job: (job.cost / (1.0 + (now - job.submitted)
+                                                / self.aging),
+                                    job.submitted))
+
+    def get_depth(self, accept=None):
+        """ :return: The number of pending jobs accept(job) is true for. """
+        with self.condition:
+            return len([job for jobs in self.pending.values() for job in jobs
+                        if accept is None or accept(job)])
+
+# What each kind of worker runs
+WORKER_ACCEPTS = {
+    PREVIEW: lambda job: job.preview,
+    NORMAL: lambda job: job.queue == NORMAL,
+    LOW_PRIORITY: lambda job: job.queue == LOW_PRIORITY,
+}
+
+class Dispatcher(object):
+    """
+    A FairScheduler served by pools of worker threads of each kind. Preview
+    workers only run previews, normal workers run everything on the normal
+    queue, including previews, and low priority workers only run the low
+    priority queue, so expensive jobs can never take up the normal workers.
+    The workers are started with the first job submitted.
+    """
+    def __init__(self, n_workers, aging, max_wait):
+        """
+        :param n_workers: A dictionary from kind of worker to the number of
+        worker threads of that kind.
+        :param aging: See FairScheduler.
+        :param max_wait: See FairScheduler.
+        """
+        self.n_workers = n_workers
+        self.scheduler = FairScheduler(aging, max_wait)
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submit(self, function, args, client, cost, queue=NORMAL,
+               preview=False, key=None):
+        """
+        Effect: queues function(*args) to be run by a worker.
+
+        :param function: The function to run.
+        :param args: The arguments to call function with.
+        :param client: The key of the client that submitted the job.
+        :param cost: The estimated cost of the job.
+        :param queue: NORMAL or LOW_PRIORITY.
+        :param preview: True if the job is a cheap, latency sensitive preview.
+        :param key: A key to cancel the job with.
+        :return: The Job.
+        """
+        self.start_workers()
+        job = Job(function, args, client, cost, queue,
+                  preview and queue == NORMAL, key)
+        self.scheduler.push(job)
+        return job
+
+    def cancel(self, key):
+        """
+        Effect: removes the job key from the queue, if it has not started yet.
+
+        :return: True if the job was removed.
+        """
+        return bool(self.scheduler.remove(lambda job: job.key == key))
+
+    def is_queued(self, key):
+        """ :return: True if the job key is waiting in the queue. """
+        return self.scheduler.get_depth(lambda job: job.key == key) > 0
+
+    def get_depth(self, queue=None):
+        """ :return: The number of jobs waiting in queue, or in total. """
+        return self.scheduler.get_depth(
+            None if queue is None else lambda job: job.queue == queue)
+
+    def start_workers(self):
+        with self.lock:
+            if self.workers:
+                return
+            for kind, n_workers in self.n_workers.items():
+                for i in range(n_workers):
+                    worker = threading.Thread(target=self.work,
+                        args=(WORKER_ACCEPTS[kind],))
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+
+    def work(self, accept):
+        while True:
+            job = self.scheduler.pop(accept)
+            stage_seconds.observe(time.time() - job.submitted, 'queue_wait')
+            try:
+                job.run()
+            except Exception:
+                app.logger.exception('Job failed')
+
+dispatcher = Dispatcher({
+        PREVIEW: app.config['PREVIEW_WORKER_COUNT'],
+        NORMAL: app.config['WORKER_COUNT'],
+        LOW_PRIORITY: app.config['LOW_PRIORITY_WORKER_COUNT'],
+    },
+    app.config['SCHEDULER_AGING'],
+    app.config['SCHEDULER_MAX_WAIT'])
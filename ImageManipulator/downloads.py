@@ -0,0 +1,153 @@
+import os, hashlib, mimetypes, threading
+from flask import request, send_file, Response, abort
+from . import app, image_storage
+
+# Python 2 does not know the type of animated WebP results
+mimetypes.add_type('image/webp', '.webp')
+
+# A year, the longest max-age browsers honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_etags = {}
+_etags_lock = threading.Lock()
+
+def get_file_etag(path):
+    """
+    Computes the strong ETag of a file, which is the SHA-1 of its contents.
+    ETags are remembered by path, size and modification time so that each
+    file is only hashed once.
+
+    :param path: The path of the file.
+    :return: The ETag as a hex string.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime)
+    with _etags_lock:
+        cached = _etags.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+
+    with _etags_lock:
+        if len(_etags) >= app.config['ETAG_CACHE_SIZE']:
+            _etags.clear()
+        _etags[path] = (signature, etag)
+    return etag
+
+def get_image_path(filename):
+    """
+    :param filename: The name of an uploaded or generated image.
+    :return: The path to the file, or None if filename is not a file in the
+    image directory.
+    """
+    if filename != os.path.basename(filename) or filename.startswith('.'):
+        return None
+    path = image_storage.get_path(filename)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+def send_image(filename):
+    """
+    Sends an uploaded or generated image. The transfer is handed off to the
+    front proxy if one is configured in SENDFILE_BACKEND, otherwise the file
+    is sent from here with support for Range requests. The ETag is the SHA-1
+    of the file, and requests that name it in the 'v' query parameter are
+    cached forever, since a URL with a content hash in it can never change.
+
+    :param filename: The name of the image.
+    :return: The response.
+    """
+    path = get_image_path(filename)
+    if path is None:
+        abort(404)
+
+    etag = get_file_etag(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    backend = app.config['SENDFILE_BACKEND']
+
+    if backend == 'nginx':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = (
+            app.config['ACCEL_REDIRECT_PREFIX']
+            + os.path.relpath(path, app.config['IMAGE_DIR']))
+    elif backend == 'apache':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = path
+    else:
+        response = send_range(path, mimetype, etag)
+        if response is None:
+            response = send_file(path, mimetype=mimetype, add_etags=False,
+                conditional=False, cache_timeout=None)
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    response.set_etag(etag)
+    if request.args.get('v') == etag:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.headers['Cache-Control'] += ', immutable'
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+
+    if response.status_code == 200:
+        response.make_conditional(request)
+    return response
+
+def send_range(path, mimetype, etag):
+    """
+    Sends the part of a file requested with a Range header.
+
+    :param path: The path of the file.
+    :param mimetype: The mimetype of the file.
+    :param etag: The ETag of the file, to check If-Range against.
+    :return: A 206 response, a 416 response if a single range can not be
+    satisfied, or None if the whole file should be sent.
+    """
+    if request.range is None:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range.strip('"') != etag:
+        return None
+
+    # werkzeug only serves single ranges, so a request for several gets
+    # the whole file
+    if len(request.range.ranges) != 1:
+        return None
+    length = os.path.getsize(path)
+    byte_range = request.range.range_for_length(length)
+    if byte_range is None:
+        response = Response(status=416)
+        response.headers['Content-Range'] = 'bytes */{}'.format(length)
+        return response
+
+    start, stop = byte_range
+    f = open(path, 'rb')
+    f.seek(start)
+    response = Response(read_chunks(f, stop - start), status=206,
+        mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stop - start
+    response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start,
+        stop - 1, length)
+    return response
+
+def read_chunks(f, n_bytes):
+    """
+    Generates the next n_bytes of the file f in chunks, then closes it.
+    """
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    try:
+        while n_bytes > 0:
+            chunk = f.read(min(chunk_size, n_bytes))
+            if not chunk:
+                break
+            n_bytes -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
@@ -2,13 +2,18 @@ from flask_wtf import Form
 from wtforms import FileField, RadioField, StringField, SelectField, BooleanField, SubmitField
 from wtforms.validators import StopValidation, DataRequired
 
-import imghdr
+from .uploads import sniff_image_type
+from .cli.encoders import ENCODERS
+
+# The animation formats offered, if the installed Pillow can write them
+OUTPUT_FORMATS = [('gif', 'GIF'), ('webp', 'WebP')]
 
 class ImageFileRequired(object):
     """
     Validates that an uploaded file from a flask_wtf FileField is, in fact an
     image.  Better than checking the file extension, examines the header of
-    the image using Python's built in imghdr module.
+    the image using Python's built in imghdr module. Only the header is read,
+    so the upload is never pulled into memory in full.
 
     Author: https://gist.github.com/msukmanowsky/8086892
     """
@@ -17,11 +22,9 @@ class ImageFileRequired(object):
 
     def __call__(self, form, field):
         if (field.data is None
-            or imghdr.what('unused', field.data.read()) is None):
+            or sniff_image_type(field.data.stream) is None):
             raise StopValidation(self.message)
 
-        field.data.seek(0)
-
 class ImageManipulationForm(Form):
     image = FileField('image',
         validators=[ImageFileRequired(message='You must upload an image file')])
@@ -35,6 +38,15 @@ class ImageManipulationForm(Form):
     frames = StringField('frames')
     save_frames = BooleanField('save_frames')
 
+    output_format = SelectField('output_format',
+        choices=[(name, label) for name, label in OUTPUT_FORMATS
+                 if ENCODERS[name].is_available()],
+        default='gif')
+    preset = RadioField('preset',
+        choices=[('fast', 'Fast'),
+                 ('small', 'Small file')],
+        default='fast')
+
     box_shape = RadioField('box_shape',
         choices=[('square', 'Square'),
                  ('vertical', 'Vertical slices'),
@@ -44,8 +56,24 @@ class ImageManipulationForm(Form):
     rotation = SelectField('rotation',
         choices=[('none', 'None'),
                  ('flip', 'Flip'),
-                 ('ninety', 'Multiples of 90 degrees')])
+                 ('ninety', 'Multiples of 90 degrees')],
+        default='none')
     randomize = BooleanField('randomize')
     average = BooleanField('average')
+    seed = StringField('seed')
 
     submit = SubmitField('Submit')
+
+class BatchForm(ImageManipulationForm):
+    """
+    The options of a batch, which are applied to every image in it. The
+    images are uploaded under 'images', as zip archives of images or as
+    images, so the form has no image field of its own.
+    """
+    image = None
+
+class CancelForm(Form):
+    """
+    Cancels the job of a result page. It has no fields, only the CSRF token
+    the page posts back with it.
+    """
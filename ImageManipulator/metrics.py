@@ -0,0 +1,180 @@
+"""
+Metrics in the Prometheus text exposition format. Only what the app needs:
+counters, gauges read from a callback when scraped, and histograms, all with
+optional labels.
+"""
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets in seconds, from previews up to the job timeout
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60, 120, 300]
+
+class Metric(object):
+    """ The base class of the metric types. """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: The name of the metric.
+        :param help: A description of the metric.
+        :param labels: The names of the labels of the metric.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def render(self):
+        """ :return: The lines exposing the metric. """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        return lines + self.render_samples()
+
+    def render_samples(self):
+        raise NotImplementedError()
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                              for name, value in pairs) + '}'
+
+class Counter(Metric):
+    """ A value that only goes up. """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        """ Effect: adds amount to the counter with the given labels. """
+        with self.lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount)
+
+    def render_samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['{}{} {}'.format(self.name, self.format_labels(labels),
+                                 format_value(value))
+                for labels, value in values]
+
+class Gauge(Metric):
+    """ A value read from a function every time the metrics are scraped. """
+    type = 'gauge'
+
+    def __init__(self, name, help, function, labels=(), label_values=()):
+        """
+        :param function: Returns the value of the gauge when labels is empty,
+        otherwise takes the label values and returns the value for them.
+        :param label_values: The label value tuples to expose.
+        """
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+        self.label_values = label_values
+
+    def render_samples(self):
+        if not self.labels:
+            return ['{} {}'.format(self.name, format_value(self.function()))]
+        return ['{}{} {}'.format(self.name, self.format_labels(values),
+                                 format_value(self.function(*values)))
+                for values in self.label_values]
+
+class Histogram(Metric):
+    """ Counts observations into cumulative buckets. """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        """ Effect: records one observation with the given labels. """
+        with self.lock:
+            counts, total = self.values.get(label_values,
+                ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[label_values] = (counts, total + value)
+
+    def render_samples(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self.values.items())
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name,
+                    self.format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name,
+                self.format_labels(labels), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name,
+                self.format_labels(labels), cumulative))
+        return lines
+
+class Registry(object):
+    """ The metrics exposed by the app. """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """ Effect: adds metric to the registry. :return: The metric. """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ :return: All metrics in the text exposition format. """
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'imagemanipulator_stage_seconds',
+    'Time spent in each stage of a job, from queue wait to GIF encode',
+    ['stage']))
+job_seconds = registry.register(Histogram(
+    'imagemanipulator_job_seconds',
+    'Time from a worker starting a job to its end', ['status']))
+jobs_total = registry.register(Counter(
+    'imagemanipulator_jobs_total', 'Jobs that ended, by status', ['status']))
+output_bytes_total = registry.register(Counter(
+    'imagemanipulator_output_bytes_total', 'Bytes of GIFs and frames written'))
+result_cache_total = registry.register(Counter(
+    'imagemanipulator_result_cache_requests_total',
+    'Result cache lookups, by result: hit, miss or uncacheable', ['result']))
+memo_total = registry.register(Counter(
+    'imagemanipulator_memo_requests_total',
+    'Stage memo lookups in the script, by result: hit or miss', ['result']))
+
+def observe_timings(timings):
+    """
+    Effect: records the stage timings reported by the script.
+
+    :param timings: A dictionary from stage name to seconds.
+    """
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage)
@@ -1,15 +1,65 @@
+import datetime
 from . import db
 
+# The states of the job rendering an Image
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ACTIVE_STATUSES = [QUEUED, RUNNING]
+
 class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     original_filename = db.Column(db.Text, index=True)
     filename = db.Column(db.Text, index=True, unique=True)
+    source_filename = db.Column(db.Text, index=True)
     results = db.Column(db.Text, index=True)
+    content_hash = db.Column(db.String(40), index=True)
+    n_bytes = db.Column(db.Integer)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    cache_key = db.Column(db.String(40), index=True)
+    results_bytes = db.Column(db.Integer, default=0)
+    estimated_cost = db.Column(db.Float)
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.Text)
+    client = db.Column(db.String(64))
+    last_accessed = db.Column(db.DateTime, index=True)
+    # when the job was queued, and then when it started running
+    started = db.Column(db.DateTime, index=True)
 
     def __init__(self, original_filename, filename, results):
         self.original_filename = original_filename
         self.filename = filename
         self.results = results
+        self.status = QUEUED
+        self.results_bytes = 0
+        self.last_accessed = datetime.datetime.utcnow()
+        self.started = self.last_accessed
 
     def __repr__(self):
         return '<Image %r>' % self.filename
+
+class CachedResult(db.Model):
+    """
+    A rendered result that can be shared by every Image uploaded with the same
+    content and options. refcount is the number of Images linked to the
+    result, the files are only removed once it drops to zero.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(40), index=True, unique=True)
+    results = db.Column(db.Text)
+    n_bytes = db.Column(db.Integer, default=0)
+    refcount = db.Column(db.Integer, default=0)
+    last_used = db.Column(db.DateTime, index=True)
+
+    def __init__(self, key, results, n_bytes):
+        self.key = key
+        self.results = results
+        self.n_bytes = n_bytes
+        self.refcount = 0
+        self.last_used = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        return '<CachedResult %r>' % self.key
@@ -5,14 +5,17 @@ $(document).ready(function() {
             $('#box-size-form').hide();
             $('#frames-form').hide();
             $('#save-frames-form').show();
+            $('#output-format-form').show();
         } else if (val == 'one_frame') {
             $('#box-size-form').show();
             $('#frames-form').hide();
             $('#save-frames-form').hide();
+            $('#output-format-form').hide();
         } else {
             $('#box-size-form').show();
             $('#frames-form').show();
             $('#save-frames-form').show();
+            $('#output-format-form').show();
         }
     }
     $('#animation-form input:radio').click(updateBoxAndFrameOptions);
@@ -0,0 +1,262 @@
+import os, uuid, hashlib, imghdr, struct
+
+# imghdr never looks further than the first 32 bytes of a file
+HEADER_SIZE = 32
+
+def read_header(stream):
+    """
+    Reads just enough bytes from the start of stream to identify the type of
+    image it contains, then rewinds the stream.
+
+    :param stream: A seekable file-like object.
+    :return: The header bytes.
+    """
+    header = stream.read(HEADER_SIZE)
+    stream.seek(0)
+    return header
+
+def sniff_header_type(header):
+    """
+    :param header: The first HEADER_SIZE bytes of a file.
+    :return: The image type as returned by imghdr (e.g. 'png', 'jpeg') or None
+    if the header is not that of an image.
+    """
+    return imghdr.what('unused', header)
+
+def sniff_image_type(stream):
+    """
+    Determines the type of the image in stream by examining only its header.
+
+    :param stream: A seekable file-like object.
+    :return: The image type as returned by imghdr (e.g. 'png', 'jpeg') or None
+    if the stream does not contain an image.
+    """
+    return sniff_header_type(read_header(stream))
+
+class HeaderSizeReader(object):
+    """
+    Incrementally parses the dimensions of an image out of the chunks of a file
+    as they are streamed past it. PNG, GIF and BMP store their size at a fixed
+    offset in the first few bytes, JPEG stores it in the first SOFn marker
+    segment, which usually follows the (possibly large) EXIF segment.
+    """
+    # Never buffer more than this many bytes looking for a size
+    MAX_BUFFER = 1024 * 1024
+
+    def __init__(self):
+        self.buffer = b''
+        self.size = None
+        self.done = False
+
+    def feed(self, chunk):
+        """
+        Feeds the next chunk of the file to the parser.
+
+        :param chunk: The next bytes of the file.
+        """
+        if self.done:
+            return
+        self.buffer += chunk
+        self.size = self.parse(self.buffer)
+        if self.size is not None or len(self.buffer) >= self.MAX_BUFFER:
+            self.done = True
+            self.buffer = b''
+
+    def parse(self, data):
+        """
+        :param data: The first bytes of the file.
+        :return: A tuple (width, height) or None if data does not contain the
+        size (yet).
+        """
+        if data[:8] == b'\x89PNG\r\n\x1a\n':
+            if len(data) >= 24:
+                return struct.unpack('>II', data[16:24])
+        elif data[:6] in (b'GIF87a', b'GIF89a'):
+            if len(data) >= 10:
+                return struct.unpack('<HH', data[6:10])
+        elif data[:2] == b'BM':
+            if len(data) >= 26:
+                width, height = struct.unpack('<ii', data[18:26])
+                return width, abs(height)
+        elif data[:2] == b'\xff\xd8':
+            return self.parse_jpeg(data)
+        return None
+
+    def parse_jpeg(self, data):
+        """
+        Walks the JPEG marker segments in data until a SOFn segment is found.
+
+        :param data: The first bytes of a JPEG file.
+        :return: A tuple (width, height) or None if the SOFn segment has not
+        been reached yet.
+        """
+        i = 2
+        while i + 4 <= len(data):
+            if data[i:i + 1] != b'\xff':
+                return None
+            marker = ord(data[i + 1:i + 2])
+            if marker == 0xff:
+                # fill byte
+                i += 1
+                continue
+            length = struct.unpack('>H', data[i + 2:i + 4])[0]
+            if (0xc0 <= marker <= 0xcf
+                and marker not in (0xc4, 0xc8, 0xcc)):
+                if i + 9 > len(data):
+                    return None
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+        return None
+
+def probe_image_size(stream, chunk_size):
+    """
+    Reads the dimensions of the image in stream from its header, reading no
+    more of the stream than needed, then rewinds the stream.
+
+    :param stream: A seekable file-like object.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: A tuple (width, height) or None if the size could not be found.
+    """
+    size_reader = HeaderSizeReader()
+    while not size_reader.done:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size_reader.feed(chunk)
+    stream.seek(0)
+    if size_reader.size is not None:
+        return size_reader.size
+
+    # formats HeaderSizeReader does not know, PIL only reads the header too
+    try:
+        from PIL import Image
+        size = Image.open(stream).size
+    except Exception:
+        size = None
+    stream.seek(0)
+    return size
+
+def probe_frame_count(stream, max_frames):
+    """
+    Counts the frames of an animated image by seeking through them, which
+    reads the data of each frame but decodes none of them, then rewinds the
+    stream.
+
+    :param stream: A seekable file-like object.
+    :param max_frames: The most frames to count, so that a huge animation
+    is not read to its end.
+    :return: The number of frames, at most max_frames, or 1 if the image is
+    not animated or could not be read.
+    """
+    n_frames = 1
+    try:
+        from PIL import Image
+        image = Image.open(stream)
+        while n_frames < max_frames:
+            image.seek(n_frames)
+            n_frames += 1
+    except Exception:
+        # EOFError after the last frame, or a format with only one
+        pass
+    stream.seek(0)
+    return n_frames
+
+def save_upload(stream, file_path, chunk_size):
+    """
+    Streams an upload to disk in chunks, hashing it and reading the image
+    dimensions from its header on the way through, so that the upload never
+    has to be held in memory in full.
+
+    :param stream: The file-like object to read the upload from.
+    :param file_path: The path to save the upload to.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: A tuple (content_hash, n_bytes, size); where content_hash is the
+    hex SHA-1 of the upload, n_bytes is its length and size is a tuple
+    (width, height) or None if it could not be read from the header.
+    """
+    digest = hashlib.sha1()
+    size_reader = HeaderSizeReader()
+    n_bytes = 0
+    with open(file_path, 'wb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size_reader.feed(chunk)
+            f.write(chunk)
+            n_bytes += len(chunk)
+    return digest.hexdigest(), n_bytes, size_reader.size
+
+def store_upload(stream, storage, ext, chunk_size):
+    """
+    Saves an upload in storage under its content hash, so that the same image
+    uploaded again is only stored once.
+
+    :param stream: The file-like object to read the upload from.
+    :param storage: The storage to save the upload in.
+    :param ext: The extension to give the saved file, including the dot.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: A tuple (name, content_hash, n_bytes, size); where name is the
+    name of the saved file, and the rest are as returned by save_upload.
+    """
+    tmp_path = os.path.join(storage.root, '.upload-{}{}'.format(uuid.uuid4(),
+        ext))
+    try:
+        content_hash, n_bytes, size = save_upload(stream, tmp_path, chunk_size)
+        name = content_hash + ext
+        if storage.exists(name):
+            os.remove(tmp_path)
+            # keep the garbage collector off the file until it is referenced
+            os.utime(storage.get_path(name), None)
+        else:
+            os.rename(tmp_path, storage.get_save_path(name))
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return name, content_hash, n_bytes, size
+
+def get_preview_name(name):
+    """
+    :param name: The name of a stored upload.
+    :return: The name of its reduced preview.
+    """
+    base, _ = os.path.splitext(name)
+    return base + '-preview.jpeg'
+
+def make_preview(storage, name, width):
+    """
+    Saves a reduced copy of a stored upload to show while its job runs, if
+    the upload is wider than width and its format can be decoded at a reduced
+    resolution, which keeps making the preview cheap enough to do while
+    handling the upload.
+
+    :param storage: The storage the upload is in.
+    :param name: The name of the upload.
+    :param width: The width of the preview.
+    :return: The name of the preview, or name if there is none.
+    """
+    from PIL import Image
+    from .cli.resizing import get_resized_size, draft, resize
+
+    preview_name = get_preview_name(name)
+    if storage.exists(preview_name):
+        return preview_name
+    tmp_path = os.path.join(storage.root, '.preview-{}.jpeg'.format(
+        uuid.uuid4()))
+    try:
+        image = Image.open(storage.get_path(name))
+        if image.size[0] <= width:
+            return name
+        size = get_resized_size(image.size, (width, 0))
+        if not draft(image, size):
+            return name
+        resize(image, size).save(tmp_path, 'JPEG', quality=85)
+        os.rename(tmp_path, storage.get_save_path(preview_name))
+    except (IOError, ValueError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return name
+    return preview_name
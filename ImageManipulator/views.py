@@ -1,8 +1,18 @@
-import os, subprocess, json, uuid, threading
-from flask import render_template, send_from_directory, url_for, jsonify
-from . import app, db
-from .forms import ImageManipulationForm
-from .models import Image
+import os, json, uuid, time, datetime, zipfile
+from flask import (render_template, send_from_directory, url_for, jsonify,
+    request, session, abort, Response, stream_with_context, g)
+from . import app, db, cache, image_storage, metrics
+from .forms import ImageManipulationForm, BatchForm, CancelForm
+from .models import (Image, QUEUED, RUNNING, DONE, FAILED, CANCELLED,
+    ACTIVE_STATUSES)
+from .collector import record_access, UUID_PREFIX
+from .uploads import (store_upload, probe_image_size, probe_frame_count,
+    make_preview, sniff_header_type, HEADER_SIZE)
+from .archives import is_zip, iter_members, ZipStream
+from .admission import admit, AdmissionError, ACCEPT
+from .dispatcher import dispatcher, NORMAL, LOW_PRIORITY
+from .workers import registry, run_script, JobCancelled, JobFailed
+from .downloads import send_image, get_image_path, get_file_etag
 
 @app.route('/', methods=['GET', 'POST'])
 def start():
@@ -10,67 +20,560 @@ def start():
 
     if form.validate_on_submit():
         old_filename = form.image.data.filename
-        _, ext = os.path.splitext(old_filename)
-        filename = str(uuid.uuid4()) + ext
-        image = Image(old_filename, filename, '')
-        db.session.add(image)
-        db.session.commit()
+        ext = get_upload_ext(old_filename)
+
+        # estimate the cost of the job from the image header before anything
+        # is saved or queued
+        size = probe_image_size(form.image.data.stream,
+            app.config['UPLOAD_CHUNK_SIZE'])
+        if size is None:
+            form.image.errors.append('Could not read the size of the image')
+            return render_template('index.html', form=form)
+        n_frames = probe_frame_count(form.image.data.stream,
+            app.config['ADMISSION_MAX_FRAMES'] + 1)
+        try:
+            decision, arguments, cost = admit(size[0], size[1],
+                get_cli_arguments(form), app.config, n_frames)
+        except AdmissionError as e:
+            form.image.errors.append(str(e))
+            return render_template('index.html', form=form)
+
+        # stream the upload to disk under its content hash
+        upload = store_upload(form.image.data.stream, image_storage, ext,
+            app.config['UPLOAD_CHUNK_SIZE'])
+        source_filename, content_hash = upload[:2]
+        preview_filename = make_preview(image_storage, source_filename,
+            app.config['PREVIEW_IMAGE_WIDTH'])
 
-        file_path = os.path.join(app.config['IMAGE_DIR'], filename)
-        form.image.data.save(file_path)
-        start_image_processing_and_update_files(file_path, form, image.id)
+        image = queue_image(old_filename, ext, upload, size, n_frames, form,
+            decision, arguments, cost)
 
-        return render_template('result.html', preview_filename=filename,
-            old_filename=old_filename, image_id=image.id)
+        return render_template('result.html', cancel_form=CancelForm(),
+            preview_filename=preview_filename,
+            preview_version=content_hash, old_filename=old_filename,
+            image_id=image.id)
 
     return render_template('index.html', form=form)
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Renders every image uploaded under 'images', each either an image or a
+    zip archive of images, with the options of a BatchForm. The response is a
+    zip of the results, streamed as each job finishes, that ends with
+    manifest.json listing what became of every image. The images are stored
+    and queued one at a time as the response is streamed, not before it.
+    """
+    form = BatchForm(csrf_enabled=False)
+    if not form.validate_on_submit():
+        return jsonify(errors=form.errors), 400
+
+    uploads = list(iter_batch_uploads(request.files.getlist('images')))
+    if not uploads:
+        return jsonify(errors={'images': ['No images were uploaded']}), 400
+    if len(uploads) > app.config['BATCH_MAX_IMAGES']:
+        return jsonify(errors={'images': ['A batch can have at most {} images'
+            .format(app.config['BATCH_MAX_IMAGES'])]}), 400
+    # the sizes of zip members are checked before they are inflated to disk
+    if (sum(n_bytes for _, n_bytes, _ in uploads)
+        > app.config['BATCH_MAX_TOTAL_BYTES']):
+        return jsonify(errors={'images': ['A batch can have at most {} MB of '
+            'images'.format(app.config['BATCH_MAX_TOTAL_BYTES'] // 2 ** 20)]
+            }), 400
+
+    # the jobs are queued under the key of the client from this request, and
+    # a new client has to be given its id before the response starts
+    get_client_key()
+    client_id = getattr(g, 'client_id', None)
+    results = stream_with_context(stream_batch_results(uploads, form))
+    # pushing the request context again reopens the session from the cookie,
+    # which drops the id just given to a new client
+    if client_id is not None:
+        session['client_id'] = client_id
+    response = Response(results, mimetype='application/zip',
+        direct_passthrough=True)
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=results.zip')
+    return response
+
 @app.route('/_results/<image_id>', methods=['GET'])
 def send_results(image_id):
+    record_access(image_id=image_id)
     image = Image.query.filter_by(id=image_id).first()
-    if image is not None and image.results:
-        return jsonify(**json.loads(image.results))
-    else:
+    if image is None:
+        return ''
+    if image.status in ACTIVE_STATUSES:
+        registry.poll(image.id)
         return ''
+    if image.status in [FAILED, CANCELLED]:
+        return jsonify(status=image.status, error=image.error)
+    if image.results:
+        results = json.loads(image.results)
+        results['versions'] = get_versions(
+            [results['gif']] + results['frames'])
+        results['status'] = DONE
+        return jsonify(**results)
+    return ''
+
+@app.route('/_cancel/<int:image_id>', methods=['POST'])
+def cancel(image_id):
+    if not CancelForm().validate_on_submit():
+        abort(400)
+    image = Image.query.filter_by(id=image_id).first()
+    if image is None:
+        abort(404)
+    if image.client not in [session.get('client_id'), request.remote_addr]:
+        abort(403)
+    cancel_job(image_id)
+    image = Image.query.filter_by(id=image_id).first()
+    return jsonify(status=image.status)
+
+@app.route('/images/<filename>', methods=['GET'])
+def download(filename):
+    record_access(filename=filename)
+    return send_image(filename)
+
+@app.route('/metrics', methods=['GET'])
+def send_metrics():
+    return Response(metrics.registry.render(),
+                    content_type=metrics.CONTENT_TYPE)
+
+metrics.registry.register(metrics.Gauge('imagemanipulator_queue_depth',
+    'Jobs waiting to be run, by queue', dispatcher.get_depth, ['queue'],
+    [(NORMAL,), (LOW_PRIORITY,)]))
+metrics.registry.register(metrics.Gauge('imagemanipulator_active_workers',
+    'Worker processes running a job', lambda: len(registry.processes)))
+metrics.registry.register(metrics.Gauge('imagemanipulator_images',
+    'Images in the DB, by status',
+    lambda status: Image.query.filter_by(status=status).count(), ['status'],
+    [(status,) for status in [QUEUED, RUNNING, DONE, FAILED, CANCELLED]]))
+
+def get_upload_ext(filename):
+    """
+    :param filename: The name of an uploaded image.
+    :return: The extension to save it with, including the dot.
+    """
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext == '.jpg':
+        ext = '.jpeg'
+    return ext
+
+def queue_image(old_filename, ext, upload, size, n_frames, form, decision,
+                arguments, cost):
+    """
+    Adds an Image for a stored upload to the DB, and queues the job that
+    renders it. If the same image has been rendered with the same options
+    before, the Image is linked to that result instead.
+
+    :param old_filename: The name the image was uploaded under.
+    :param ext: The extension of the stored upload.
+    :param upload: The tuple (name, content_hash, n_bytes, ...) returned by
+    store_upload.
+    :param size: The (width, height) of the image.
+    :param n_frames: The number of frames of the image.
+    :param form: The form with the options of the job.
+    :param decision, arguments, cost: As returned by admit.
+    :return: The Image.
+    """
+    source_filename, content_hash, n_bytes = upload[:3]
+    file_path = image_storage.get_path(source_filename)
+
+    image = Image(old_filename, str(uuid.uuid4()) + ext, '')
+    image.source_filename = source_filename
+    image.content_hash = content_hash
+    image.n_bytes = n_bytes
+    image.width, image.height = size
+    image.estimated_cost = cost
+    image.client = get_client_key()
+    db.session.add(image)
+
+    # the same image with the same options has been rendered before, so
+    # link to that result instead of rendering it again
+    seed = get_seed(form)
+    cache_key = cache.get_cache_key(content_hash, arguments, seed)
+    entry = cache.lookup(cache_key)
+    if entry is not None:
+        cache.link(image, entry)
+    metrics.result_cache_total.inc(1, 'uncacheable' if cache_key is None
+        else 'miss' if entry is None else 'hit')
+    db.session.commit()
+
+    if entry is None:
+        if seed is not None:
+            arguments = arguments + ['--seed', str(seed)]
+        queue = NORMAL if decision == ACCEPT else LOW_PRIORITY
+        # an animated image renders all of its frames whatever the options
+        preview = (form.animation.data == 'one_frame' and n_frames == 1
+                   and cost <= app.config['PREVIEW_MAX_COST'])
+        start_image_processing_and_update_files(file_path, arguments,
+            image.id, cache_key, queue, image.client, cost, preview)
+    return image
+
+def iter_batch_uploads(files):
+    """
+    Generates the images of a batch, reading zip archives a member at a time.
+
+    :param files: The uploaded FileStorages.
+    :return: A generator of tuples (name, n_bytes, open_upload); where
+    n_bytes is the size of the image and open_upload() returns a file-like
+    object reading the image from its start.
+    """
+    for upload in files:
+        if is_zip(upload.stream):
+            for member in iter_members(upload.stream):
+                yield member
+        else:
+            def open_upload(stream=upload.stream):
+                stream.seek(0)
+                return stream
+            upload.stream.seek(0, os.SEEK_END)
+            n_bytes = upload.stream.tell()
+            upload.stream.seek(0)
+            yield upload.filename, n_bytes, open_upload
+
+def start_batch_image(index, name, n_bytes, open_upload, form):
+    """
+    Stores an image of a batch and queues its job, unless it is not an image
+    or admission rejects it.
+
+    :param index: The position of the image in the batch.
+    :param name: The name the image was uploaded under.
+    :param n_bytes: The size of the image.
+    :param open_upload: A function returning a file-like object reading the
+    image from its start.
+    :param form: The BatchForm with the options of the batch.
+    :return: The entry of the image in the manifest, a dictionary with the
+    name of the image, the prefix its results are saved under, and either
+    the image_id of its Image or the error that kept it from being queued.
+    """
+    base, _ = os.path.splitext(name)
+    entry = {'name': name, 'prefix': '{:04d}-{}'.format(index, base),
+             'image_id': None, 'files': []}
+    if n_bytes > app.config['BATCH_MAX_IMAGE_BYTES']:
+        entry['status'] = FAILED
+        entry['error'] = 'Images can be at most {} MB'.format(
+            app.config['BATCH_MAX_IMAGE_BYTES'] // 2 ** 20)
+        return entry
+    try:
+        header = open_upload().read(HEADER_SIZE)
+    except (IOError, zipfile.BadZipfile):
+        header = b''
+    if sniff_header_type(header) is None:
+        entry['status'], entry['error'] = FAILED, 'Not an image file'
+        return entry
+
+    # members of a zip can not be rewound, so the size is read on the way to
+    # disk rather than before
+    ext = get_upload_ext(name)
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    try:
+        upload = store_upload(open_upload(), image_storage, ext, chunk_size)
+    except (IOError, zipfile.BadZipfile):
+        entry['status'], entry['error'] = FAILED, 'Could not read the image'
+        return entry
+    size = upload[3]
+    with open(image_storage.get_path(upload[0]), 'rb') as f:
+        if size is None:
+            size = probe_image_size(f, chunk_size)
+        n_frames = probe_frame_count(f,
+            app.config['ADMISSION_MAX_FRAMES'] + 1)
+    if size is None:
+        entry['status'] = FAILED
+        entry['error'] = 'Could not read the size of the image'
+        return entry
+    try:
+        decision, arguments, cost = admit(size[0], size[1],
+            get_cli_arguments(form), app.config, n_frames)
+    except AdmissionError as e:
+        entry['status'], entry['error'] = FAILED, str(e)
+        return entry
+
+    image = queue_image(name, ext, upload, size, n_frames, form, decision,
+        arguments, cost)
+    entry['image_id'] = image.id
+    return entry
+
+def stream_batch_results(uploads, form):
+    """
+    Starts the jobs of a batch one image at a time and writes the results of
+    each to a zip as soon as it finishes, including while later images are
+    still being started, then ends the zip with the manifest. Jobs still
+    running when the client goes away are cancelled, and the images not
+    started yet are dropped.
+
+    :param uploads: The tuples (name, n_bytes, open_upload) generated by
+    iter_batch_uploads.
+    :param form: The BatchForm with the options of the batch.
+    :return: A generator of the chunks of the zip.
+    """
+    interval = app.config['BATCH_POLL_INTERVAL']
+    archive = ZipStream()
+    entries, pending = [], {}
+    try:
+        polled = time.time()
+        for index, (name, n_bytes, open_upload) in enumerate(uploads):
+            entry = start_batch_image(index, name, n_bytes, open_upload, form)
+            entries.append(entry)
+            if entry['image_id'] is not None:
+                pending[entry['image_id']] = entry
+                registry.poll(entry['image_id'])
+            if time.time() - polled >= interval:
+                for chunk in iter_finished_results(pending, archive):
+                    yield chunk
+                polled = time.time()
+
+        while True:
+            for chunk in iter_finished_results(pending, archive):
+                yield chunk
+            if not pending:
+                break
+            time.sleep(interval)
+
+        manifest = [dict((key, entry.get(key)) for key in
+                         ['name', 'status', 'error', 'files'])
+                    for entry in entries]
+        archive.add_bytes('manifest.json', json.dumps(manifest, indent=2))
+        archive.close()
+        yield archive.read()
+    finally:
+        for image_id in pending:
+            cancel_job(image_id)
+
+def iter_finished_results(pending, archive):
+    """
+    Writes the results of the finished jobs of a batch to its zip, and
+    records what became of them in their manifest entries.
+
+    :param pending: A dictionary from the id of each Image that was still
+    being rendered to its manifest entry, which the finished ones are
+    removed from.
+    :param archive: The ZipStream of the batch.
+    :return: A generator of the chunks of the zip.
+    """
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    # the jobs update their Images in other sessions
+    db.session.expire_all()
+    for image_id, entry in pending.items():
+        image = Image.query.filter_by(id=image_id).first()
+        if image is not None and image.status in ACTIVE_STATUSES:
+            registry.poll(image_id)
+            continue
+        del pending[image_id]
+        if image is None:
+            entry['status'], entry['error'] = FAILED, 'Deleted'
+            continue
+        entry['status'], entry['error'] = image.status, image.error
+        if image.status != DONE:
+            continue
+
+        record_access(image_id=image_id)
+        results = json.loads(image.results)
+        for filename in [results['gif']] + results['frames']:
+            path = filename and get_image_path(filename)
+            if not path:
+                continue
+            name = get_batch_result_name(entry['prefix'], filename)
+            entry['files'].append(name)
+            for chunk in archive.add_file(path, name, chunk_size):
+                yield chunk
+
+def get_batch_result_name(prefix, filename):
+    """
+    :param prefix: The name the results of an image are saved under in the
+    zip of a batch.
+    :param filename: The name of a result, which starts with the uuid of the
+    job that rendered it.
+    :return: The name of the result in the zip.
+    """
+    match = UUID_PREFIX.match(filename)
+    return prefix + (filename[match.end():] if match else '-' + filename)
 
-def start_image_processing_and_update_files(file_path, form, image_id):
+def get_versions(filenames):
+    """
+    :param filenames: A list of names of images, empty names are ignored.
+    :return: A dictionary from each filename to the ETag of the file, for
+    building URLs that can be cached forever.
     """
-    This method starts the image manipulation method in the background.
+    versions = {}
+    for filename in filenames:
+        path = filename and get_image_path(filename)
+        if path:
+            versions[filename] = get_file_etag(path)
+    return versions
+
+def start_image_processing_and_update_files(file_path, arguments, image_id,
+                                            cache_key=None, queue=NORMAL,
+                                            client=None, cost=0.0,
+                                            preview=False):
+    """
+    This method queues the image manipulation method to run in the
+    background.
 
     :param file_path: Argument to pass to manipulate_image, the path to the
     image to manipulate.
-    :param form: Argument to pass to manipulate_image, the form with
-    configuration options.
+    :param arguments: Argument to pass to manipulate_image, the command line
+    arguments for the configuration options.
     :param image_id: The id of the Image in the DB.
+    :param cache_key: The key to cache the result under, or None if the
+    result can not be cached.
+    :param queue: The dispatcher queue to run the job on.
+    :param client: The key of the client the job is scheduled fairly for.
+    :param cost: The estimated cost of the job.
+    :param preview: True if the job is a single frame preview.
+    """
+    dispatcher.submit(manipulate_image,
+        (file_path, arguments, image_id, cache_key), client, cost, queue,
+        preview, image_id)
+
+def cancel_job(image_id):
     """
-    thread = threading.Thread(target=manipulate_image,
-        args=(file_path, form, image_id))
-    thread.daemon = True
-    thread.start()
+    Cancels the job rendering an Image. A queued job is removed from the
+    queue, a running job has its worker process killed and is marked as
+    cancelled by manipulate_image. A job no worker has, like one left
+    active by a restart, is marked as cancelled here.
 
-def manipulate_image(file_path, form, image_id):
+    :param image_id: The id of the Image in the DB.
     """
-    Manipulates the image at the given file_path depending on the options
-    provided from the given form. Once the resulting gif/frames are returned by
-    the script, the Image in the DB is updated.
+    image = Image.query.filter_by(id=image_id).first()
+    if image is None or image.status not in ACTIVE_STATUSES:
+        registry.finish(image_id)
+        return
+    if dispatcher.cancel(image_id):
+        registry.finish(image_id)
+        image.status = CANCELLED
+        db.session.commit()
+    elif not registry.cancel(image_id):
+        # the job stays cancelled in the registry, in case a worker takes
+        # it between the two checks
+        image.status = CANCELLED
+        db.session.commit()
+
+def get_client_key():
+    """
+    :return: The key jobs of the current client are scheduled under, which
+    is the id kept in its session. Clients that did not send a session yet,
+    including those that never keep one, are keyed by their address for the
+    whole request, and given an id for their next ones.
+    """
+    if hasattr(g, 'client_key'):
+        return g.client_key
+    if 'client_id' in session:
+        g.client_key = session['client_id']
+    else:
+        g.client_key = request.remote_addr
+        g.client_id = session['client_id'] = str(uuid.uuid4())
+    return g.client_key
+
+def manipulate_image(file_path, arguments, image_id, cache_key=None):
+    """
+    Manipulates the image at the given file_path with the given command line
+    arguments. Once the resulting gif/frames are returned by the script, the
+    Image in the DB is updated and the result is cached.
 
     :param file_path: Path to the saved image
-    :param form: The submitted form with configuration options
+    :param arguments: The command line arguments for the configuration options
     :param image_id: The id of the Image in the DB
+    :param cache_key: The key to cache the result under, or None
     """
+    registry.claim(image_id)
     script_path = app.config['SCRIPT_PATH']
     output_dir = app.config['IMAGE_DIR']
-    arguments = ['--output', output_dir] + get_cli_arguments(form)
+    image = Image.query.filter_by(id=image_id).first()
+    if image is None or image.status not in ACTIVE_STATUSES:
+        registry.finish(image_id)
+        return
+    image.status = RUNNING
+    image.started = datetime.datetime.utcnow()
+    db.session.commit()
+    started = time.time()
+
+    # name the results after the job, since the upload itself is named after
+    # its content and may be shared by other jobs
+    name, _ = os.path.splitext(image.filename)
+    arguments = ['--output', output_dir, '--shard', '--shard_levels',
+        str(app.config['IMAGE_SHARD_LEVELS']), '--name', name] + arguments
+
+    # share intermediate stages with other jobs on the same image
+    if app.config['MEMO_DIR']:
+        arguments += ['--memo', app.config['MEMO_DIR']]
+        if image.content_hash:
+            arguments += ['--source_hash', image.content_hash]
+    if app.config['JOB_THREADS']:
+        arguments += ['--threads', str(app.config['JOB_THREADS'])]
+    if app.config['PIPELINE_JOBS']:
+        arguments += ['--pipeline']
+    if app.config['PROFILE_JOBS']:
+        arguments += ['--profile']
     command = [app.config['PYTHON'], script_path, file_path] + arguments
 
     # the script outputs the following dictionary:
-    # {"gif": "path_to.gif", "frames": ["path_to_frame.png", ...]}
-    results = subprocess.check_output(command)
+    # {"gif": "path_to.gif", "frames": ["path_to_frame.png", ...],
+    #  "timings": {"stage": seconds, ...}, "counters": {"event": n, ...},
+    #  "memo": {"hits": n, "misses": n}, "profile": "path_to.prof"}
+    # where the animation under "gif" is a .webp or .png with --format
+    # every way this can go wrong has to end the job, or its result page
+    # polls forever
+    status, error = DONE, None
+    try:
+        results = run_script(command, image_id)
+    except JobCancelled:
+        status = CANCELLED
+    except JobFailed as e:
+        status, error = FAILED, str(e)
+    except Exception:
+        app.logger.exception('Job %s failed', image_id)
+        status, error = FAILED, 'The job failed'
 
     image = Image.query.filter_by(id=image_id).first()
-    if image is not None:
+    if image is None:
+        return
+    image.status = status
+    image.error = error
+    if status == DONE:
         image.results = results
-        db.session.commit()
+        image.results_bytes = cache.get_results_size(results)
+        metrics.output_bytes_total.inc(image.results_bytes)
+    else:
+        image_storage.remove_prefixed(name)
+    db.session.commit()
+    if status == DONE:
+        cache.store(cache_key, image)
+    record_job_metrics(status, time.time() - started,
+                       results if status == DONE else None)
+
+def record_job_metrics(status, seconds, results=None):
+    """
+    Effect: records the outcome of a job and the stage timings the script
+    reported for it.
+
+    :param status: The status the job ended with.
+    :param seconds: The time the job took to run.
+    :param results: The output of the script, if the job is done.
+    """
+    metrics.jobs_total.inc(1, status)
+    metrics.job_seconds.observe(seconds, status)
+    if not results:
+        return
+    try:
+        results = json.loads(results)
+    except ValueError:
+        return
+    metrics.observe_timings(results.get('timings', {}))
+    memo = results.get('memo', {})
+    metrics.memo_total.inc(memo.get('hits', 0), 'hit')
+    metrics.memo_total.inc(memo.get('misses', 0), 'miss')
+
+def get_seed(form):
+    """
+    :param form: The ImageManipulationForm submitted by the user.
+    :return: The seed for the random number generator given in the form as an
+    int, or None if no valid seed was given.
+    """
+    try:
+        return int(form.seed.data)
+    except (TypeError, ValueError):
+        return None
 
 def get_cli_arguments(form):
     """
@@ -95,6 +598,11 @@ def get_cli_arguments(form):
 
     if form.animation.data in ['auto', 'custom'] and form.save_frames.data:
         arguments += ['--frames']
+    if form.animation.data in ['auto', 'custom']:
+        if form.output_format.data == 'webp':
+            arguments += ['--format', form.output_format.data]
+        if form.preset.data == 'small':
+            arguments += ['--preset', 'small']
 
     if form.box_shape.data == 'vertical':
         arguments += ['--vertical']
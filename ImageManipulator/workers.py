@@ -0,0 +1,201 @@
+"""
+Runs the manipulation script in worker processes with a wall-clock timeout
+and CPU and memory limits, and keeps track of the running processes so that
+jobs can be cancelled, explicitly or when nobody is waiting for them anymore.
+"""
+import time, signal, threading, subprocess
+from . import app
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class JobCancelled(Exception):
+    """ Raised when a job is cancelled before or while it runs. """
+
+class JobFailed(Exception):
+    """ Raised when the script fails, runs out of time or exceeds a limit. """
+
+class WorkerRegistry(object):
+    """
+    The worker processes of running jobs, by job key, along with the last
+    time somebody polled for the result of each job.
+    """
+    def __init__(self):
+        self.processes = {}
+        self.claimed = set()
+        self.cancelled = set()
+        self.polled = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Effect: records that a worker has taken the job key, before its
+        process is started.
+        """
+        with self.lock:
+            self.claimed.add(key)
+
+    def start(self, key, process):
+        """
+        Effect: registers the worker process of the job key.
+
+        :raises JobCancelled: If the job was cancelled before it started, in
+        which case the process is killed.
+        """
+        with self.lock:
+            self.processes[key] = process
+            cancelled = key in self.cancelled
+        if cancelled:
+            kill(process)
+            raise JobCancelled()
+
+    def finish(self, key):
+        """
+        Effect: forgets the job key, which has finished or was removed from
+        the queue.
+
+        :return: True if the job was cancelled.
+        """
+        with self.lock:
+            self.processes.pop(key, None)
+            self.claimed.discard(key)
+            self.polled.pop(key, None)
+            cancelled = key in self.cancelled
+            self.cancelled.discard(key)
+        return cancelled
+
+    def cancel(self, key):
+        """
+        Effect: cancels the job key, killing its worker process if it has one.
+        A worker that takes the job later does not start it.
+
+        :return: True if a worker has taken the job, which then ends it.
+        """
+        with self.lock:
+            self.cancelled.add(key)
+            process = self.processes.get(key)
+            claimed = key in self.claimed
+        if process is not None:
+            kill(process)
+        return claimed
+
+    def is_claimed(self, key):
+        """ :return: True if a worker has taken the job key. """
+        with self.lock:
+            return key in self.claimed
+
+    def is_cancelled(self, key):
+        with self.lock:
+            return key in self.cancelled
+
+    def poll(self, key):
+        """ Effect: records that somebody is waiting for the job key. """
+        with self.lock:
+            self.polled[key] = time.time()
+
+    def get_abandoned(self, timeout):
+        """
+        :return: The keys of the jobs that have been polled for, but not in
+        the last timeout seconds.
+        """
+        now = time.time()
+        with self.lock:
+            return [key for key, polled in self.polled.items()
+                    if now - polled > timeout and key not in self.cancelled]
+
+registry = WorkerRegistry()
+
+def kill(process):
+    """ Effect: kills process, if it has not exited yet. """
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+def limit_resources(memory_limit, cpu_limit):
+    """
+    :return: A function for subprocess' preexec_fn, that limits the address
+    space of the process to memory_limit bytes and its CPU time to cpu_limit
+    seconds. Limits of 0 are not applied.
+    """
+    def preexec():
+        if resource is None:
+            return
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        if cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+    return preexec
+
+def run_script(command, key):
+    """
+    Runs the manipulation script in a worker process for the job key.
+
+    :param command: The command to run.
+    :param key: The key of the job, to cancel it with.
+    :return: The output of the script.
+    :raises JobCancelled: If the job was cancelled.
+    :raises JobFailed: If the script failed or exceeded a limit.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        preexec_fn=limit_resources(app.config['WORKER_MEMORY_LIMIT'],
+                                   app.config['WORKER_CPU_LIMIT']))
+    timed_out = []
+    def time_out():
+        timed_out.append(True)
+        kill(process)
+    timer = threading.Timer(app.config['JOB_TIMEOUT'], time_out)
+    timer.daemon = True
+
+    try:
+        registry.start(key, process)
+        timer.start()
+        output, error = process.communicate()
+    finally:
+        timer.cancel()
+        cancelled = registry.finish(key)
+
+    if cancelled:
+        raise JobCancelled()
+    if timed_out:
+        raise JobFailed('The job took longer than {} seconds'.format(
+            app.config['JOB_TIMEOUT']))
+    if process.returncode == -getattr(signal, 'SIGXCPU', 0):
+        raise JobFailed('The job used too much CPU time')
+    if process.returncode != 0:
+        if 'MemoryError' in error:
+            raise JobFailed('The job used too much memory')
+        app.logger.error('Script failed: %s', error)
+        raise JobFailed('The job failed')
+    return output
+
+class Watchdog(threading.Thread):
+    """
+    Daemon thread that cancels jobs nobody has polled for in ABANDON_TIMEOUT
+    seconds, e.g. because their result page was closed.
+    """
+    def __init__(self, cancel):
+        """
+        :param cancel: The function to cancel a job with, given its key.
+        """
+        super(Watchdog, self).__init__()
+        self.daemon = True
+        self.cancel = cancel
+
+    def run(self):
+        while True:
+            time.sleep(app.config['ABANDON_CHECK_INTERVAL'])
+            for key in registry.get_abandoned(app.config['ABANDON_TIMEOUT']):
+                try:
+                    self.cancel(key)
+                except Exception:
+                    app.logger.exception('Cancelling job %s failed', key)
+
+def start_watchdog(cancel):
+    """ Effect: starts the watchdog thread. """
+    watchdog = Watchdog(cancel)
+    watchdog.start()
+    return watchdog
@@ -0,0 +1,216 @@
+#!env/bin/python
+"""
+Benchmarks the configurations of images2gif.writeGif on frames rendered the
+way the manipulation script renders them: both quantizers (the PIL adaptive
+palette and NeuQuant), dithering, subrectangles and disposal. For each
+configuration it records the encode time, the size of the gif, the peak
+memory and the PSNR of every frame, as displayed, against the unquantized
+frame. Each configuration runs in its own process.
+
+    python benchmarks/bench_gif.py --sizes 0.25 --frames 6 \
+        --output results.json --baseline baseline.json
+
+Exits with status 1 if any configuration got slower, bigger or worse looking
+than the baseline by more than the tolerance.
+"""
+import argparse, sys, os, json, math, tempfile
+import common
+
+QUANTIZERS = ['pil', 'neuquant']
+
+# The fields identifying a case
+KEY_FIELDS = ['megapixels', 'frames', 'operations', 'nq', 'dither',
+              'sub_rectangles', 'dispose']
+
+# The metrics compared against the baseline, and whether higher is better
+METRICS = [('seconds', False), ('bytes', False), ('psnr_mean', True)]
+
+def run_case(case):
+    """
+    Encodes one animation with one configuration.
+
+    :param case: A dictionary with the fields in KEY_FIELDS, the number of
+    times to repeat the encode and the seed.
+    :return: The result dictionary.
+    """
+    import images2gif
+
+    frames = common.make_frames(case['megapixels'],
+        case['operations'].split(','), case['frames'], case['seed'])
+
+    # keep what the writer is about to write, so the frames can be composited
+    # the way a viewer displays them
+    written = {}
+    write = images2gif.GifWriter.writeGifToFile
+    def capture(self, fp, images, durations, loops, xys, disposes):
+        written.update(images=images, xys=xys, disposes=disposes)
+        return write(self, fp, images, durations, loops, xys, disposes)
+    images2gif.GifWriter.writeGifToFile = capture
+
+    fd, path = tempfile.mkstemp(suffix='.gif')
+    os.close(fd)
+    try:
+        seconds = sorted(common.measure(lambda: lambda: images2gif.writeGif(
+            path, frames, dither=case['dither'], nq=case['nq'],
+            subRectangles=case['sub_rectangles'], dispose=case['dispose']),
+            case['repeat']))
+        n_bytes = os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+    psnrs = [get_psnr(frame, shown) for frame, shown in
+             zip(frames, composite(written['images'], written['xys'],
+                                   written['disposes'], frames[0].size))]
+    result = dict((field, case[field]) for field in KEY_FIELDS)
+    result.update({
+        'width': frames[0].size[0],
+        'height': frames[0].size[1],
+        'seconds': seconds[len(seconds) / 2],
+        'best_seconds': seconds[0],
+        'bytes': n_bytes,
+        'peak_rss_mb': common.get_peak_rss(),
+        'psnr': psnrs,
+        'psnr_mean': sum(psnrs) / len(psnrs),
+        'psnr_min': min(psnrs),
+        'scipy': images2gif.get_cKDTree() is not None,
+    })
+    return result
+
+def composite(images, xys, disposes, size):
+    """
+    Plays back the frames of a gif the way a viewer displays them.
+
+    :param images: The paletted frames, possibly cropped to subrectangles.
+    :param xys: The position of each frame.
+    :param disposes: The disposal method of each frame, 1 to leave it in place
+    and 2 to clear it to the background afterwards.
+    :param size: The size of the gif.
+    :return: A generator of the RGB Image displayed for each frame.
+    """
+    from PIL import Image
+
+    canvas = Image.new('RGB', size)
+    for image, xy, dispose in zip(images, xys, disposes):
+        image = image.convert('RGB')
+        canvas.paste(image, xy)
+        yield canvas.copy()
+        if dispose == 2:
+            canvas.paste((0, 0, 0), xy + (xy[0] + image.size[0],
+                                          xy[1] + image.size[1]))
+
+def get_psnr(expected, actual):
+    """
+    :return: The peak signal to noise ratio of actual against expected, in
+    decibels, capped at 100 for identical images.
+    """
+    import numpy as np
+
+    difference = (np.asarray(expected.convert('RGB'), dtype=np.float64)
+                  - np.asarray(actual, dtype=np.float64))
+    mse = (difference ** 2).mean()
+    if mse == 0:
+        return 100.0
+    return min(100.0, 10 * math.log10(255.0 ** 2 / mse))
+
+def get_cases(args):
+    """ :return: The list of cases selected by the arguments. """
+    nqs = []
+    if 'pil' in args.quantizers:
+        nqs.append(0)
+    if 'neuquant' in args.quantizers:
+        nqs += args.nq
+    cases = []
+    for megapixels in args.sizes:
+        for nq in nqs:
+            for dither in args.dither:
+                for sub_rectangles in args.sub_rectangles:
+                    for dispose in args.dispose:
+                        cases.append({
+                            'megapixels': megapixels,
+                            'frames': args.frames,
+                            'operations': ','.join(args.operations),
+                            'nq': nq,
+                            'dither': dither,
+                            'sub_rectangles': sub_rectangles,
+                            'dispose': dispose,
+                            'repeat': args.repeat,
+                            'seed': args.seed,
+                        })
+    return cases
+
+def get_bools(value):
+    return value.lower() in ['1', 'true', 'yes']
+
+def get_dispose(value):
+    return None if value.lower() == 'default' else int(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the speed and\
+        quality of the configurations of images2gif')
+    parser.add_argument('--sizes', nargs='+', default=[0.25], type=float,
+        help='Sizes of the images in megapixels')
+    parser.add_argument('--frames', default=6, type=int, help='Box sizes in\
+        the animation, before it is looped back')
+    parser.add_argument('--operations', nargs='+', default=['flip',
+        'average'], choices=['flip', 'ninety', 'average', 'random'])
+    parser.add_argument('--quantizers', nargs='+', default=QUANTIZERS,
+        choices=QUANTIZERS)
+    parser.add_argument('--nq', nargs='+', default=[10], type=int,
+        help='Sample factors to run NeuQuant with, 1 is the best quality')
+    parser.add_argument('--dither', nargs='+', default=[False, True],
+        type=get_bools)
+    parser.add_argument('--sub_rectangles', nargs='+', default=[True, False],
+        type=get_bools)
+    parser.add_argument('--dispose', nargs='+', default=[None, 1, 2],
+        type=get_dispose, help='Disposal methods, "default" lets writeGif\
+        choose')
+    parser.add_argument('--repeat', default=1, type=int, help='Encodes of\
+        each case, the median time is reported')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--timeout', default=1800, type=float, help='Seconds\
+        after which a case is abandoned')
+    parser.add_argument('-o', '--output', default='bench_gif.json',
+        help='Path to save the results to')
+    parser.add_argument('--baseline', default='', help='Path to results to\
+        compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='The\
+        fraction a metric may get worse by before it is a regression')
+    parser.add_argument('--case', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print json.dumps(run_case(json.loads(args.case)))
+        return 0
+
+    results = []
+    for case in get_cases(args):
+        result = common.run_isolated(os.path.abspath(__file__), case,
+            args.timeout)
+        for field in KEY_FIELDS:
+            result.setdefault(field, case[field])
+        results.append(result)
+        line = '{megapixels:6}MP nq {nq:3} dither {dither:d} subrect'\
+            ' {sub_rectangles:d} dispose {dispose!s:4}'.format(**result)
+        if 'error' in result:
+            print line, 'error:', result['error']
+        else:
+            print line, '{seconds:8.3f}s {bytes:9d}B {peak_rss_mb:7.1f}MB'\
+                ' PSNR {psnr_mean:5.2f}dB (min {psnr_min:5.2f})'.format(
+                **result)
+        sys.stdout.flush()
+    common.save_results(args.output, results)
+
+    if args.baseline:
+        baseline = common.load_results(args.baseline)
+        regressed = False
+        for metric, higher_is_better in METRICS:
+            regressions = common.compare(results, baseline, KEY_FIELDS,
+                metric, higher_is_better, args.tolerance)
+            common.print_regressions(regressions, KEY_FIELDS, metric)
+            regressed = regressed or bool(regressions)
+        if regressed:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
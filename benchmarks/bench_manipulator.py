@@ -0,0 +1,158 @@
+#!env/bin/python
+"""
+Benchmarks the operations of ImageManipulator on synthetic images of several
+sizes, with every box layout and a range of box sizes. Each case runs in its
+own process, so the peak memory reported is that of the case alone.
+
+    python benchmarks/bench_manipulator.py --sizes 0.25 1 --box_sizes 8 64 \
+        --output results.json --baseline baseline.json
+
+Exits with status 1 if any case is slower than the baseline by more than the
+tolerance.
+"""
+import argparse, sys, os, random, itertools
+import common
+
+OPERATIONS = ['resize', 'boxes', 'flip', 'ninety', 'average', 'random']
+LAYOUTS = ['square', 'vertical', 'horizontal']
+SIZES = [0.25, 1, 4, 16, 64]
+BOX_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+# The fields identifying a case
+KEY_FIELDS = ['operation', 'layout', 'megapixels', 'box_size', 'threads']
+
+def run_case(case):
+    """
+    Times one operation on one image.
+
+    :param case: A dictionary with the fields in KEY_FIELDS, the number of
+    times to repeat the operation and the seed.
+    :return: The result dictionary.
+    """
+    from imagemanipulator import ImageManipulator, get_rotate_options
+
+    operation, box_size = case['operation'], case['box_size']
+    base = common.make_image(case['megapixels'], case['seed'])
+    width, height = base.size
+    resize = [width / 2, 0] if operation == 'resize' else False
+    args = common.ManipulatorArguments(case['layout'], [operation], resize,
+        case['threads'])
+    random.seed(case['seed'])
+
+    def setup():
+        im = ImageManipulator('bench.png', box_size, args, image=base.copy())
+        if operation == 'resize':
+            return im.resize
+        elif operation == 'boxes':
+            return lambda: im.get_boxes_and_size(box_size)
+        elif operation in ['flip', 'ninety']:
+            return lambda: im.rotate_sections(get_rotate_options(args))
+        elif operation == 'average':
+            return im.average_sections
+        elif operation == 'random':
+            return im.randomize_sections
+
+    rss_before = common.get_peak_rss()
+    seconds = sorted(common.measure(setup, case['repeat']))
+    median = seconds[len(seconds) / 2]
+    result = dict((field, case[field]) for field in KEY_FIELDS)
+    result.update({
+        'width': width,
+        'height': height,
+        'seconds': median,
+        'best_seconds': seconds[0],
+        'megapixels_per_second': (width * height / 1e6 / median
+                                  if median else None),
+        'peak_rss_mb': common.get_peak_rss(),
+        'image_rss_mb': rss_before,
+    })
+    return result
+
+def get_cases(args):
+    """ :return: The list of cases selected by the arguments. """
+    cases = []
+    for megapixels in args.sizes:
+        width, height = common.get_size(megapixels)
+        for operation in args.operations:
+            # resizing does not depend on the boxes
+            if operation == 'resize':
+                layouts, box_sizes = ['square'], [0]
+            # rotating by ninety degrees only keeps square boxes in place
+            elif operation == 'ninety':
+                layouts, box_sizes = ['square'], args.box_sizes
+            else:
+                layouts, box_sizes = args.layouts, args.box_sizes
+            for layout, box_size, threads in itertools.product(layouts,
+                    box_sizes, args.threads):
+                side = (width if layout == 'vertical'
+                        else height if layout == 'horizontal'
+                        else min(width, height))
+                if box_size > side:
+                    continue
+                cases.append({'operation': operation, 'layout': layout,
+                              'megapixels': megapixels, 'box_size': box_size,
+                              'threads': threads, 'repeat': args.repeat,
+                              'seed': args.seed})
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the operations\
+        of ImageManipulator')
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS,
+        choices=OPERATIONS)
+    parser.add_argument('--layouts', nargs='+', default=LAYOUTS,
+        choices=LAYOUTS)
+    parser.add_argument('--sizes', nargs='+', default=SIZES, type=float,
+        help='Sizes of the images in megapixels')
+    parser.add_argument('--box_sizes', nargs='+', default=BOX_SIZES, type=int)
+    parser.add_argument('--threads', nargs='+', default=[0], type=int,
+        help='Numbers of threads to run the operations on, 0 runs them one\
+        box at a time')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs of each\
+        case, the median is reported')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--timeout', default=600, type=float, help='Seconds\
+        after which a case is abandoned')
+    parser.add_argument('-o', '--output', default='bench_manipulator.json',
+        help='Path to save the results to')
+    parser.add_argument('--baseline', default='', help='Path to results to\
+        compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='The\
+        fraction of throughput a case may lose before it is a regression')
+    parser.add_argument('--case', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        import json
+        print json.dumps(run_case(json.loads(args.case)))
+        return 0
+
+    results = []
+    for case in get_cases(args):
+        result = common.run_isolated(os.path.abspath(__file__), case,
+            args.timeout)
+        for field in KEY_FIELDS:
+            result.setdefault(field, case[field])
+        results.append(result)
+        if 'error' in result:
+            print '{operation:8} {layout:10} {megapixels:6}MP box {box_size:4}'\
+                ' threads {threads:2} error: {error}'.format(**result)
+        else:
+            print '{operation:8} {layout:10} {megapixels:6}MP box {box_size:4}'\
+                ' threads {threads:2} {seconds:9.4f}s {megapixels_per_second:9.3f}MP/s'\
+                ' {peak_rss_mb:8.1f}MB'.format(**result)
+        sys.stdout.flush()
+    common.save_results(args.output, results)
+
+    if args.baseline:
+        regressions = common.compare(results,
+            common.load_results(args.baseline), KEY_FIELDS,
+            'megapixels_per_second', tolerance=args.tolerance)
+        common.print_regressions(regressions, KEY_FIELDS,
+            'megapixels_per_second')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Helpers shared by the benchmarks: deterministic synthetic images, running each
+case in a fresh process so its peak memory is its own, and saving results and
+comparing them against a baseline.
+"""
+import os, sys, json, math, time, random, platform, resource, subprocess, threading
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_DIR = os.path.join(ROOT_DIR, 'ImageManipulator', 'cli')
+
+# Make the manipulation script importable by the benchmarks
+if CLI_DIR not in sys.path:
+    sys.path.insert(0, CLI_DIR)
+
+def make_image(megapixels, seed=0, aspect=4.0 / 3.0):
+    """
+    Creates the same image for the same arguments on every run: smooth
+    gradients, so averaged and quantized boxes differ from each other, with
+    noise on top, so compression has something to do.
+
+    :param megapixels: The number of pixels of the image, in millions.
+    :param seed: The seed for the noise.
+    :param aspect: The ratio of width to height.
+    :return: An RGB Image.
+    """
+    width, height = get_size(megapixels, aspect)
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[:, :, 0] = (255 * x * np.ones_like(y)).astype(np.uint8)
+    pixels[:, :, 1] = (255 * y * np.ones_like(x)).astype(np.uint8)
+    pixels[:, :, 2] = (255 * (1 - x) * y).astype(np.uint8)
+    noise = rng.randint(0, 32, size=(height, width, 1)).astype(np.uint8)
+    pixels -= np.minimum(pixels, noise)
+    return Image.fromarray(pixels, 'RGB')
+
+def get_size(megapixels, aspect=4.0 / 3.0):
+    """ :return: The (width, height) of an image of megapixels. """
+    height = int(round(math.sqrt(megapixels * 1e6 / aspect)))
+    width = int(round(height * aspect))
+    return width, height
+
+class ManipulatorArguments(object):
+    """ Stands in for the parsed arguments of the manipulation script. """
+    def __init__(self, layout='square', operations=(), resize=False,
+                 threads=0):
+        """
+        :param layout: 'square', 'vertical' or 'horizontal'.
+        :param operations: The names of the operations, see
+        imagemanipulator.get_operations.
+        :param resize: The size to resize to, or False.
+        :param threads: The number of threads to run the operations on.
+        """
+        self.vertical = layout == 'vertical'
+        self.horizontal = layout == 'horizontal'
+        self.flip = 'flip' in operations
+        self.ninety = 'ninety' in operations
+        self.average = 'average' in operations
+        self.random = 'random' in operations
+        self.resize = resize
+        self.threads = threads
+        self.debug = False
+
+def make_frames(megapixels, operations, n_frames, seed=0):
+    """
+    Renders the frames of an animation the way the manipulation script does:
+    one frame per box size, doubling from 2, cropped to the smallest frame
+    and looped back to the start.
+
+    :param megapixels: The size of the synthetic image, in millions of pixels.
+    :param operations: The names of the operations applied to each frame.
+    :param n_frames: The number of box sizes.
+    :param seed: The seed for the image and the random operations.
+    :return: A list of RGB Images.
+    """
+    from imagemanipulator import ImageManipulator, apply_operation
+
+    base = make_image(megapixels, seed)
+    args = ManipulatorArguments('square', operations)
+    random.seed(seed)
+    frames = []
+    for i in range(n_frames):
+        im = ImageManipulator('bench.png', 2 ** (i + 1), args,
+                              image=base.copy())
+        for operation in operations:
+            apply_operation(im, operation)
+        im.crop_image()
+        frames.append(im.image)
+
+    width = min(frame.size[0] for frame in frames)
+    height = min(frame.size[1] for frame in frames)
+    frames = [frame.crop((0, 0, width, height)) for frame in frames]
+    return frames + frames[-2:0:-1]
+
+def get_peak_rss():
+    """ :return: The peak resident set size of this process, in megabytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def measure(function, repeat):
+    """
+    Calls function repeat times.
+
+    :param function: Takes no arguments and returns a function that runs the
+    work to time, so the setup of each run is not timed.
+    :param repeat: The number of runs.
+    :return: A list of the seconds each run took.
+    """
+    seconds = []
+    for i in range(repeat):
+        work = function()
+        start = time.time()
+        work()
+        seconds.append(time.time() - start)
+    return seconds
+
+def run_isolated(script, case, timeout):
+    """
+    Runs one case in a new process, which prints its result as JSON.
+
+    :param script: The path to the benchmark script, which must accept
+    --case followed by the case as JSON.
+    :param case: A dictionary describing the case.
+    :param timeout: Seconds after which the case is killed.
+    :return: The result dictionary printed by the case, or a dictionary with
+    an "error" if it failed or timed out.
+    """
+    process = subprocess.Popen(
+        [sys.executable, script, '--case', json.dumps(case)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        timer.cancel()
+
+    if process.returncode != 0:
+        if timed_out.is_set():
+            return {'error': 'timed out after {}s'.format(timeout)}
+        if process.returncode < 0:
+            return {'error': 'killed by signal {}'.format(-process.returncode)}
+        return {'error': stderr.strip().splitlines()[-1] if stderr.strip()
+                else 'exited with {}'.format(process.returncode)}
+    try:
+        return json.loads(stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {'error': 'no result'}
+
+def get_environment():
+    """ :return: A dictionary describing what the benchmarks ran on. """
+    import PIL
+    return {
+        'python': platform.python_version(),
+        'pillow': getattr(PIL, '__version__', getattr(PIL, 'PILLOW_VERSION',
+                                                      None)),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def save_results(path, results):
+    """ Effect: saves the results with a description of the environment. """
+    with open(path, 'w') as f:
+        json.dump({'environment': get_environment(), 'results': results}, f,
+                  indent=2, sort_keys=True)
+
+def load_results(path):
+    """ :return: The results saved at path by save_results. """
+    with open(path) as f:
+        return json.load(f)['results']
+
+def compare(results, baseline, key_fields, metric, higher_is_better=True,
+            tolerance=0.1):
+    """
+    Finds the cases that got worse than the baseline by more than tolerance.
+
+    :param results: A list of result dictionaries.
+    :param baseline: A list of result dictionaries from an earlier run.
+    :param key_fields: The fields identifying a case in both lists.
+    :param metric: The field compared.
+    :param higher_is_better: True if a higher metric is better.
+    :param tolerance: The fraction the metric may get worse by.
+    :return: A list of tuples (result, baseline_value, change), where change
+    is the relative change of the metric.
+    """
+    def get_key(result):
+        return tuple(result.get(field) for field in key_fields)
+
+    baseline = dict((get_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = baseline.get(get_key(result), {}).get(metric)
+        new = result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / float(old)
+        if (change < -tolerance if higher_is_better else change > tolerance):
+            regressions.append((result, old, change))
+    return regressions
+
+def print_regressions(regressions, key_fields, metric):
+    """ Effect: prints the regressions found by compare. """
+    for result, old, change in regressions:
+        print 'REGRESSION {}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(
+            ' '.join(str(result.get(field)) for field in key_fields), metric,
+            old, result[metric], change)
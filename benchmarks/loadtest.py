@@ -0,0 +1,362 @@
+#!env/bin/python
+"""
+Generates load on the web app: concurrent clients upload images of several
+sizes with a mix of options, poll for their results and download them. By
+default the app runs in this process, on a fresh database and image
+directory, and is driven through the WSGI test client; with --url it drives
+a running server instead.
+
+    python benchmarks/loadtest.py --clients 8 --jobs 5 --sizes 0.05 0.25 1
+
+Reports requests per second and latency percentiles for each kind of
+request, percentiles of the time from upload to result, and, in process, how
+long SQLite statements and commits waited.
+"""
+import argparse, sys, os, re, io, json, time, uuid, random, tempfile
+import threading, urllib, urllib2, cookielib
+import common
+
+# The options submitted with the form, by name
+OPTION_SETS = {
+    'preview': {'animation': 'one_frame', 'box_size': '8',
+                'box_shape': 'square', 'rotation': 'flip'},
+    'gif': {'animation': 'auto', 'box_shape': 'square', 'rotation': 'flip'},
+    'average': {'animation': 'auto', 'box_shape': 'vertical',
+                'rotation': 'none', 'average': 'y'},
+    'random': {'animation': 'custom', 'box_size': '4', 'frames': '4',
+               'box_shape': 'square', 'rotation': 'ninety',
+               'randomize': 'y', 'seed': '1'},
+}
+
+# The statuses a job ends with
+FINISHED = ['done', 'failed', 'cancelled']
+
+class TestClient(object):
+    """ Sends requests to the app in this process. """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        """ :return: A tuple (status code, body). """
+        response = self.client.get(path)
+        return response.status_code, response.data
+
+    def upload(self, fields, image, filename):
+        """
+        Submits the form with an image.
+
+        :return: A tuple (status code, body).
+        """
+        data = dict(fields)
+        data['image'] = (io.BytesIO(image), filename)
+        response = self.client.post('/', data=data)
+        return response.status_code, response.data
+
+class HttpClient(object):
+    """ Sends requests to a running server, keeping its cookies. """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def get(self, path):
+        return self.request(urllib2.Request(self.url + path))
+
+    def upload(self, fields, image, filename):
+        # the form is protected against CSRF, so fetch a token first
+        _, page = self.get('/')
+        match = re.search(r'name="csrf_token"[^>]*value="([^"]*)"', page)
+        fields = dict(fields)
+        if match:
+            fields['csrf_token'] = match.group(1)
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append('--{}\r\nContent-Disposition: form-data; '
+                         'name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value))
+        parts.append('--{}\r\nContent-Disposition: form-data; name="image"; '
+                     'filename="{}"\r\nContent-Type: application/octet-stream'
+                     '\r\n\r\n'.format(boundary, filename))
+        body = ''.join(parts) + image + '\r\n--{}--\r\n'.format(boundary)
+        request = urllib2.Request(self.url + '/', body, {
+            'Content-Type': 'multipart/form-data; boundary=' + boundary})
+        return self.request(request)
+
+    def request(self, request):
+        try:
+            response = self.opener.open(request)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError as e:
+            return e.code, e.read()
+
+class Recorder(object):
+    """ Collects the latencies of requests and jobs from every client. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.results = {}
+        self.statuses = {}
+
+    def request(self, kind, seconds, status_code):
+        with self.lock:
+            self.requests.setdefault(kind, []).append(seconds)
+            if status_code >= 400:
+                self.count('http_{}'.format(status_code))
+
+    def result(self, option_set, seconds, status):
+        with self.lock:
+            self.results.setdefault(option_set, []).append(seconds)
+            self.count(status)
+
+    def count(self, status):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+class LockWaits(object):
+    """
+    Times the statements that write to SQLite and the commits of sessions,
+    which is where they wait for the database lock, and counts the statements
+    that gave up with "database is locked".
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.writes, self.commits = [], []
+        self.locked = 0
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+        event.listen(Session, 'before_commit', self.before_commit)
+        event.listen(Session, 'after_commit', self.after_commit)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('load_test_start', []).append(time.time())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        seconds = time.time() - conn.info['load_test_start'].pop()
+        if statement.lstrip().split(' ', 1)[0].upper() in [
+                'INSERT', 'UPDATE', 'DELETE']:
+            with self.lock:
+                self.writes.append(seconds)
+
+    def handle_error(self, context):
+        if context.connection is not None:
+            starts = context.connection.info.get('load_test_start')
+            if starts:
+                starts.pop()
+        if 'database is locked' in str(context.original_exception):
+            with self.lock:
+                self.locked += 1
+
+    def before_commit(self, session):
+        self.local.start = time.time()
+
+    def after_commit(self, session):
+        start = getattr(self.local, 'start', None)
+        if start is not None:
+            with self.lock:
+                self.commits.append(time.time() - start)
+            self.local.start = None
+
+    def report(self):
+        return {'write_statements': summarize(self.writes),
+                'commits': summarize(self.commits),
+                'locked_errors': self.locked}
+
+def run_client(client, recorder, images, args, rng):
+    """
+    Effect: submits args.jobs jobs one after another, polling each until it
+    finishes and downloading its results.
+
+    :param client: The TestClient or HttpClient.
+    :param recorder: The Recorder shared by all clients.
+    :param images: A dictionary from size to the bytes of a PNG image.
+    :param args: The parsed arguments.
+    :param rng: The Random choosing sizes and options for this client.
+    """
+    for i in range(args.jobs):
+        size = rng.choice(args.sizes)
+        option_set = rng.choice(args.options)
+        start = time.time()
+        status_code, body = timed(recorder, 'upload', client.upload,
+            OPTION_SETS[option_set], images[size], 'load.png')
+        match = re.search(r'/_results/(\d+)', body)
+        if match is None:
+            recorder.result(option_set, time.time() - start, 'rejected')
+            continue
+
+        results = None
+        while time.time() - start < args.timeout:
+            status_code, body = timed(recorder, 'poll', client.get,
+                '/_results/' + match.group(1))
+            if body.strip():
+                results = json.loads(body)
+                if results.get('status') in FINISHED:
+                    break
+            time.sleep(args.poll_interval)
+        else:
+            recorder.result(option_set, time.time() - start, 'timeout')
+            continue
+        recorder.result(option_set, time.time() - start, results['status'])
+
+        if args.download and results['status'] == 'done':
+            names = [results['gif']] + results['frames']
+            for name in filter(None, names):
+                version = results.get('versions', {}).get(name)
+                timed(recorder, 'download', client.get, '/images/' + name
+                      + ('?v=' + urllib.quote(version) if version else ''))
+
+def timed(recorder, kind, function, *args):
+    """ :return: function(*args), after recording how long it took. """
+    start = time.time()
+    status_code, body = function(*args)
+    recorder.request(kind, time.time() - start, status_code)
+    return status_code, body
+
+def summarize(seconds):
+    """ :return: The count, total and percentiles of a list of seconds. """
+    seconds = sorted(seconds)
+    summary = {'count': len(seconds), 'total': sum(seconds)}
+    for percentile in [50, 95, 99]:
+        summary['p{}'.format(percentile)] = get_percentile(seconds,
+                                                           percentile)
+    return summary
+
+def get_percentile(values, percentile):
+    """ :return: The nearest rank percentile of sorted values, or None. """
+    if not values:
+        return None
+    rank = int(round(percentile / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+def start_app():
+    """
+    Imports the app configured to run on a fresh database and image
+    directory, with CSRF protection off so the test client can post forms.
+
+    :return: The app and its SQLAlchemy db.
+    """
+    sys.path.insert(0, common.ROOT_DIR)
+    import config
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    config.IMAGE_DIR = os.path.join(directory, 'images')
+    config.MEMO_DIR = os.path.join(directory, 'memo')
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory,
+                                                                 'app.db')
+    config.WTF_CSRF_ENABLED = False
+    config.GC_ENABLED = False
+    if not os.path.exists(config.PYTHON):
+        config.PYTHON = sys.executable
+    os.makedirs(config.IMAGE_DIR)
+
+    from ImageManipulator import app, db
+    db.create_all()
+    return app, db
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate load on the web\
+        app and report throughput and latency')
+    parser.add_argument('--url', default='', help='URL of a running server,\
+        instead of running the app in this process')
+    parser.add_argument('--clients', default=4, type=int, help='Concurrent\
+        clients')
+    parser.add_argument('--jobs', default=5, type=int, help='Jobs each\
+        client submits, one after another')
+    parser.add_argument('--sizes', nargs='+', default=[0.05, 0.25, 1],
+        type=float, help='Sizes of the uploaded images in megapixels')
+    parser.add_argument('--options', nargs='+', default=sorted(OPTION_SETS),
+        choices=sorted(OPTION_SETS), help='Option sets to submit')
+    parser.add_argument('--poll_interval', default=0.25, type=float)
+    parser.add_argument('--timeout', default=600, type=float, help='Seconds\
+        after which a job is given up on')
+    parser.add_argument('--no_download', dest='download',
+        action='store_false', help='Do not download the results')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-o', '--output', default='', help='Path to save\
+        the report to as JSON')
+    args = parser.parse_args()
+
+    images = {}
+    for size in args.sizes:
+        output = io.BytesIO()
+        common.make_image(size, args.seed).save(output, 'png')
+        images[size] = output.getvalue()
+
+    lock_waits = None
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        app, db = start_app()
+        lock_waits = LockWaits(db.engine)
+        make_client = lambda: TestClient(app)
+
+    recorder = Recorder()
+    threads = []
+    start = time.time()
+    for i in range(args.clients):
+        thread = threading.Thread(target=run_client, args=(make_client(),
+            recorder, images, args, random.Random(args.seed + i)))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    elapsed = time.time() - start
+
+    n_requests = sum(len(seconds) for seconds in recorder.requests.values())
+    report = {
+        'environment': common.get_environment(),
+        'arguments': vars(args),
+        'seconds': elapsed,
+        'requests_per_second': n_requests / elapsed,
+        'requests': dict((kind, summarize(seconds))
+                         for kind, seconds in recorder.requests.items()),
+        'time_to_result': summarize(sum(recorder.results.values(), [])),
+        'time_to_result_by_options': dict(
+            (option_set, summarize(seconds))
+            for option_set, seconds in recorder.results.items()),
+        'statuses': recorder.statuses,
+        'sqlite': lock_waits and lock_waits.report(),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+def print_report(report):
+    def format_summary(summary):
+        return '{:6d} p50 {} p95 {} p99 {}'.format(summary['count'],
+            *[format_seconds(summary[p]) for p in ['p50', 'p95', 'p99']])
+
+    print '{:.1f}s, {:.2f} requests/s'.format(report['seconds'],
+        report['requests_per_second'])
+    for kind, summary in sorted(report['requests'].items()):
+        print '  {:22} {}'.format(kind, format_summary(summary))
+    print '  {:22} {}'.format('time to result',
+        format_summary(report['time_to_result']))
+    for option_set, summary in sorted(
+            report['time_to_result_by_options'].items()):
+        print '    {:20} {}'.format(option_set, format_summary(summary))
+    print '  statuses:', ', '.join('{} {}'.format(status, count)
+        for status, count in sorted(report['statuses'].items()))
+    if report['sqlite']:
+        sqlite = report['sqlite']
+        print '  {:22} {}'.format('sqlite writes',
+            format_summary(sqlite['write_statements']))
+        print '  {:22} {}'.format('sqlite commits',
+            format_summary(sqlite['commits']))
+        print '  sqlite "database is locked" errors:', sqlite['locked_errors']
+
+def format_seconds(seconds):
+    return '   -    ' if seconds is None else '{:7.3f}s'.format(seconds)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,3 +9,62 @@ SCRIPT_PATH = os.path.join(APP_DIR, 'cli', 'imagemanipulator.py')
 PYTHON = os.path.join(ROOT_DIR, 'env', 'bin', 'python')
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(ROOT_DIR, 'app.db')
 SQLALCHEMY_MIGRATE_REPO = os.path.join(ROOT_DIR, 'db_repository')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+RESULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+MEMO_DIR = os.path.join(ROOT_DIR, 'memo')
+# Hand file transfers off to the front proxy: None, 'nginx' (X-Accel-Redirect)
+# or 'apache' (X-Sendfile)
+SENDFILE_BACKEND = None
+ACCEL_REDIRECT_PREFIX = '/protected/images/'
+ETAG_CACHE_SIZE = 10000
+IMAGE_SHARD_LEVELS = 2
+# Garbage collection of uploads and results, least recently accessed first
+GC_ENABLED = True
+GC_QUOTA_BYTES = 20 * 1024 * 1024 * 1024
+GC_TTL = 30 * 24 * 60 * 60
+GC_INTERVAL = 10
+GC_BATCH_SIZE = 50
+GC_UPLOAD_GRACE = 5 * 60
+WORKER_COUNT = 4
+LOW_PRIORITY_WORKER_COUNT = 1
+PREVIEW_WORKER_COUNT = 1
+# Jobs from one client are run cheapest first, with their cost halved for
+# every SCHEDULER_AGING seconds they wait. Jobs waiting longer than
+# SCHEDULER_MAX_WAIT seconds are run before all others.
+SCHEDULER_AGING = 60
+SCHEDULER_MAX_WAIT = 600
+# Single frame jobs up to this estimated cost run on the preview workers
+PREVIEW_MAX_COST = 2
+# Uploads wider than this are shown reduced to it while their job runs, when
+# their format can be decoded at a reduced resolution
+PREVIEW_IMAGE_WIDTH = 1024
+# Estimated seconds of work above which jobs go to the low priority queue,
+# and above which they are downscaled to fit it or rejected
+ADMISSION_ACCEPT_COST = 30
+ADMISSION_LOW_PRIORITY_COST = 300
+ADMISSION_MIN_WIDTH = 256
+# Animated uploads are costed by their frames, and rejected if they have more
+# than this many
+ADMISSION_MAX_FRAMES = 1000
+# Limits of the worker processes running the manipulation script
+JOB_TIMEOUT = 300
+WORKER_CPU_LIMIT = 300
+WORKER_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+# Jobs whose result page has not polled for ABANDON_TIMEOUT seconds are
+# cancelled
+ABANDON_TIMEOUT = 30
+ABANDON_CHECK_INTERVAL = 5
+# Save a pstats profile of every job next to its gif
+PROFILE_JOBS = False
+# Encode the gif of each job while its frames are rendered
+PIPELINE_JOBS = True
+# Threads each job runs its box operations on
+JOB_THREADS = 2
+# The most images a batch can have, and how often a batch checks its jobs.
+# Every image of a batch is uploaded before its response starts
+BATCH_MAX_IMAGES = 200
+# The most bytes an image of a batch, and all of them together, can take up
+# once unzipped
+BATCH_MAX_IMAGE_BYTES = 100 * 1024 * 1024
+BATCH_MAX_TOTAL_BYTES = 2 * 1024 * 1024 * 1024
+BATCH_POLL_INTERVAL = 0.5
@@ -0,0 +1,55 @@
+"""
+Smoke tests that run the manipulation script with each operation, with and
+without kernel threads, on a small generated image of every mode.
+
+    python -m unittest discover tests
+"""
+import os, sys, json, shutil, tempfile, subprocess, unittest
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT_DIR, 'ImageManipulator', 'cli',
+    'imagemanipulator.py')
+
+OPERATIONS = ['--flip', '--ninety', '--random', '--average']
+MODES = ['RGB', 'RGBA', 'L', 'P']
+
+class OperationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_image(self, mode):
+        """ :return: The path of a small gradient image in mode. """
+        image = Image.linear_gradient('L').resize((48, 32)).convert(mode)
+        path = os.path.join(self.directory, mode.lower() + '.png')
+        image.save(path)
+        return path
+
+    def run_script(self, image_path, *arguments):
+        """
+        Runs the script on image_path with arguments.
+
+        :return: The results it printed.
+        """
+        output = subprocess.check_output([sys.executable, SCRIPT_PATH,
+            image_path, '-o', self.directory, '-bs', '4', '-i', '2',
+            '--frames'] + list(arguments))
+        return json.loads(output.splitlines()[-1])
+
+    def test_operations(self):
+        for mode in MODES:
+            image_path = self.make_image(mode)
+            for operation in OPERATIONS:
+                for threads in ['0', '2']:
+                    results = self.run_script(image_path, operation,
+                        '--threads', threads)
+                    self.assertEqual(len(results['frames']), 2)
+                    for name in [results['gif']] + results['frames']:
+                        path = os.path.join(self.directory, name)
+                        self.assertTrue(os.path.exists(path), name)
+
+if __name__ == '__main__':
+    unittest.main()